@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+#
+#  IRIS VT Module Source Code
+#  contact@dfir-iris.org
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Benchmarks the enrichment of IOCs end to end, from IrisVTInterface._handle_ioc down to the HTTP requests,
+against a local VT stub server. Results are printed as JSON so runs can be compared.
+
+    python benchmarks/bench_hooks.py --hooks 2000 --latency 0.05 --quota-ratio 0.01 --output run.json
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import resource
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from iris_stubs import FakeIoc, attribute_writes, install_iris_stubs
+from vt_stub import VtStubServer
+
+install_iris_stubs()
+
+import iris_vt_module.IrisVTConfig as interface_conf
+from iris_vt_module.IrisVTInterface import IrisVTInterface
+from iris_vt_module.vt_handler import vt_async_client, vt_client
+from iris_vt_module.vt_handler.vt_cache import IOC_KIND_DOMAIN, IOC_KIND_HASH, IOC_KIND_IP
+from iris_vt_module.vt_handler.vt_handler import VtHandler
+
+IOC_TYPES = {
+    IOC_KIND_IP: 'ip-dst',
+    IOC_KIND_DOMAIN: 'domain',
+    IOC_KIND_HASH: 'md5'
+}
+
+HANDLERS = {
+    IOC_KIND_IP: 'handle_vt_ip',
+    IOC_KIND_DOMAIN: 'handle_vt_domain',
+    IOC_KIND_HASH: 'handle_vt_hash'
+}
+
+
+def get_rss_kb():
+    """
+    Returns the current resident set size of the process
+
+    :return: RSS in KB, or None if unavailable on this platform
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def get_peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux reports KB
+    return peak // 1024 if platform.system() == 'Darwin' else peak
+
+
+def percentiles(samples):
+    """
+    Summarizes latency samples
+
+    :param samples: List of durations in seconds
+    :return: Dict of statistics in milliseconds
+    """
+    if not samples:
+        return {'count': 0}
+
+    ordered = sorted(samples)
+
+    def rank(percent):
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))] * 1000, 3)
+
+    return {
+        'count': len(ordered),
+        'mean': round(sum(ordered) / len(ordered) * 1000, 3),
+        'p50': rank(50),
+        'p95': rank(95),
+        'p99': rank(99),
+        'max': round(ordered[-1] * 1000, 3)
+    }
+
+
+class IocFactory(object):
+    """
+    Builds batches of fake IOCs with a given mix of types. Values are unique unless a repeat ratio
+    is set, in which case some values are drawn from the ones already used, as happens across cases
+    """
+    def __init__(self, mix, repeat_ratio):
+        self.kinds = [kind for kind, weight in mix.items() for _ in range(weight)]
+        self.repeat_ratio = repeat_ratio
+        self.count = 0
+
+    def value(self, kind, number):
+        # Routable addresses and non reserved names, so the pre-flight checks let them through
+        if kind == IOC_KIND_IP:
+            return f'45.{number >> 16 & 255}.{number >> 8 & 255}.{number & 255}'
+        if kind == IOC_KIND_DOMAIN:
+            return f'bench-{number}.iris-vt-bench.net'
+        return f'{number:032x}'
+
+    def batch(self, size):
+        iocs = []
+        for _ in range(size):
+            self.count += 1
+            kind = self.kinds[self.count % len(self.kinds)]
+            number = self.count
+            if self.repeat_ratio and (self.count * 7919) % 1000 < self.repeat_ratio * 1000:
+                number = (self.count * 104729) % max(1, self.count // 2) + 1
+            iocs.append((kind, FakeIoc(self.count, IOC_TYPES[kind], self.value(kind, number))))
+        return iocs
+
+
+def point_clients_to(base_url):
+    """
+    Makes the VT clients built by the module target the stub server
+
+    :param base_url: Base URL of the stub API
+    :return: Nothing
+    """
+    for client_class in (vt_client.VtClient, getattr(vt_async_client, 'VtAsyncClient', None)):
+        if client_class is None:
+            continue
+
+        original_init = client_class.__init__
+
+        def patched_init(self, *args, _original_init=original_init, **kwargs):
+            _original_init(self, *args, **kwargs)
+            self.base_url = base_url
+
+        client_class.__init__ = patched_init
+
+
+def time_handlers(samples):
+    """
+    Records the duration of the enrichment of each IOC, per IOC kind
+
+    :param samples: Dict of lists of durations, filled per IOC kind
+    :return: Nothing
+    """
+    for kind, handler_name in HANDLERS.items():
+        handler = getattr(VtHandler, handler_name)
+
+        def timed_handler(self, *args, _handler=handler, _kind=kind, **kwargs):
+            start = time.perf_counter()
+            try:
+                return _handler(self, *args, **kwargs)
+            finally:
+                samples[_kind].append(time.perf_counter() - start)
+
+        setattr(VtHandler, handler_name, timed_handler)
+
+
+def build_config(args):
+    config = {param['param_name']: param['default'] for param in interface_conf.module_configuration}
+    config.update({
+        'vt_api_key': 'benchmark',
+        'vt_cache_enabled': False,
+        'vt_rate_limit_per_minute': '0',
+        'vt_rate_limit_per_day': '0',
+        'vt_rate_limit_per_month': '0',
+        'vt_rate_limit_max_wait': '0',
+        'vt_max_concurrency': args.concurrency,
+        'vt_lookup_engine': args.engine
+    })
+
+    for override in args.config:
+        name, _, value = override.partition('=')
+        config[name] = json.loads(value) if value[:1] and value[:1] in '0123456789-[{tfn"' else value
+
+    return config
+
+
+def run(args):
+    stub = VtStubServer(latency=args.latency, quota_ratio=args.quota_ratio, oversized_ratio=args.oversized_ratio,
+                        oversize_factor=args.oversize_factor, seed=args.seed)
+    base_url = stub.start()
+    point_clients_to(base_url)
+
+    enrich_samples = defaultdict(list)
+    time_handlers(enrich_samples)
+
+    config = build_config(args)
+    module = IrisVTInterface()
+    module.log.setLevel(logging.WARNING)
+    type(module).module_dict_conf = property(lambda self: config)
+    type(module).server_dict_conf = property(lambda self: {})
+
+    mix = {IOC_KIND_IP: args.mix[0], IOC_KIND_DOMAIN: args.mix[1], IOC_KIND_HASH: args.mix[2]}
+    factory = IocFactory(mix, args.repeat_ratio)
+
+    hook_samples = []
+    errors = 0
+    rss_start = get_rss_kb()
+    rss_after_warmup = rss_start
+    rss_series = []
+    started = time.perf_counter()
+
+    for hook_number in range(args.warmup + args.hooks):
+        if hook_number == args.warmup:
+            gc.collect()
+            rss_after_warmup = get_rss_kb()
+            enrich_samples.clear()
+            started = time.perf_counter()
+
+        iocs = [ioc for _, ioc in factory.batch(args.batch_size)]
+
+        start = time.perf_counter()
+        status = module._handle_ioc(iocs, hook_name='on_postload_ioc_create')
+        if hook_number >= args.warmup:
+            hook_samples.append(time.perf_counter() - start)
+            if not status.is_success():
+                errors += 1
+
+            if (hook_number - args.warmup) % max(1, args.hooks // 20) == 0:
+                rss_series.append(get_rss_kb())
+
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    rss_end = get_rss_kb()
+    stub.stop()
+
+    enriched = args.hooks * args.batch_size
+    return {
+        'config': {name: value for name, value in vars(args).items() if name != 'output'},
+        'iocs': enriched,
+        'hooks': args.hooks,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_iocs_per_s': round(enriched / elapsed, 2) if elapsed else None,
+        'failed_hooks': errors,
+        'latency_ms': dict({'hook': percentiles(hook_samples)},
+                           **{kind: percentiles(samples) for kind, samples in sorted(enrich_samples.items())}),
+        'memory_kb': {
+            'rss_start': rss_start,
+            'rss_after_warmup': rss_after_warmup,
+            'rss_end': rss_end,
+            'growth_after_warmup': rss_end - rss_after_warmup if rss_end is not None else None,
+            'peak_rss': get_peak_rss_kb(),
+            'rss_series': rss_series
+        },
+        'attribute_writes': attribute_writes['count'],
+        'stub': dict(stub.stats)
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the IRIS VT module against a local VT stub server')
+    parser.add_argument('--hooks', type=int, default=1000, help='Number of measured hook calls')
+    parser.add_argument('--warmup', type=int, default=20, help='Number of hook calls run before measuring')
+    parser.add_argument('--batch-size', type=int, default=10, help='Number of IOCs per hook call')
+    parser.add_argument('--mix', type=int, nargs=3, default=[1, 1, 1], metavar=('IP', 'DOMAIN', 'HASH'),
+                        help='Relative weights of the IOC types')
+    parser.add_argument('--repeat-ratio', type=float, default=0.0,
+                        help='Ratio of IOC values reused from previous hooks')
+    parser.add_argument('--latency', type=float, default=0.0, help='Stub response delay in seconds')
+    parser.add_argument('--quota-ratio', type=float, default=0.0, help='Ratio of 204 quota responses')
+    parser.add_argument('--oversized-ratio', type=float, default=0.0, help='Ratio of oversized IP/domain payloads')
+    parser.add_argument('--oversize-factor', type=int, default=200, help='Multiplier of oversized list sections')
+    parser.add_argument('--concurrency', type=int, default=4, help='vt_max_concurrency of the module')
+    parser.add_argument('--engine', default='threads', choices=['threads', 'asyncio'], help='Lookup engine')
+    parser.add_argument('--config', action='append', default=[], metavar='PARAM=VALUE',
+                        help='Overrides a module configuration parameter, values are parsed as JSON when possible')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the stub random draws')
+    parser.add_argument('--output', help='Writes the results to this file instead of stdout')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    results = run(args)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+#
+#  IRIS VT Module Source Code
+#  contact@dfir-iris.org
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Benchmarks the negative cache of unknown indicators: time to record them, size of the generation files, and
+latency of the lookups done before any network call, from a second cache instance mapping the files as
+another IRIS worker would. Results are printed as JSON.
+
+    python benchmarks/bench_negative_cache.py --entries 1000000 --lookups 100000 --max-lookup-us 50
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from iris_vt_module.vt_handler.vt_negative_cache import VtNegativeCache  # noqa: E402
+
+from bench_startup import get_rss_kb  # noqa: E402
+
+
+def random_hash():
+    return '%064x' % random.getrandbits(256)
+
+
+def time_lookups(cache, values):
+    """
+    Times lookups of the negative cache
+
+    :param cache: VtNegativeCache
+    :param values: Hashes looked up
+    :return: Dict of latency percentiles, in microseconds
+    """
+    durations = []
+    for value in values:
+        start = time.perf_counter()
+        cache.contains('hash', value)
+        durations.append((time.perf_counter() - start) * 1e6)
+
+    durations.sort()
+    return {
+        'p50_us': round(statistics.median(durations), 2),
+        'p99_us': round(durations[int(len(durations) * 0.99)], 2),
+        'max_us': round(durations[-1], 2)
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as cache_directory:
+        # Laid out as in production, under the private directory of the databases
+        directory = os.path.join(cache_directory, 'vt_negative_cache')
+        writer = VtNegativeCache(directory, args.ttl * 3600)
+        known = [random_hash() for _ in range(args.entries)]
+
+        start = time.perf_counter()
+        for value in known:
+            writer.add('hash', value)
+        writer.flush()
+        fill_seconds = time.perf_counter() - start
+
+        files_bytes = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+        rss_before = get_rss_kb()
+        reader = VtNegativeCache(directory, args.ttl * 3600)
+        hits = time_lookups(reader, random.choices(known, k=args.lookups))
+        misses = time_lookups(reader, [random_hash() for _ in range(args.lookups)])
+        rss_after = get_rss_kb()
+
+        results = {
+            'entries': reader.get_size(),
+            'fill_seconds': round(fill_seconds, 3),
+            'files_mb': round(files_bytes / 1e6, 3),
+            'bytes_per_entry': round(files_bytes / max(args.entries, 1), 2),
+            'reader_rss_kb': rss_after - rss_before if rss_before is not None else None,
+            'hits': hits,
+            'misses': misses
+        }
+
+    failures = []
+    if args.max_lookup_us is not None:
+        for kind in ('hits', 'misses'):
+            if results[kind]['p50_us'] > args.max_lookup_us:
+                failures.append(f'{kind} p50 {results[kind]["p50_us"]}us above {args.max_lookup_us}us')
+    results['failures'] = failures
+
+    print(json.dumps(results, indent=2))
+
+    return 1 if failures else 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the negative cache of the IRIS VT module')
+    parser.add_argument('--entries', type=int, default=1000000, help='Number of unknown indicators recorded')
+    parser.add_argument('--lookups', type=int, default=100000, help='Number of hits and of misses timed')
+    parser.add_argument('--ttl', type=int, default=24, help='TTL of the negative cache, in hours')
+    parser.add_argument('--max-lookup-us', type=float, help='Fails if the median hit or miss latency is above')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
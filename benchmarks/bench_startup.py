@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+#
+#  IRIS VT Module Source Code
+#  contact@dfir-iris.org
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Benchmarks the startup of the module in a fresh interpreter: import of IrisVTInterface, as done by every IRIS
+worker, hook registration, and the first hook, which pays for the imports deferred until an enrichment runs.
+Each run is a separate process, so imports are never already cached. Results are printed as JSON.
+
+    python benchmarks/bench_startup.py --runs 10 --max-import-ms 100 --output startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Modules which must not be loaded by a worker which only imports the module or registers its hooks
+HEAVY_MODULES = ('requests', 'urllib3', 'jinja2', 'aiohttp', 'asyncio')
+
+
+def get_rss_kb():
+    """
+    Returns the current resident set size of the process
+
+    :return: RSS in KB, or None if unavailable on this platform
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def get_heavy_modules():
+    return sorted(module for module in HEAVY_MODULES if module in sys.modules)
+
+
+def measure_phase(results, phase, func):
+    """
+    Runs a startup phase and records its duration, RSS growth and loaded modules
+
+    :param results: Dict the measures are added to
+    :param phase: Name of the phase
+    :param func: Callable running the phase
+    :return: Result of func
+    """
+    modules_before = len(sys.modules)
+    rss_before = get_rss_kb()
+    start = time.perf_counter()
+
+    value = func()
+
+    results[phase] = {
+        'ms': round((time.perf_counter() - start) * 1000, 3),
+        'rss_kb': get_rss_kb() - rss_before if rss_before is not None else None,
+        'modules': len(sys.modules) - modules_before,
+        'heavy_modules': get_heavy_modules()
+    }
+    return value
+
+
+def run_child():
+    """
+    Measures the startup phases in this process, which must be a fresh interpreter
+
+    :return: Dict of measures by phase
+    """
+    sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+    sys.path.insert(0, BENCHMARKS_DIR)
+    results = {}
+
+    def install_stubs():
+        from iris_stubs import install_iris_stubs
+        install_iris_stubs()
+
+    # iris_interface and the IRIS stubs are loaded first, they are not part of the module footprint
+    measure_phase(results, 'iris_stubs', install_stubs)
+
+    def import_module():
+        from iris_vt_module.IrisVTInterface import IrisVTInterface
+        return IrisVTInterface
+
+    module_class = measure_phase(results, 'import', import_module)
+
+    import iris_vt_module.IrisVTConfig as interface_conf
+    config = {param['param_name']: param['default'] for param in interface_conf.module_configuration}
+    config.update({
+        'vt_api_key': 'benchmark',
+        'vt_on_create_hook_enabled': True,
+        'vt_cache_enabled': False,
+        'vt_rate_limit_per_minute': '0',
+        'vt_rate_limit_per_day': '0',
+        'vt_rate_limit_per_month': '0'
+    })
+    module_class.module_dict_conf = property(lambda self: config)
+    module_class.server_dict_conf = property(lambda self: {})
+
+    def register():
+        module = module_class()
+        module.register_hooks(module_id=1)
+        return module
+
+    module = measure_phase(results, 'register', register)
+
+    from iris_stubs import FakeIoc
+    from vt_stub import VtStubServer
+
+    stub = VtStubServer()
+    base_url = stub.start()
+
+    def first_hook():
+        from iris_vt_module.vt_handler import vt_client
+        vt_client.VT_API_URL = base_url
+        return module._handle_ioc([FakeIoc(1, 'ip-dst', '8.8.8.8')], hook_name='on_postload_ioc_create')
+
+    measure_phase(results, 'first_hook', first_hook)
+    stub.stop()
+
+    return results
+
+
+def summarize(runs):
+    """
+    Summarizes the measures of several runs, keeping the median of each numeric measure
+
+    :param runs: List of dicts returned by run_child
+    :return: Dict of summarized measures by phase
+    """
+    summary = {}
+    for phase in runs[0]:
+        summary[phase] = {}
+        for measure, value in runs[0][phase].items():
+            values = [run[phase][measure] for run in runs]
+            if isinstance(value, (int, float)):
+                summary[phase][measure] = statistics.median(values)
+                summary[phase][f'{measure}_max'] = max(values)
+            else:
+                summary[phase][measure] = value
+
+    return summary
+
+
+def check_limits(summary, args):
+    """
+    Returns the startup regressions found, compared to the limits given on the command line
+
+    :param summary: Dict returned by summarize
+    :param args: Parsed arguments
+    :return: List of messages
+    """
+    failures = []
+    limits = [('import', 'ms', args.max_import_ms), ('import', 'rss_kb', args.max_import_rss_kb),
+              ('register', 'ms', args.max_register_ms)]
+
+    for phase, measure, limit in limits:
+        if limit is not None and summary[phase][measure] > limit:
+            failures.append(f'{phase} {measure} {summary[phase][measure]} above {limit}')
+
+    for phase in ('import', 'register'):
+        if summary[phase]['heavy_modules'] and not args.allow_heavy_modules:
+            failures.append(f'{phase} loaded {", ".join(summary[phase]["heavy_modules"])}')
+
+    return failures
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the import, registration and first hook of the '
+                                                 'IRIS VT module')
+    parser.add_argument('--runs', type=int, default=5, help='Number of fresh interpreters measured')
+    parser.add_argument('--max-import-ms', type=float, help='Fails if the median import time is above')
+    parser.add_argument('--max-import-rss-kb', type=int, help='Fails if the median import RSS growth is above')
+    parser.add_argument('--max-register-ms', type=float, help='Fails if the median registration time is above')
+    parser.add_argument('--allow-heavy-modules', action='store_true',
+                        help=f'Do not fail if the import or registration loads one of {", ".join(HEAVY_MODULES)}')
+    parser.add_argument('--output', help='Writes the results to this file instead of stdout')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.child:
+        print(json.dumps(run_child()))
+        return 0
+
+    runs = []
+    for _ in range(args.runs):
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child'], check=True,
+                                stdout=subprocess.PIPE, universal_newlines=True).stdout
+        runs.append(json.loads(output.splitlines()[-1]))
+
+    summary = summarize(runs)
+    failures = check_limits(summary, args)
+    results = {'runs': args.runs, 'phases': summary, 'failures': failures}
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
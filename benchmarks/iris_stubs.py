@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+#
+#  IRIS VT Module Source Code
+#  contact@dfir-iris.org
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+import importlib
+import sys
+import types
+
+
+class FakeIocType(object):
+    def __init__(self, type_name):
+        self.type_name = type_name
+
+
+class FakeIoc(object):
+    """
+    Stand-in for the IOC model of IRIS, holding the fields the module reads and writes
+    """
+    def __init__(self, ioc_id, type_name, value):
+        self.ioc_id = ioc_id
+        self.ioc_type = FakeIocType(type_name)
+        self.ioc_value = value
+        self.ioc_tags = ''
+        self.ioc_description = ''
+        self.custom_attributes = None
+
+
+# Number of attributes written through the stubbed add_tab_attribute_field
+attribute_writes = {'count': 0}
+
+
+def add_tab_attribute_field(obj, tab_name, field_name, field_type, field_value, mandatory=None, field_options=None):
+    """
+    Stub of the IRIS helper, storing the attribute on the object without any database
+    """
+    if not obj.custom_attributes:
+        obj.custom_attributes = {}
+
+    obj.custom_attributes.setdefault(tab_name, {})[field_name] = {'type': field_type, 'value': field_value}
+    attribute_writes['count'] += 1
+
+
+def _add_module(name, **attributes):
+    module = sys.modules.get(name)
+    if module is None:
+        module = types.ModuleType(name)
+        sys.modules[name] = module
+
+    for attribute, value in attributes.items():
+        setattr(module, attribute, value)
+
+    return module
+
+
+def install_iris_stubs():
+    """
+    Makes the module importable outside of IRIS. The IRIS helpers the module and iris_interface import are
+    replaced by stubs, and add_tab_attribute_field is always stubbed so no database is needed.
+    Must be called before importing iris_vt_module
+
+    :return: Nothing
+    """
+    try:
+        importlib.import_module('app')
+        iris_available = True
+    except ImportError:
+        iris_available = False
+
+    if not iris_available:
+        from iris_interface import IrisInterfaceStatus
+
+        def succeed(*args, **kwargs):
+            return IrisInterfaceStatus.I2Success()
+
+        def register(*args, **kwargs):
+            return True, 'Registered (stub)'
+
+        for package in ('app', 'app.datamgmt', 'app.datamgmt.manage', 'app.datamgmt.iris_engine',
+                        'app.iris_engine', 'app.iris_engine.module_handler'):
+            _add_module(package, __path__=[])
+
+        _add_module('app.datamgmt.manage.manage_srv_settings_db', get_server_settings_as_dict=lambda: {})
+        _add_module('app.datamgmt.iris_engine.evidence_storage', EvidenceStorage=type('EvidenceStorage', (), {}))
+        _add_module('app.iris_engine.module_handler.module_handler', register_hook=register,
+                    deregister_from_hook=register,
+                    get_mod_config_by_name=lambda name: IrisInterfaceStatus.I2Success(data=None))
+
+    try:
+        importlib.import_module('celery')
+    except ImportError:
+        _add_module('celery', Task=type('Task', (), {'request_stack': None}))
+
+    _add_module('app.datamgmt.manage.manage_attribute_db', add_tab_attribute_field=add_tab_attribute_field)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+#
+#  IRIS VT Module Source Code
+#  contact@dfir-iris.org
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+RECORDINGS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'recordings')
+
+# Sections multiplied in oversized payloads, as returned for shared hosting or CDN infrastructure
+OVERSIZED_SECTIONS = ('resolutions', 'subdomains', 'undetected_urls', 'detected_urls')
+
+
+def load_recording(name):
+    """
+    Loads a recorded VT v2 response
+
+    :param name: Name of the recording, without extension
+    :return: Decoded response
+    """
+    with open(os.path.join(RECORDINGS_PATH, f'{name}.json')) as recording:
+        return json.load(recording)
+
+
+class VtStubServer(object):
+    """
+    Local HTTP server answering the VT v2 endpoints used by the module with recorded responses.
+    Latency, quota exhausted responses and oversized payloads are configurable to reproduce the
+    conditions met against the real API
+    """
+    def __init__(self, latency=0.0, quota_ratio=0.0, oversized_ratio=0.0, oversize_factor=200, seed=0):
+        """
+        :param latency: Delay in seconds before each response
+        :param quota_ratio: Ratio of requests answered with 204, as VT does when the quota is exceeded
+        :param oversized_ratio: Ratio of IP and domain responses whose list sections are multiplied
+        :param oversize_factor: Multiplier of the list sections of oversized responses
+        :param seed: Seed of the random draws, so runs can be compared
+        """
+        self.latency = latency
+        self.quota_ratio = quota_ratio
+        self.oversized_ratio = oversized_ratio
+        self.oversize_factor = oversize_factor
+
+        self.recordings = {name: load_recording(name) for name in ('ip_report', 'domain_report', 'file_report')}
+        self.stats = {'requests': 0, 'quota_responses': 0, 'oversized_responses': 0, 'bytes_sent': 0}
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self._server.server_address[1]}/vtapi/v2/'
+
+    def start(self):
+        """
+        Starts serving on a random local port
+
+        :return: Base URL of the stub API
+        """
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are sent separately, Nagle would delay the body of kept-alive connections
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                status, body = stub.answer(self.path)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='vt_stub', daemon=True)
+        self._thread.start()
+
+        return self.base_url
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def _draw(self, ratio):
+        with self._lock:
+            return self._random.random() < ratio
+
+    def _count(self, stat, value=1):
+        with self._lock:
+            self.stats[stat] += value
+
+    def answer(self, path):
+        """
+        Builds the response to a request
+
+        :param path: Path and query of the request
+        :return: HTTP status and body
+        """
+        self._count('requests')
+        if self.latency:
+            time.sleep(self.latency)
+
+        if self._draw(self.quota_ratio):
+            self._count('quota_responses')
+            return 204, b''
+
+        url = urlparse(path)
+        query = parse_qs(url.query)
+
+        if url.path.endswith('/file/report'):
+            resources = [resource.strip() for resource in query.get('resource', [''])[0].split(',')]
+            reports = [self._file_report(resource) for resource in resources]
+            body = reports if len(reports) > 1 else reports[0]
+
+        elif url.path.endswith('/ip-address/report'):
+            body = self._maybe_oversized(self.recordings['ip_report'])
+
+        elif url.path.endswith('/domain/report'):
+            body = self._maybe_oversized(self.recordings['domain_report'])
+
+        else:
+            return 404, b''
+
+        body = json.dumps(body).encode('utf-8')
+        self._count('bytes_sent', len(body))
+
+        return 200, body
+
+    def _file_report(self, resource):
+        report = dict(self.recordings['file_report'])
+        for field in ('resource', 'md5', 'scan_id', 'permalink'):
+            report[field] = report[field].replace('RESOURCE', resource)
+
+        return report
+
+    def _maybe_oversized(self, report):
+        if not self._draw(self.oversized_ratio):
+            return report
+
+        self._count('oversized_responses')
+        report = dict(report)
+        for section in OVERSIZED_SECTIONS:
+            if isinstance(report.get(section), list):
+                report[section] = report[section] * self.oversize_factor
+
+        return report
@@ -42,6 +42,16 @@ module_configuration = [
         "mandatory": True,
         "type": "bool"
     },
+    {
+        "param_name": "vt_additional_api_keys",
+        "param_human_name": "Additional VT API keys",
+        "param_description": "Comma-separated list of additional API keys. Lookups are spread over the main key "
+                             "and these keys, each with its own quota. Suffix a key with :premium if it is premium, "
+                             "e.g. key1,key2:premium",
+        "default": None,
+        "mandatory": False,
+        "type": "sensitive_string"
+    },
     {
         "param_name": "vt_manual_hook_enabled",
         "param_human_name": "Manual triggers on IOCs",
@@ -69,6 +79,80 @@ module_configuration = [
         "type": "bool",
         "section": "Triggers"
     },
+    {
+        "param_name": "vt_case_manual_hook_enabled",
+        "param_human_name": "Manual triggers on cases",
+        "param_description": "Set to True to offer the possibility to enrich all the IOCs of a case at once, via "
+                             "a manual trigger on the case",
+        "default": True,
+        "mandatory": True,
+        "type": "bool",
+        "section": "Triggers"
+    },
+    {
+        "param_name": "vt_bulk_chunk_size",
+        "param_human_name": "Case enrichment chunk size",
+        "param_description": "Number of IOCs loaded and processed at once when enriching all the IOCs of a case",
+        "default": 100,
+        "mandatory": True,
+        "type": "int",
+        "section": "Triggers"
+    },
+    {
+        "param_name": "vt_update_freshness",
+        "param_human_name": "Update freshness window",
+        "param_description": "Number of hours during which an IOC update doesn't trigger a new enrichment, as long "
+                             "as the IOC value, type and report template are unchanged. 0 re-enriches on every "
+                             "update",
+        "default": 24,
+        "mandatory": True,
+        "type": "int",
+        "section": "Triggers"
+    },
+    {
+        "param_name": "vt_preflight_enabled",
+        "param_human_name": "Pre-flight checks",
+        "param_description": "Check IOCs before any lookup and skip those VT can't know: malformed IPs, domains "
+                             "and hashes, hashes other than md5, sha1 and sha256, and the non routable or "
+                             "excluded indicators below. Defanged values "
+                             "such as hxxp://evil[.]com are refanged before the checks",
+        "default": True,
+        "mandatory": True,
+        "type": "bool",
+        "section": "Pre-flight"
+    },
+    {
+        "param_name": "vt_preflight_skip_non_routable",
+        "param_human_name": "Skip non routable indicators",
+        "param_description": "Skip private, loopback, link-local, multicast and other reserved IP addresses, "
+                             "single-label names and reserved or internal domain suffixes (.local, .internal, "
+                             ".corp, .lan, ...)",
+        "default": True,
+        "mandatory": True,
+        "type": "bool",
+        "section": "Pre-flight"
+    },
+    {
+        "param_name": "vt_preflight_excluded",
+        "param_human_name": "Excluded indicators",
+        "param_description": "Networks and domain suffixes never looked up, separated by commas or new lines, "
+                             "e.g. 198.51.100.0/24, corp.example.com. A domain suffix also excludes its "
+                             "subdomains",
+        "default": None,
+        "mandatory": False,
+        "type": "string",
+        "section": "Pre-flight"
+    },
+    {
+        "param_name": "vt_preflight_allowed",
+        "param_human_name": "Allowed indicators",
+        "param_description": "Networks and domain suffixes always looked up, even if non routable or excluded, "
+                             "separated by commas or new lines",
+        "default": None,
+        "mandatory": False,
+        "type": "string",
+        "section": "Pre-flight"
+    },
     {
         "param_name": "vt_ip_assign_asn_as_tag",
         "param_human_name": "Assign ASN tag to IP",
@@ -107,6 +191,403 @@ module_configuration = [
         "type": "bool",
         "section": "Insights"
     },
+    {
+        "param_name": "vt_pool_size",
+        "param_human_name": "Connection pool size",
+        "param_description": "Maximum number of keep-alive connections kept open to VT",
+        "default": 10,
+        "mandatory": True,
+        "type": "int",
+        "section": "Connection"
+    },
+    {
+        "param_name": "vt_connect_timeout",
+        "param_human_name": "Connect timeout",
+        "param_description": "Number of seconds to wait for the connection to VT to be established",
+        "default": "5",
+        "mandatory": True,
+        "type": "float",
+        "section": "Connection"
+    },
+    {
+        "param_name": "vt_read_timeout",
+        "param_human_name": "Read timeout",
+        "param_description": "Number of seconds to wait for VT to answer once connected",
+        "default": "30",
+        "mandatory": True,
+        "type": "float",
+        "section": "Connection"
+    },
+    {
+        "param_name": "vt_retry_attempts",
+        "param_human_name": "Retries",
+        "param_description": "Number of times a VT request is retried after a network error, a timeout, a server "
+                             "error or a quota exceeded response",
+        "default": 2,
+        "mandatory": True,
+        "type": "int",
+        "section": "Connection"
+    },
+    {
+        "param_name": "vt_retry_backoff",
+        "param_human_name": "Retry backoff",
+        "param_description": "Delay in seconds before the first retry. The delay doubles at each retry, up to 30 "
+                             "seconds, and is partly randomized",
+        "default": "1",
+        "mandatory": True,
+        "type": "float",
+        "section": "Connection"
+    },
+    {
+        "param_name": "vt_breaker_threshold",
+        "param_human_name": "Circuit breaker threshold",
+        "param_description": "Number of consecutive failed VT requests after which lookups are suspended and fail "
+                             "immediately. 0 disables the circuit breaker",
+        "default": 5,
+        "mandatory": True,
+        "type": "int",
+        "section": "Connection"
+    },
+    {
+        "param_name": "vt_breaker_cooldown",
+        "param_human_name": "Circuit breaker cooldown",
+        "param_description": "Number of seconds lookups stay suspended once the circuit breaker opened, before a "
+                             "trial request is sent to VT",
+        "default": "60",
+        "mandatory": True,
+        "type": "float",
+        "section": "Connection"
+    },
+    {
+        "param_name": "vt_max_concurrency",
+        "param_human_name": "Max concurrent lookups",
+        "param_description": "Maximum number of VT lookups running at the same time while processing a hook. "
+                             "Set to 1 to fetch the reports one after the other",
+        "default": 4,
+        "mandatory": True,
+        "type": "int",
+        "section": "Connection"
+    },
+    {
+        "param_name": "vt_lookup_engine",
+        "param_human_name": "Lookup engine",
+        "param_description": "Engine running the concurrent VT lookups of a hook. 'threads' runs them in a thread "
+                             "pool, 'asyncio' keeps them in flight on a single event loop thread and requires "
+                             "aiohttp to be installed",
+        "default": "threads",
+        "mandatory": True,
+        "type": "string",
+        "section": "Connection"
+    },
+    {
+        "param_name": "vt_lookup_timeout",
+        "param_human_name": "Lookup timeout",
+        "param_description": "Maximum number of seconds a hook waits for the lookups of the asyncio engine. Lookups "
+                             "not completed in time are cancelled and their IOCs fail. 0 means no limit",
+        "default": "600",
+        "mandatory": False,
+        "type": "float",
+        "section": "Connection"
+    },
+    {
+        "param_name": "vt_backend",
+        "param_human_name": "Lookup backend",
+        "param_description": "Where reports are looked up. 'api' queries VT, 'mirror' only uses the local mirror "
+                             "and 'chained' uses the local mirror first and queries VT for the indicators it "
+                             "doesn't know",
+        "default": "api",
+        "mandatory": True,
+        "type": "string",
+        "section": "Connection"
+    },
+    {
+        "param_name": "vt_mirror_path",
+        "param_human_name": "Local mirror directory",
+        "param_description": "Directory of the local mirror, holding JSONL dumps of VT reports results, one per "
+                             "line. IP and domain results must carry an ip or domain field. The index of the "
+                             "dumps is written next to the report cache, so the directory may be read-only, "
+                             "and rebuilt when the dumps change",
+        "default": None,
+        "mandatory": False,
+        "type": "string",
+        "section": "Connection"
+    },
+    {
+        "param_name": "vt_rate_limit_per_minute",
+        "param_human_name": "Requests per minute",
+        "param_description": "Maximum number of requests sent to VT per minute and per key, over all the IRIS workers "
+                             "of the host. 0 means unlimited. Leave empty to use the quota of the key type (4 for "
+                             "public keys, unlimited for premium keys)",
+        "default": None,
+        "mandatory": False,
+        "type": "string",
+        "section": "Rate limiting"
+    },
+    {
+        "param_name": "vt_rate_limit_per_day",
+        "param_human_name": "Requests per day",
+        "param_description": "Maximum number of requests sent to VT per UTC day and per key. 0 means unlimited. Leave empty to "
+                             "use the quota of the key type (500 for public keys, unlimited for premium keys)",
+        "default": None,
+        "mandatory": False,
+        "type": "string",
+        "section": "Rate limiting"
+    },
+    {
+        "param_name": "vt_rate_limit_per_month",
+        "param_human_name": "Requests per month",
+        "param_description": "Maximum number of requests sent to VT per UTC month and per key. 0 means unlimited. Leave empty to "
+                             "use the quota of the key type (15500 for public keys, unlimited for premium keys)",
+        "default": None,
+        "mandatory": False,
+        "type": "string",
+        "section": "Rate limiting"
+    },
+    {
+        "param_name": "vt_rate_limit_max_wait",
+        "param_human_name": "Max wait for quota",
+        "param_description": "Maximum number of seconds a lookup waits for the quota to allow it before failing",
+        "default": "120",
+        "mandatory": True,
+        "type": "float",
+        "section": "Rate limiting"
+    },
+    {
+        "param_name": "vt_premium_key_weight",
+        "param_human_name": "Premium key weight",
+        "param_description": "Weight of premium keys against public keys when picking the key of a lookup. With "
+                             "the default, premium keys are picked 10 times more often than public keys while both "
+                             "have quota left",
+        "default": "10",
+        "mandatory": True,
+        "type": "float",
+        "section": "Rate limiting"
+    },
+    {
+        "param_name": "vt_key_quota_cooldown",
+        "param_human_name": "Key cooldown on quota exceeded",
+        "param_description": "Number of seconds a key is set aside after VT answered it exceeded its quota, "
+                             "when other keys are configured",
+        "default": "60",
+        "mandatory": True,
+        "type": "float",
+        "section": "Rate limiting"
+    },
+    {
+        "param_name": "vt_key_auth_cooldown",
+        "param_human_name": "Key cooldown on authentication failure",
+        "param_description": "Number of seconds a key is set aside after VT refused it",
+        "default": "3600",
+        "mandatory": True,
+        "type": "float",
+        "section": "Rate limiting"
+    },
+    {
+        "param_name": "vt_cache_enabled",
+        "param_human_name": "Cache VT reports",
+        "param_description": "Set to True to keep VT reports in a local cache, so the same IOC is not fetched "
+                             "again from VT until its TTL expires",
+        "default": True,
+        "mandatory": True,
+        "type": "bool",
+        "section": "Cache"
+    },
+    {
+        "param_name": "vt_cache_path",
+        "param_human_name": "Cache database path",
+        "param_description": "Path of the SQLite database holding the cached reports. The other databases of the "
+                             "module are stored in the same directory, which must be owned by the user running IRIS "
+                             "and not be writable by other users. Defaults to iris_vt_module/vt_cache.db in the "
+                             "cache directory of that user if empty",
+        "default": None,
+        "mandatory": False,
+        "type": "string",
+        "section": "Cache"
+    },
+    {
+        "param_name": "vt_cache_hash_ttl",
+        "param_human_name": "Hash reports TTL",
+        "param_description": "Number of hours a hash report is kept in cache",
+        "default": 168,
+        "mandatory": True,
+        "type": "int",
+        "section": "Cache"
+    },
+    {
+        "param_name": "vt_cache_ip_ttl",
+        "param_human_name": "IP reports TTL",
+        "param_description": "Number of hours an IP report is kept in cache",
+        "default": 24,
+        "mandatory": True,
+        "type": "int",
+        "section": "Cache"
+    },
+    {
+        "param_name": "vt_cache_domain_ttl",
+        "param_human_name": "Domain reports TTL",
+        "param_description": "Number of hours a domain report is kept in cache",
+        "default": 24,
+        "mandatory": True,
+        "type": "int",
+        "section": "Cache"
+    },
+    {
+        "param_name": "vt_cache_max_entries",
+        "param_human_name": "Cache max entries",
+        "param_description": "Maximum number of reports kept in cache. Least recently used reports are evicted first. "
+                             "0 keeps every report",
+        "default": 50000,
+        "mandatory": True,
+        "type": "int",
+        "section": "Cache"
+    },
+    {
+        "param_name": "vt_cache_prewarm_samples",
+        "param_human_name": "Pre-warm sample reports",
+        "param_description": "Record the samples listed by IP and domain reports (downloaded and communicating "
+                             "samples) and use the free slots of batched hash requests to cache their reports. "
+                             "Needs the report cache",
+        "default": True,
+        "mandatory": True,
+        "type": "bool",
+        "section": "Cache"
+    },
+    {
+        "param_name": "vt_negative_cache_enabled",
+        "param_human_name": "Cache unknown indicators",
+        "param_description": "Set to True to remember the indicators VT doesn't know, so they are not looked up "
+                             "again until the negative cache TTL expires. Stored next to the report cache",
+        "default": True,
+        "mandatory": True,
+        "type": "bool",
+        "section": "Cache"
+    },
+    {
+        "param_name": "vt_negative_cache_ttl",
+        "param_human_name": "Unknown indicators TTL",
+        "param_description": "Number of hours an indicator VT doesn't know is remembered as unknown",
+        "default": 24,
+        "mandatory": True,
+        "type": "int",
+        "section": "Cache"
+    },
+    {
+        "param_name": "vt_report_max_items",
+        "param_human_name": "Max items per report section",
+        "param_description": "Maximum number of items rendered for each list section of a report (resolutions, "
+                             "subdomains, detected URLs, scans, ...). Extra items are dropped and marked as "
+                             "truncated in the raw JSON view. 0 means unlimited",
+        "default": 200,
+        "mandatory": True,
+        "type": "int",
+        "section": "Templates"
+    },
+    {
+        "param_name": "vt_report_max_bytes",
+        "param_human_name": "Max report size",
+        "param_description": "Maximum size in bytes of a rendered report. Larger reports are rendered with fewer "
+                             "items per section until they fit, the dropped items being marked in the raw report. "
+                             "0 means unlimited",
+        "default": 1048576,
+        "mandatory": True,
+        "type": "int",
+        "section": "Templates"
+    },
+    {
+        "param_name": "vt_render_cache_max_mb",
+        "param_human_name": "Rendered reports cache size",
+        "param_description": "Maximum size in MB of the rendered reports kept by each worker, so an unchanged "
+                             "report rendered with an unchanged template is reused instead of rendered again. "
+                             "0 disables the cache",
+        "default": 64,
+        "mandatory": True,
+        "type": "int",
+        "section": "Templates"
+    },
+    {
+        "param_name": "vt_projection_max_items",
+        "param_human_name": "Max parsed items",
+        "param_description": "Maximum number of resolutions, subdomains and domain siblings kept when IP and domain "
+                             "reports are parsed. Items beyond are skipped while the response is streamed and never "
+                             "loaded in memory. Detected URLs and samples are always kept whole as the detection "
+                             "ratios are computed on them. 0 means unlimited",
+        "default": 1000,
+        "mandatory": True,
+        "type": "int",
+        "section": "Templates"
+    },
+    {
+        "param_name": "vt_projection_skip_undetected",
+        "param_human_name": "Skip undetected sections",
+        "param_description": "Drop the undetected URLs and samples sections of IP and domain reports while the "
+                             "response is streamed",
+        "default": True,
+        "mandatory": True,
+        "type": "bool",
+        "section": "Templates"
+    },
+    {
+        "param_name": "vt_deferred_enabled",
+        "param_human_name": "Deferred enrichment",
+        "param_description": "Set to True to enrich created and updated IOCs in the background. The hooks queue "
+                             "the IOCs in a durable queue and return immediately, and a worker thread enriches "
+                             "them at the pace allowed by the rate limits. Manual triggers stay synchronous",
+        "default": False,
+        "mandatory": True,
+        "type": "bool",
+        "section": "Deferred enrichment"
+    },
+    {
+        "param_name": "vt_deferred_batch_size",
+        "param_human_name": "Deferred batch size",
+        "param_description": "Maximum number of queued IOCs enriched at once by the background worker",
+        "default": 20,
+        "mandatory": True,
+        "type": "int",
+        "section": "Deferred enrichment"
+    },
+    {
+        "param_name": "vt_deferred_retry_delay",
+        "param_human_name": "Deferred retry delay",
+        "param_description": "Delay in seconds before retrying a failed deferred enrichment. The delay doubles "
+                             "after each failed attempt",
+        "default": 60,
+        "mandatory": True,
+        "type": "int",
+        "section": "Deferred enrichment"
+    },
+    {
+        "param_name": "vt_deferred_max_attempts",
+        "param_human_name": "Deferred max attempts",
+        "param_description": "Number of failed attempts after which a queued IOC is dead-lettered. Dead-lettered "
+                             "IOCs are kept in the queue until they are updated again",
+        "default": 5,
+        "mandatory": True,
+        "type": "int",
+        "section": "Deferred enrichment"
+    },
+    {
+        "param_name": "vt_hook_log_enabled",
+        "param_human_name": "Structured hook log",
+        "param_description": "Set to True to log a JSON summary of each processed hook, with the number of IOCs "
+                             "enriched, failed and skipped and the time spent in each enrichment stage",
+        "default": False,
+        "mandatory": True,
+        "type": "bool",
+        "section": "Metrics"
+    },
+    {
+        "param_name": "vt_metrics_textfile_dir",
+        "param_human_name": "Metrics textfile directory",
+        "param_description": "Directory of a node_exporter textfile collector. When set, each worker exports its "
+                             "lookups, errors, quota, bytes and stage timing counters in the Prometheus text format "
+                             "to its own iris_vt_module_<pid>.prom file after each hook. Files of exited workers are "
+                             "removed",
+        "default": None,
+        "mandatory": False,
+        "type": "string",
+        "section": "Metrics"
+    },
     {
         "param_name": "vt_domain_report_template",
         "param_human_name": "Domain report template",
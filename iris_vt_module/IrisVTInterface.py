@@ -16,12 +16,25 @@
 #  You should have received a copy of the GNU Lesser General Public License
 #  along with this program; if not, write to the Free Software Foundation,
 #  Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+import json
+import time
+import traceback
+from collections import Counter
 
 import iris_interface.IrisInterfaceStatus as InterfaceStatus
 from iris_interface.IrisModuleInterface import IrisModuleInterface, IrisModuleTypes
 
 import iris_vt_module.IrisVTConfig as interface_conf
-from iris_vt_module.vt_handler.vt_handler import VtHandler
+from iris_vt_module.vt_handler.vt_bulk import commit_chunk, count_case_iocs, get_bulk_checkpoints, iter_case_iocs
+from iris_vt_module.vt_handler.vt_cache import normalize_ioc_value, HASH_TYPES, IOC_KIND_DOMAIN, IOC_KIND_HASH, \
+    IOC_KIND_IP
+from iris_vt_module.vt_handler.vt_deferred import get_deferred_queue, get_deferred_worker, load_iocs, \
+    log as deferred_log
+from iris_vt_module.vt_handler.vt_metrics import metrics
+from iris_vt_module.vt_handler.vt_preflight import get_preflight, SKIP_REASONS
+
+# Hooks whose IOCs are enriched in the background when the deferred enrichment is enabled
+DEFERRABLE_HOOKS = ['on_postload_ioc_create', 'on_postload_ioc_update']
 
 
 class IrisVTInterface(IrisModuleInterface):
@@ -40,13 +53,25 @@ class IrisVTInterface(IrisModuleInterface):
 
     def register_hooks(self, module_id: int):
         """
-        Registers all the hooks
+        Registers all the hooks. A configuration with invalid report templates is refused before any
+        hook is registered, and the error returned to IRIS so it is shown at registration
 
         :param module_id: Module ID provided by IRIS
-        :return: Nothing
+        :return: IIStatus
         """
+        from iris_vt_module.vt_handler.vt_helper import validate_templates
+
         self.module_id = module_id
         module_conf = self.module_dict_conf
+
+        status = validate_templates(module_conf)
+        if status.is_failure():
+            self.log.error(status.get_message())
+            self.log.error(status.get_data())
+            return InterfaceStatus.IIStatus(code=InterfaceStatus.I2CodeError,
+                                            message=f'{status.get_message()}: {", ".join(status.get_data())}',
+                                            data=status.get_data(), logs=list(self.message_queue))
+
         if module_conf.get('vt_on_create_hook_enabled'):
             status = self.register_to_hook(module_id, iris_hook_name='on_postload_ioc_create')
             if status.is_failure():
@@ -82,6 +107,22 @@ class IrisVTInterface(IrisModuleInterface):
         else:
             self.deregister_from_hook(module_id=self.module_id, iris_hook_name='on_manual_trigger_ioc')
 
+        if module_conf.get('vt_case_manual_hook_enabled'):
+            status = self.register_to_hook(module_id, iris_hook_name='on_manual_trigger_case',
+                                           manual_hook_name='Enrich all IOCs with VT')
+            if status.is_failure():
+                self.log.error(status.get_message())
+                self.log.error(status.get_data())
+
+            else:
+                self.log.info("Successfully registered on_manual_trigger_case hook")
+
+        else:
+            self.deregister_from_hook(module_id=self.module_id, iris_hook_name='on_manual_trigger_case')
+
+        return InterfaceStatus.IIStatus(code=InterfaceStatus.I2CodeSuccess, message='Success',
+                                        logs=list(self.message_queue))
+
     def hooks_handler(self, hook_name: str, hook_ui_name: str, data: any):
         """
         Hooks handler table. Calls corresponding methods depending on the hooks name.
@@ -93,21 +134,34 @@ class IrisVTInterface(IrisModuleInterface):
         """
 
         self.log.info(f'Received {hook_name}')
-        if hook_name in ['on_postload_ioc_create', 'on_postload_ioc_update', 'on_manual_trigger_ioc']:
-            status = self._handle_ioc(data=data)
+        try:
+            if hook_name in ['on_postload_ioc_create', 'on_postload_ioc_update', 'on_manual_trigger_ioc']:
+                status = self._handle_ioc(data=data, skip_fresh=hook_name == 'on_postload_ioc_update',
+                                          hook_name=hook_name)
 
-        else:
-            self.log.critical(f'Received unsupported hook {hook_name}')
-            return InterfaceStatus.I2Error(data=data, logs=list(self.message_queue))
+            elif hook_name == 'on_manual_trigger_case':
+                status = self._handle_case(data=data)
+
+            else:
+                self.log.critical(f'Received unsupported hook {hook_name}')
+                return InterfaceStatus.IIStatus(code=InterfaceStatus.I2CodeError, message='Unspecified error',
+                                               data=data, logs=list(self.message_queue))
+
+        except PermissionError as e:
+            # Databases directory refused by ensure_private_directory
+            self.log.error(str(e))
+            status = InterfaceStatus.IIStatus(code=InterfaceStatus.I2CodeError, message=str(e))
 
         if status.is_failure():
             self.log.error(f"Encountered error processing hook {hook_name}")
-            return InterfaceStatus.I2Error(data=data, logs=list(self.message_queue))
+            return InterfaceStatus.IIStatus(code=InterfaceStatus.I2CodeError, message='Unspecified error', data=data,
+                                           logs=list(self.message_queue))
 
         self.log.info(f"Successfully processed hook {hook_name}")
-        return InterfaceStatus.I2Success(data=data, logs=list(self.message_queue))
+        return InterfaceStatus.IIStatus(code=InterfaceStatus.I2CodeSuccess, message='Success', data=data,
+                                       logs=list(self.message_queue))
 
-    def _handle_ioc(self, data) -> InterfaceStatus.IIStatus:
+    def _handle_ioc(self, data, skip_fresh=False, hook_name=None, hook_stats=None) -> InterfaceStatus.IIStatus:
         """
         Handle the IOC data the module just received. The module registered
         to on_postload hooks, so it receives instances of IOC object.
@@ -115,30 +169,333 @@ class IrisVTInterface(IrisModuleInterface):
         be modified safely.
 
         :param data: Data associated to the hook, here IOC object
+        :param skip_fresh: Skip the IOCs whose enrichment is still fresh, used on updates
+        :param hook_name: Name of the hook, used in metrics
+        :param hook_stats: Dict updated with the statistics of the enrichment, if set
         :return: IIStatus
         """
+        # The handler pulls the HTTP clients, Jinja and the IRIS database helpers, so it is only
+        # imported once a hook runs, not by every worker importing the module
+        from iris_vt_module.vt_handler.vt_handler import VtHandler
+
+        started = time.perf_counter()
 
-        vt_handler = VtHandler(mod_config=self.module_dict_conf,
-                               server_config=self.server_dict_conf,
-                               logger=self.log)
+        try:
+            vt_handler = VtHandler(mod_config=self.module_dict_conf,
+                                   server_config=self.server_dict_conf,
+                                   logger=self.log)
+        except ValueError as e:
+            # Configuration errors, such as a missing mirror directory
+            self.log.error(f'Invalid VT module configuration. {e}')
+            return InterfaceStatus.IIStatus(code=InterfaceStatus.I2CodeError, message=str(e), data=data)
 
         in_status = InterfaceStatus.IIStatus(code=InterfaceStatus.I2CodeNoError)
+        preflight = get_preflight(self.module_dict_conf)
 
+        to_enrich = []
+        skipped = {'unsupported': 0, 'fresh': 0, **{reason: 0 for reason in SKIP_REASONS}}
         for element in data:
             # Check that the IOC we receive is of type the module can handle and dispatch
-            if 'ip-' in element.ioc_type.type_name:
-                status = vt_handler.handle_vt_ip(ioc=element)
-                in_status = InterfaceStatus.merge_status(in_status, status)
+            ioc_kind = self._get_ioc_kind(element)
+            if ioc_kind is None:
+                self.log.error(f'IOC type {element.ioc_type.type_name} not handled by VT module. Skipping')
+                skipped['unsupported'] += 1
+                continue
 
-            elif 'domain' in element.ioc_type.type_name:
-                status = vt_handler.handle_vt_domain(ioc=element)
-                in_status = InterfaceStatus.merge_status(in_status, status)
+            # Indicators VT can't know are skipped before any lookup
+            skip = preflight.check(ioc_kind, element.ioc_value) if preflight else None
+            if skip is not None:
+                reason, message = skip
+                self.log.info(f'IOC {element.ioc_value} {message}. Skipping')
+                skipped[reason] += 1
+                continue
+
+            if skip_fresh and vt_handler.is_enrichment_fresh(element, ioc_kind):
+                self.log.info(f'IOC {element.ioc_value} unchanged and enriched recently. Skipping')
+                skipped['fresh'] += 1
+                continue
+
+            to_enrich.append((ioc_kind, element))
+
+        preflight_skipped = [f'{skipped[reason]} {reason}' for reason in SKIP_REASONS if skipped[reason]]
+        if preflight_skipped:
+            self.log.info(f'Pre-flight checks skipped {sum(skipped[reason] for reason in SKIP_REASONS)} IOCs '
+                          f'without lookup: {", ".join(preflight_skipped)}')
 
-            elif element.ioc_type.type_name in ['md5', 'sha1', 'sha224', 'sha256', 'sha512']:
-                status = vt_handler.handle_vt_hash(ioc=element)
+        deferred = 0
+        if hook_name in DEFERRABLE_HOOKS and self.module_dict_conf.get('vt_deferred_enabled'):
+            self._defer_iocs(vt_handler, to_enrich)
+            deferred = len(to_enrich)
+
+        else:
+            if self.module_dict_conf.get('vt_deferred_enabled'):
+                self._resume_deferred(vt_handler)
+
+            for status in self._enrich_iocs(vt_handler, to_enrich):
                 in_status = InterfaceStatus.merge_status(in_status, status)
 
+        self._report_hook_metrics(hook_name or 'unknown', vt_handler, time.perf_counter() - started,
+                                  received=len(data), skipped=skipped, deferred=deferred)
+        if hook_stats is not None:
+            hook_stats.update(vt_handler.hook_stats)
+
+        return in_status(data=data)
+
+    @staticmethod
+    def _enrich_iocs(vt_handler, to_enrich):
+        """
+        Looks up and enriches a list of IOCs
+
+        :param vt_handler: VtHandler
+        :param to_enrich: List of (IOC kind, IOC instance)
+        :return: List of the IIStatus of each IOC
+        """
+        # Reports are fetched upfront, concurrently and with hashes batched. IOCs are then
+        # updated one after the other on this thread, which owns the SQLAlchemy session
+        lookups = [(ioc_kind, normalize_ioc_value(ioc_kind, element.ioc_value)) for ioc_kind, element in to_enrich]
+        reports = vt_handler.get_reports(lookups)
+
+        # Reports are released as soon as the last IOC using them is enriched
+        remaining_uses = Counter(lookups)
+
+        statuses = []
+        for lookup, (ioc_kind, element) in zip(lookups, to_enrich):
+            remaining_uses[lookup] -= 1
+            report = reports.get(lookup) if remaining_uses[lookup] else reports.pop(lookup, None)
+
+            if ioc_kind == IOC_KIND_IP:
+                status = vt_handler.handle_vt_ip(ioc=element, report=report)
+
+            elif ioc_kind == IOC_KIND_DOMAIN:
+                status = vt_handler.handle_vt_domain(ioc=element, report=report)
+
             else:
-                self.log.error(f'IOC type {element.ioc_type.type_name} not handled by VT module. Skipping')
+                status = vt_handler.handle_vt_hash(ioc=element, report=report)
+
+            statuses.append(status)
+
+        return statuses
+
+    def _defer_iocs(self, vt_handler, to_enrich):
+        """
+        Queues IOCs for the background worker and wakes it up. The worker is configured with the
+        module configuration of this hook, and its lookups go through the same rate limiter
+
+        :param vt_handler: VtHandler
+        :param to_enrich: List of (IOC kind, IOC instance)
+        :return: Nothing
+        """
+        queue = get_deferred_queue(self.module_dict_conf)
+        for ioc_kind, element in to_enrich:
+            queue.enqueue(element.ioc_id, ioc_kind, element.ioc_value)
+
+        self._start_deferred_worker(vt_handler, queue)
+
+        depth = queue.get_depth()
+        self.log.info(f'{len(to_enrich)} IOCs queued for VT enrichment. Queue depth: {depth["pending"]} pending, '
+                      f'{depth["running"]} running, {depth["dead"]} dead-lettered')
+
+    def _resume_deferred(self, vt_handler):
+        """
+        Starts the background worker of this process if the queue still holds entries, e.g. queued before
+        a restart, so they don't wait for a new IOC to be deferred
+
+        :param vt_handler: VtHandler
+        :return: Nothing
+        """
+        queue = get_deferred_queue(self.module_dict_conf)
+        if get_deferred_worker(queue).is_running() or queue.get_next_due() is None:
+            return
+
+        self.log.info('Resuming the deferred enrichment of the IOCs left in the queue')
+        self._start_deferred_worker(vt_handler, queue)
+
+    def _start_deferred_worker(self, vt_handler, queue):
+        """
+        Configures the background worker with the module configuration of this hook and wakes it up.
+        Its lookups go through the same rate limiter as the hooks
+
+        :param vt_handler: VtHandler
+        :param queue: VtDeferredQueue
+        :return: Nothing
+        """
+        worker = get_deferred_worker(queue)
+        worker.configure(process=self._process_deferred,
+                         rate_limiter=vt_handler.vt.rate_limiter,
+                         breaker=vt_handler.vt.breaker,
+                         batch_size=int(self.module_dict_conf.get('vt_deferred_batch_size') or 20),
+                         retry_delay=int(self.module_dict_conf.get('vt_deferred_retry_delay') or 60),
+                         max_attempts=int(self.module_dict_conf.get('vt_deferred_max_attempts') or 5))
+        worker.wake_up()
+
+    def _process_deferred(self, entries):
+        """
+        Enriches a batch of queued IOCs, from the background worker. The IOCs are loaded in a fresh
+        application context and the changes committed at the end of the batch. IOCs deleted since
+        they were queued, or whose value changed and which were queued again, are dropped
+
+        :param entries: List of (IOC ID, IOC kind, IOC value, attempts) claimed from the queue
+        :return: Dict of errors by IOC ID, for the IOCs whose enrichment failed
+        """
+        from app import app, db
+        from iris_vt_module.vt_handler.vt_handler import VtHandler
+
+        started = time.perf_counter()
+        errors = {}
+
+        with app.app_context():
+            iocs = load_iocs([entry[0] for entry in entries])
+
+            vt_handler = VtHandler(mod_config=self.module_dict_conf,
+                                   server_config=self.server_dict_conf,
+                                   logger=deferred_log)
+
+            to_enrich = []
+            for ioc_id, _, ioc_value, _ in entries:
+                element = iocs.get(ioc_id)
+                if element is None or element.ioc_value != ioc_value:
+                    continue
+
+                ioc_kind = self._get_ioc_kind(element)
+                if ioc_kind is not None:
+                    to_enrich.append((ioc_kind, element))
+
+            for (_, element), status in zip(to_enrich, self._enrich_iocs(vt_handler, to_enrich)):
+                if status.is_failure():
+                    errors[element.ioc_id] = f'VT enrichment of {element.ioc_value} failed'
+
+            db.session.commit()
+
+        self._report_hook_metrics('deferred', vt_handler, time.perf_counter() - started,
+                                  received=len(entries),
+                                  skipped={'unsupported': 0, 'fresh': 0, **{reason: 0 for reason in SKIP_REASONS}})
+
+        return errors
+
+    def _report_hook_metrics(self, hook_name, vt_handler, duration, received, skipped, deferred=0):
+        """
+        Adds a processed hook to the worker metrics, logs its structured summary if enabled and
+        exports the metrics to the textfile collector directory if configured
+
+        :param hook_name: Name of the hook
+        :param vt_handler: VtHandler which processed the hook
+        :param duration: Processing time of the hook, in seconds
+        :param received: Number of IOCs received
+        :param skipped: Number of IOCs skipped, by reason
+        :param deferred: Number of IOCs queued for the background worker
+        :return: Nothing
+        """
+        metrics.inc('iris_vt_hooks_total', hook=hook_name)
+        metrics.inc('iris_vt_hook_seconds_total', duration, hook=hook_name)
+        for reason, count in skipped.items():
+            if count:
+                metrics.inc('iris_vt_skipped_total', count, hook=hook_name, reason=reason)
+
+        if self.module_dict_conf.get('vt_hook_log_enabled'):
+            stats = vt_handler.hook_stats
+            vt_handler.log.info(json.dumps({
+                'event': 'vt_hook',
+                'hook': hook_name,
+                'duration_ms': round(duration * 1000, 1),
+                'iocs': received,
+                'enriched': stats['success'],
+                'failed': stats['failure'],
+                'deferred': deferred,
+                'render_cache_hits': stats['render_cache_hits'],
+                'render_cache_misses': stats['render_cache_misses'],
+                'stages_ms': {stage: round(seconds * 1000, 1) for stage, seconds in stats['stages'].items()},
+                **{f'skipped_{reason}': count for reason, count in skipped.items()}
+            }, sort_keys=True))
+
+        textfile_dir = self.module_dict_conf.get('vt_metrics_textfile_dir')
+        if textfile_dir:
+            try:
+                metrics.write_textfile(textfile_dir)
+            except OSError as e:
+                self.log.warning(f'Unable to export metrics to {textfile_dir}. {e}')
+
+    def _handle_case(self, data) -> InterfaceStatus.IIStatus:
+        """
+        Enriches every supported IOC of the cases the module just received. IOCs are streamed
+        in chunks, each chunk going through the same processing as the IOC hooks. Each chunk is
+        committed and released before the progress is checkpointed, so a run interrupted midway
+        resumes where it stopped. IOCs which failed for good, e.g. unknown to VT, count as processed.
+        The checkpoint stops advancing at the first chunk with a transient failure, such as an exhausted
+        quota or an unreachable VT, and is kept, so the next run starts over from that chunk.
+
+        :param data: Data associated to the hook, here case objects
+        :return: IIStatus
+        """
+        chunk_size = int(self.module_dict_conf.get('vt_bulk_chunk_size') or 100)
+        checkpoints = get_bulk_checkpoints(self.module_dict_conf)
+
+        in_status = InterfaceStatus.IIStatus(code=InterfaceStatus.I2CodeNoError)
+
+        for case in data:
+            case_id = case.case_id
+            last_ioc_id, processed = checkpoints.get(case_id)
+            total = count_case_iocs(case_id)
+
+            if last_ioc_id:
+                self.log.info(f'Resuming VT enrichment of case {case_id} after IOC {last_ioc_id}. '
+                              f'{processed} IOCs already processed')
+            else:
+                self.log.info(f'Starting VT enrichment of case {case_id}. {total} IOCs to process')
+
+            failed = False
+            for chunk in iter_case_iocs(case_id, after_ioc_id=last_ioc_id, chunk_size=chunk_size):
+                chunk_last_ioc_id = chunk[-1].ioc_id
+                hook_stats = {}
+                status = self._handle_ioc(data=chunk, hook_stats=hook_stats)
+
+                try:
+                    commit_chunk(chunk)
+                except Exception:
+                    self.log.error(f'Unable to save the VT enrichment of case {case_id}. {traceback.format_exc()}')
+                    in_status.code = InterfaceStatus.I2CodeError
+                    failed = True
+                    break
+
+                # Only the status code is kept, the IOCs of each chunk are not returned to IRIS
+                if status.is_failure():
+                    in_status.code = status.code
+                    if hook_stats.get('transient_failure'):
+                        failed = True
+                    else:
+                        self.log.warning(f'{hook_stats.get("failure", 0)} IOCs of case {case_id} up to IOC '
+                                         f'{chunk_last_ioc_id} could not be enriched. They are not retried')
+
+                processed += len(chunk)
+                if not failed:
+                    checkpoints.set(case_id, last_ioc_id=chunk_last_ioc_id, processed=processed)
+                self.log.info(f'VT enrichment of case {case_id}: {processed}/{total} IOCs processed')
+
+            if failed:
+                self.log.warning(f'VT enrichment of case {case_id} completed with transient failures. Its '
+                                 f'checkpoint is kept, the next run resumes from the first failed chunk')
+                continue
+
+            checkpoints.clear(case_id)
+            self.log.info(f'VT enrichment of case {case_id} completed')
 
         return in_status(data=data)
+
+    @staticmethod
+    def _get_ioc_kind(element):
+        """
+        Returns the kind of lookup to issue for an IOC, based on its type
+
+        :param element: IOC instance
+        :return: IOC kind (ip, domain, hash) or None if the type is not handled
+        """
+        type_name = element.ioc_type.type_name
+        if 'ip-' in type_name:
+            return IOC_KIND_IP
+
+        elif 'domain' in type_name:
+            return IOC_KIND_DOMAIN
+
+        elif type_name in HASH_TYPES:
+            return IOC_KIND_HASH
+
+        return None
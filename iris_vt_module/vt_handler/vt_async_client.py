@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+#
+#  IRIS VT Module Source Code
+#  contact@dfir-iris.org
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+import asyncio
+import atexit
+import concurrent.futures
+import json
+import threading
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from iris_vt_module.vt_handler.vt_client import RETRYABLE_STATUSES, STREAM_CHUNK_SIZE, VT_API_URL, \
+    auth_failed_report, build_report, count_response_bytes, get_backoff_delay, get_client_key, get_client_settings, \
+    get_vt_client, quota_exhausted_report
+from iris_vt_module.vt_handler.vt_keypool import AUTH_FAILURE_STATUSES
+from iris_vt_module.vt_handler.vt_metrics import metrics
+from iris_vt_module.vt_handler.vt_stream import ReportProjection, parse_projected
+
+_async_clients = {}
+_async_clients_lock = threading.Lock()
+
+
+def is_async_engine_available():
+    """
+    Returns True if the asyncio engine can be used, i.e. aiohttp is installed
+
+    :return: Bool
+    """
+    return aiohttp is not None
+
+
+async def _read_chunk(chunks):
+    """
+    Reads the next chunk of a response body
+
+    :param chunks: Async iterator of bytes
+    :return: Bytes, or None at the end of the body
+    """
+    try:
+        return await chunks.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+class VtAsyncClient(object):
+    """
+    asyncio counterpart of VtClient. The client owns a private event loop running in a dedicated thread,
+    so any hook thread can submit coroutines to it, and keeps many requests in flight on a single
+    aiohttp session whose connector is bounded to the pool size.
+    """
+    def __init__(self, key_pool, breaker, proxies, pool_size, connect_timeout, read_timeout, max_wait,
+                 retry_attempts=0, retry_backoff=1.0, projection_max_items=0, projection_skip_undetected=False):
+        # The key pool tracks the quota of each key, so it acts as the rate limiter of the client
+        self.rate_limiter = key_pool
+        self.breaker = breaker
+        self.proxies = proxies
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_wait = max_wait
+        self.retry_attempts = retry_attempts
+        self.retry_backoff = retry_backoff
+        self.projection = ReportProjection(projection_max_items, projection_skip_undetected)
+        self.base_url = VT_API_URL
+
+        self._session = None
+        # Coroutines submitted by hook threads and not completed yet. The client is closed once they are
+        self._in_flight = 0
+        self._in_flight_changed = threading.Condition()
+        self._closed = False
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name='iris_vt_async', daemon=True)
+        self._thread.start()
+
+    @property
+    def file_report_batch_size(self):
+        """
+        Number of resources VT accepts in a single file report request, whatever the key used
+        """
+        return self.rate_limiter.file_report_batch_size
+
+    def run(self, coroutine, timeout=None):
+        """
+        Runs a coroutine on the private event loop and waits for its result. Must not be called
+        from the event loop thread itself
+
+        :param coroutine: Coroutine to run
+        :param timeout: Maximum number of seconds to wait for the result. None waits until it completes
+        :return: Result of the coroutine
+        :raise concurrent.futures.TimeoutError: The coroutine didn't complete in time, it is cancelled
+        :raise concurrent.futures.CancelledError: The client was closed, the coroutine didn't run
+        """
+        with self._in_flight_changed:
+            if self._closed:
+                coroutine.close()
+                raise concurrent.futures.CancelledError()
+            self._in_flight += 1
+
+        try:
+            future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+            try:
+                return future.result(timeout)
+            except concurrent.futures.TimeoutError:
+                future.cancel()
+                raise
+
+        finally:
+            with self._in_flight_changed:
+                self._in_flight -= 1
+                self._in_flight_changed.notify_all()
+
+    def _get_session(self):
+        """
+        Returns the aiohttp session, created on first use as it must be bound to the running loop
+
+        :return: aiohttp.ClientSession
+        """
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+            )
+
+        return self._session
+
+    def _iter_body(self, response):
+        """
+        Iterates the body of a response from a thread other than the loop thread. Each chunk is read on the
+        loop when the parser asks for it, so a single chunk is held at a time
+
+        :param response: aiohttp response
+        :return: Generator of bytes
+        """
+        chunks = response.content.iter_chunked(STREAM_CHUNK_SIZE).__aiter__()
+        while True:
+            future = asyncio.run_coroutine_threadsafe(_read_chunk(chunks), self.loop)
+            try:
+                chunk = future.result(timeout=self.read_timeout)
+            except concurrent.futures.TimeoutError:
+                future.cancel()
+                raise asyncio.TimeoutError()
+
+            if chunk is None:
+                return
+            yield chunk
+
+    async def _get(self, endpoint, params, projected=False, premium_params=None):
+        """
+        Issues a GET request on a VT endpoint. Requests failing for a transient reason are retried
+        with an exponential backoff
+
+        :param endpoint: Endpoint relative to the API base URL
+        :param params: Query parameters, without the API key
+        :param projected: Parse the response through the report projection, if one is configured
+        :param premium_params: Query parameters added when the request is sent with a premium key
+        :return: VT report dict
+        """
+        attempt = 0
+        while True:
+            report, retryable = await self._get_once(endpoint, dict(params), projected, premium_params)
+            # No retry once the breaker opened, the error of the last attempt is more telling
+            if not retryable or attempt >= self.retry_attempts or self.breaker.get_retry_after():
+                return report
+
+            attempt += 1
+            metrics.inc('iris_vt_retries_total')
+            await asyncio.sleep(get_backoff_delay(attempt, self.retry_backoff))
+
+    async def _get_once(self, endpoint, params, projected, premium_params):
+        """
+        Issues a single GET request on a VT endpoint
+
+        :param endpoint: Endpoint relative to the API base URL
+        :param params: Query parameters, without the API key
+        :param projected: Parse the response through the report projection, if one is configured
+        :param premium_params: Query parameters added when the request is sent with a premium key
+        :return: Tuple (VT report dict, True if the request can be retried)
+        """
+        if not self.breaker.allow_request():
+            return self.breaker.get_open_report(), False
+
+        key = await self.rate_limiter.acquire_async(self.max_wait)
+        if key is None:
+            if self.rate_limiter.is_refused():
+                return auth_failed_report(self.rate_limiter), False
+            return quota_exhausted_report(self.rate_limiter, self.max_wait), False
+
+        params['apikey'] = key.api_key
+        if key.is_premium and premium_params:
+            params.update(premium_params)
+        url = self.base_url + endpoint
+        proxy = self.proxies.get('https' if url.startswith('https') else 'http')
+
+        try:
+            async with self._get_session().get(url, params=params, proxy=proxy) as response:
+                status_code = response.status
+                if status_code != 200:
+                    results = None
+                elif projected and self.projection.is_active():
+                    # The parser runs in a thread and is fed each chunk as it arrives, like the threads engine.
+                    # Only the projected sections are decoded, and parsing never holds the loop
+                    chunks = count_response_bytes(self._iter_body(response))
+                    results = await self.loop.run_in_executor(None, parse_projected, chunks, self.projection)
+                else:
+                    body = await response.read()
+                    metrics.inc('iris_vt_response_bytes_total', len(body))
+                    results = json.loads(body)
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.breaker.record_failure()
+            return dict(error=str(e) or type(e).__name__), True
+
+        except ValueError as e:
+            self.breaker.record_success()
+            return dict(error=f'Invalid response from VT. {e}'), False
+
+        if status_code == 204:
+            metrics.inc('iris_vt_quota_exhausted_total', source='api')
+        elif status_code in AUTH_FAILURE_STATUSES:
+            metrics.inc('iris_vt_auth_failures_total', source='api')
+        self.rate_limiter.notify_response(key, status_code)
+
+        if status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+        return build_report(status_code, results), status_code in RETRYABLE_STATUSES
+
+    async def get_ip_report(self, this_ip):
+        """
+        Get IP address report
+
+        :param this_ip: IP address
+        :return: VT report dict
+        """
+        return await self._get('ip-address/report', {'ip': this_ip}, projected=True)
+
+    async def get_domain_report(self, this_domain):
+        """
+        Get domain report
+
+        :param this_domain: Domain name
+        :return: VT report dict
+        """
+        return await self._get('domain/report', {'domain': this_domain}, projected=True)
+
+    async def get_file_report(self, resource):
+        """
+        Get file report
+
+        :param resource: md5/sha1/sha256 of the file, or comma-separated list of up to
+                         file_report_batch_size hashes
+        :return: VT report dict. Results is a list when several hashes are requested
+        """
+        params = {'resource': resource}
+
+        return await self._get('file/report', params, premium_params={'allinfo': 1})
+
+    def close(self, timeout=None):
+        """
+        Waits for the coroutines in flight to complete, then closes the session and stops the private
+        event loop. Coroutines submitted afterwards are refused. No-op if the client is already closed
+
+        :param timeout: Maximum number of seconds to wait for the coroutines in flight. None waits until
+                        they complete
+        :return: Nothing
+        """
+        with self._in_flight_changed:
+            if self._closed:
+                return
+            self._in_flight_changed.wait_for(lambda: not self._in_flight, timeout)
+            self._closed = True
+
+        if self._session is not None:
+            asyncio.run_coroutine_threadsafe(self._session.close(), self.loop).result(self.read_timeout)
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def get_vt_async_client(mod_config, server_config):
+    """
+    Returns the asyncio VT client matching the module configuration, built and rebuilt
+    under the same rules as get_vt_client. Both clients share the same key pool and circuit breaker
+
+    :param mod_config: Module configuration
+    :param server_config: Server configuration
+    :return: VtAsyncClient
+    """
+    settings = get_client_settings(mod_config, server_config)
+    client_key = get_client_key(settings, mod_config)
+
+    with _async_clients_lock:
+        client = _async_clients.get(client_key)
+        if client is None:
+            # Configuration changed, stop the previous clients so their loops and pools are released. They
+            # are closed in the background once the lookups of the hooks still using them are over
+            for stale_client in _async_clients.values():
+                threading.Thread(target=stale_client.close, name='iris_vt_async_close', daemon=True).start()
+            _async_clients.clear()
+
+            settings.pop('api_keys')
+            vt_client = get_vt_client(mod_config, server_config)
+            client = VtAsyncClient(key_pool=vt_client.rate_limiter, breaker=vt_client.breaker, **settings)
+            _async_clients[client_key] = client
+
+    return client
+
+
+def close_vt_async_clients():
+    """
+    Closes the asyncio clients of the worker, so their sessions are closed before the interpreter exits.
+    Lookups still in flight get at most a read timeout to complete
+
+    :return: Nothing
+    """
+    with _async_clients_lock:
+        clients = list(_async_clients.values())
+        _async_clients.clear()
+
+    for client in clients:
+        client.close(timeout=client.read_timeout)
+
+
+atexit.register(close_vt_async_clients)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+#
+#  IRIS VT Module Source Code
+#  contact@dfir-iris.org
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+import logging
+import threading
+import time
+
+from iris_vt_module.vt_handler.vt_metrics import metrics
+
+log = logging.getLogger('iris_vt_module.vt_breaker')
+
+
+class VtCircuitBreaker(object):
+    """
+    Circuit breaker of the VT lookups. After threshold consecutive failed requests, the breaker opens and
+    lookups fail immediately for the cooldown. A single trial request is then let through, and the others
+    keep failing until its outcome is known: the breaker closes if it succeeds and opens for another cooldown
+    if it fails. A threshold of 0 disables the breaker
+    """
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._open_until = 0
+
+    def allow_request(self):
+        """
+        Checks if a request can be issued. Once the cooldown is over, only the trial request is allowed
+        until its outcome is known
+
+        :return: True if the request can be issued
+        """
+        if not self.threshold:
+            return True
+
+        with self._lock:
+            if self._failures < self.threshold:
+                return True
+
+            now = time.monotonic()
+            if now < self._open_until:
+                metrics.inc('iris_vt_breaker_rejections_total')
+                return False
+
+            # Trial request. If its outcome is never recorded, another one is allowed after a cooldown
+            self._open_until = now + self.cooldown
+            return True
+
+    def record_success(self):
+        """
+        Records a request VT answered, closing the breaker
+
+        :return: Nothing
+        """
+        with self._lock:
+            if self._failures >= self.threshold and self.threshold:
+                log.info('VT reachable again, circuit breaker closed')
+
+            self._failures = 0
+
+    def record_failure(self):
+        """
+        Records a request which failed for a network error, a timeout or a server error, opening
+        the breaker once the threshold is reached
+
+        :return: Nothing
+        """
+        if not self.threshold:
+            return
+
+        with self._lock:
+            self._failures += 1
+
+            if self._failures >= self.threshold:
+                self._open_until = time.monotonic() + self.cooldown
+                log.warning(f'{self._failures} consecutive VT lookups failed, circuit breaker open '
+                            f'for {self.cooldown} seconds')
+
+    def get_retry_after(self):
+        """
+        Returns the remaining time the breaker stays open
+
+        :return: Seconds, 0 if requests are allowed
+        """
+        with self._lock:
+            if not self.threshold or self._failures < self.threshold:
+                return 0
+
+            return max(self._open_until - time.monotonic(), 0)
+
+    def get_open_report(self):
+        """
+        Builds the report returned when a lookup is rejected by the open breaker
+
+        :return: Dict with error
+        """
+        return dict(error=f'VT lookups suspended after {self._failures} consecutive failures, '
+                          f'retrying in {self.get_retry_after():.0f} seconds')
+
+
+def build_circuit_breaker(mod_config):
+    """
+    Builds the circuit breaker of the module configuration
+
+    :param mod_config: Module configuration
+    :return: VtCircuitBreaker
+    """
+    return VtCircuitBreaker(threshold=int(mod_config.get('vt_breaker_threshold') or 0),
+                            cooldown=float(mod_config.get('vt_breaker_cooldown') or 0))
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+#
+#  IRIS VT Module Source Code
+#  contact@dfir-iris.org
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+import os
+import sqlite3
+import threading
+import time
+
+from iris_vt_module.vt_handler.vt_cache import DEFAULT_CACHE_PATH, HASH_TYPES, ensure_private_directory
+
+_checkpoints = {}
+_checkpoints_lock = threading.Lock()
+
+
+class VtBulkCheckpoints(object):
+    """
+    Progress of the case-wide enrichments, stored in a SQLite database so an interrupted
+    enrichment resumes after the last IOC it completed
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+
+        ensure_private_directory(os.path.dirname(db_path) or '.')
+
+        self._conn = sqlite3.connect(db_path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS vt_bulk_checkpoints ('
+                           'case_id INTEGER PRIMARY KEY, '
+                           'last_ioc_id INTEGER NOT NULL, '
+                           'processed INTEGER NOT NULL, '
+                           'updated_at REAL NOT NULL)')
+
+    def get(self, case_id):
+        """
+        Returns the checkpoint of a case
+
+        :param case_id: ID of the case
+        :return: Tuple (last completed IOC ID, number of IOCs processed), or (0, 0) if none
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT last_ioc_id, processed FROM vt_bulk_checkpoints WHERE case_id = ?',
+                                     (case_id,)).fetchone()
+
+        return tuple(row) if row else (0, 0)
+
+    def set(self, case_id, last_ioc_id, processed):
+        """
+        Records the progress of a case enrichment
+
+        :param case_id: ID of the case
+        :param last_ioc_id: ID of the last IOC completed
+        :param processed: Number of IOCs processed so far
+        :return: Nothing
+        """
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO vt_bulk_checkpoints (case_id, last_ioc_id, processed, '
+                               'updated_at) VALUES (?, ?, ?, ?)', (case_id, last_ioc_id, processed, time.time()))
+
+    def clear(self, case_id):
+        """
+        Drops the checkpoint of a case once its enrichment is complete
+
+        :param case_id: ID of the case
+        :return: Nothing
+        """
+        with self._lock:
+            self._conn.execute('DELETE FROM vt_bulk_checkpoints WHERE case_id = ?', (case_id,))
+
+
+def get_bulk_checkpoints(mod_config):
+    """
+    Returns the checkpoints store, located next to the report cache
+
+    :param mod_config: Module configuration
+    :return: VtBulkCheckpoints
+    """
+    db_path = os.path.join(os.path.dirname(mod_config.get('vt_cache_path') or DEFAULT_CACHE_PATH), 'vt_bulk.db')
+
+    with _checkpoints_lock:
+        checkpoints = _checkpoints.get(db_path)
+        if checkpoints is None:
+            checkpoints = VtBulkCheckpoints(db_path)
+            _checkpoints[db_path] = checkpoints
+
+    return checkpoints
+
+
+def _case_iocs_query(case_id):
+    """
+    Returns the query of the IOCs of a case the module can enrich, ordered by ID
+
+    :param case_id: ID of the case
+    :return: SQLAlchemy query
+    """
+    from sqlalchemy import or_
+    from app.models import Ioc, IocLink, IocType
+
+    return Ioc.query.join(IocLink, IocLink.ioc_id == Ioc.ioc_id).join(
+        IocType, IocType.type_id == Ioc.ioc_type_id
+    ).filter(
+        IocLink.case_id == case_id,
+        or_(IocType.type_name.like('%ip-%'), IocType.type_name.like('%domain%'), IocType.type_name.in_(HASH_TYPES))
+    ).order_by(Ioc.ioc_id)
+
+
+def count_case_iocs(case_id):
+    """
+    Returns the number of IOCs of a case the module can enrich
+
+    :param case_id: ID of the case
+    :return: Number of IOCs
+    """
+    return _case_iocs_query(case_id).count()
+
+
+def commit_chunk(chunk):
+    """
+    Commits the enrichment of a chunk of IOCs and detaches them from the session, so a case-wide
+    enrichment only holds one chunk in memory. The session is rolled back if the commit fails
+
+    :param chunk: List of IOCs
+    :return: Nothing
+    """
+    from app import db
+
+    try:
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    for ioc in chunk:
+        db.session.expunge(ioc)
+
+
+def iter_case_iocs(case_id, after_ioc_id, chunk_size):
+    """
+    Streams the IOCs of a case in chunks, using keyset pagination on the IOC ID so only one chunk
+    is loaded at a time
+
+    :param case_id: ID of the case
+    :param after_ioc_id: Only IOCs with a greater ID are returned
+    :param chunk_size: Number of IOCs per chunk
+    :return: Generator of lists of IOCs
+    """
+    from app.models import Ioc
+
+    while True:
+        chunk = _case_iocs_query(case_id).filter(Ioc.ioc_id > after_ioc_id).limit(chunk_size).all()
+        if not chunk:
+            return
+
+        # Read before the chunk is handed over, as it is expunged once committed
+        after_ioc_id = chunk[-1].ioc_id
+        yield chunk
@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+#
+#  IRIS VT Module Source Code
+#  contact@dfir-iris.org
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+import hashlib
+import ipaddress
+import json
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlsplit
+
+# IOC kinds handled by the module. Reports are cached per kind, each kind having its own TTL
+IOC_KIND_IP = 'ip'
+IOC_KIND_DOMAIN = 'domain'
+IOC_KIND_HASH = 'hash'
+
+HASH_TYPES = ['md5', 'sha1', 'sha224', 'sha256', 'sha512']
+
+# Defanging conventions found in shared indicators, and their refanged form
+DEFANG_REPLACEMENTS = (('[.]', '.'), ('(.)', '.'), ('{.}', '.'), ('[dot]', '.'), ('(dot)', '.'), ('[:]', ':'),
+                       ('[://]', '://'), ('hxxp', 'http'))
+
+# Hash fields of a file report, all describing the same sample
+REPORT_HASH_FIELDS = ('md5', 'sha1', 'sha256')
+
+# Sections of IP and domain reports listing samples, whose hashes are recorded for pre-warming
+SAMPLE_SECTIONS = ('detected_downloaded_samples', 'detected_communicating_samples')
+
+ALIAS_SOURCE_REPORT = 'report'
+ALIAS_SOURCE_SAMPLE = 'sample'
+
+# Number of reports stored between two evictions. Counting the reports takes a scan of the table, so the
+# cache may exceed max_entries by this many reports per worker until the next eviction
+EVICTION_INTERVAL = 100
+
+# The databases are kept in the cache directory of the user running IRIS rather than in the shared temporary
+# directory, where any local user could create the directory first
+DEFAULT_CACHE_PATH = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+                                  'iris_vt_module', 'vt_cache.db')
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def normalize_ioc_value(ioc_kind, value):
+    """
+    Returns the normalized form of an IOC value, so the same indicator always maps to the same cache key.
+    Defanged values are refanged, composite values of types such as ip-dst|port or domain|ip are reduced
+    to their first part, and domains given as URLs to their host
+
+    :param ioc_kind: Kind of the IOC (ip, domain, hash)
+    :param value: Raw IOC value
+    :return: Normalized value
+    """
+    value = refang_ioc_value(value.strip().lower())
+    if ioc_kind != IOC_KIND_HASH and '|' in value:
+        value = value.split('|', 1)[0].strip()
+
+    if ioc_kind == IOC_KIND_IP:
+        try:
+            return ipaddress.ip_address(value).compressed
+        except ValueError:
+            return value
+
+    if ioc_kind == IOC_KIND_DOMAIN:
+        if '/' in value:
+            value = (urlsplit(value).hostname or '') if '://' in value else value.split('/', 1)[0]
+
+        return value.rstrip('.')
+
+    return value
+
+
+def refang_ioc_value(value):
+    """
+    Undoes the defanging of an IOC value, e.g. hxxp://evil[.]com
+
+    :param value: Lowercase IOC value
+    :return: Refanged value
+    """
+    if '[' not in value and '(' not in value and '{' not in value and 'hxxp' not in value:
+        return value
+
+    for defanged, refanged in DEFANG_REPLACEMENTS:
+        value = value.replace(defanged, refanged)
+
+    return value
+
+
+def get_report_hashes(results):
+    """
+    Returns the hashes a file report describes
+
+    :param results: Results of a VT file report
+    :return: List of normalized hashes
+    """
+    return [results[field].lower() for field in REPORT_HASH_FIELDS if isinstance(results.get(field), str)]
+
+
+def get_sample_hashes(results):
+    """
+    Returns the hashes of the samples listed in an IP or domain report
+
+    :param results: Results of a VT IP or domain report
+    :return: List of normalized sha256
+    """
+    hashes = []
+    for section in SAMPLE_SECTIONS:
+        for sample in results.get(section) or []:
+            if isinstance(sample, dict) and isinstance(sample.get('sha256'), str):
+                hashes.append(sample['sha256'].lower())
+
+    return hashes
+
+
+def ensure_private_directory(directory):
+    """
+    Creates a directory of the module databases if needed, and checks that only the user running IRIS can
+    write to it. Reports are rendered from the stored data without escaping, so a directory writable by
+    other users would let them inject HTML in the reports
+
+    :param directory: Path of the directory
+    :return: Nothing
+    :raise PermissionError: The directory belongs to another user or is writable by other users
+    """
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    stat = os.stat(directory)
+    if stat.st_uid != os.getuid() or stat.st_mode & 0o022:
+        raise PermissionError(f'{directory} must be owned by the user running IRIS and not be writable by '
+                              f'other users')
+
+
+def get_text_digest(report_text):
+    """
+    Returns the digest of the stored text of a report, identifying its content without serializing it again
+
+    :param report_text: JSON text of a report, as stored in the cache
+    :return: Hex digest
+    """
+    return hashlib.sha256(report_text.encode('utf-8')).hexdigest()
+
+
+class VtReportCache(object):
+    """
+    Persistent cache of VT reports, stored in a SQLite database and keyed by (IOC kind, normalized value).
+    The database is shared by all the IRIS workers of the host, so the same indicator is fetched once
+    per TTL whatever the case it appears in.
+
+    File reports are stored once per sample, under its sha256, and an alias index maps each of its
+    md5, sha1 and sha256 to it, so a sample is looked up once whatever the hash IOCs describing it. The
+    index also records the samples seen in IP and domain reports, candidates to be pre-warmed.
+    """
+    def __init__(self, db_path, ttls, max_entries):
+        """
+        :param db_path: Path of the SQLite database. Created if it doesn't exist
+        :param ttls: Dict of TTLs in seconds, indexed by IOC kind
+        :param max_entries: Maximum number of reports kept. Least recently used reports are evicted first.
+                            0 or None keeps every report
+        """
+        self.db_path = db_path
+        self.ttls = ttls
+        self.max_entries = max_entries or 0
+        self._lock = threading.Lock()
+        # Reports stored since the last eviction
+        self._stored_since_eviction = 0
+
+        ensure_private_directory(os.path.dirname(db_path) or '.')
+
+        self._conn = sqlite3.connect(db_path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS vt_reports ('
+                           'ioc_kind TEXT NOT NULL, '
+                           'ioc_value TEXT NOT NULL, '
+                           'report TEXT NOT NULL, '
+                           'fetched_at REAL NOT NULL, '
+                           'accessed_at REAL NOT NULL, '
+                           'PRIMARY KEY (ioc_kind, ioc_value))')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS vt_reports_accessed ON vt_reports (accessed_at)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS vt_hash_aliases ('
+                           'alias TEXT PRIMARY KEY, '
+                           'canonical TEXT NOT NULL, '
+                           'source TEXT NOT NULL, '
+                           'added_at REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS vt_hash_aliases_canonical ON vt_hash_aliases (canonical)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS vt_hash_aliases_source ON vt_hash_aliases (source, added_at)')
+
+    def get(self, ioc_kind, value):
+        """
+        Returns the cached report of an IOC if present and still fresh
+
+        :param ioc_kind: Kind of the IOC (ip, domain, hash)
+        :param value: IOC value
+        :return: Report as returned by the VT API, or None
+        """
+        return self.get_with_digest(ioc_kind, value)[0]
+
+    def get_with_digest(self, ioc_kind, value):
+        """
+        Returns the cached report of an IOC if present and still fresh, along with the digest of its stored text
+
+        :param ioc_kind: Kind of the IOC (ip, domain, hash)
+        :param value: IOC value
+        :return: Tuple (report, digest), (None, None) if not cached
+        """
+        key = normalize_ioc_value(ioc_kind, value)
+        now = time.time()
+
+        with self._lock:
+            if ioc_kind == IOC_KIND_HASH:
+                key = self._resolve_alias(key)
+
+            row = self._conn.execute('SELECT report, fetched_at FROM vt_reports WHERE ioc_kind = ? AND ioc_value = ?',
+                                     (ioc_kind, key)).fetchone()
+            if row is None:
+                return None, None
+
+            if now - row[1] > self.ttls.get(ioc_kind, 0):
+                self._conn.execute('DELETE FROM vt_reports WHERE ioc_kind = ? AND ioc_value = ?', (ioc_kind, key))
+                return None, None
+
+            self._conn.execute('UPDATE vt_reports SET accessed_at = ? WHERE ioc_kind = ? AND ioc_value = ?',
+                               (now, ioc_kind, key))
+
+        return json.loads(row[0]), get_text_digest(row[0])
+
+    def set(self, ioc_kind, value, report):
+        """
+        Stores the report of an IOC and evicts the least recently used reports if the cache is full
+
+        :param ioc_kind: Kind of the IOC (ip, domain, hash)
+        :param value: IOC value
+        :param report: Report as returned by the VT API
+        :return: Digest of the stored text of the report
+        """
+        key = normalize_ioc_value(ioc_kind, value)
+        now = time.time()
+        report_text = json.dumps(report)
+
+        aliases = []
+        if ioc_kind == IOC_KIND_HASH:
+            aliases = [key] + get_report_hashes(report.get('results') or {})
+            key = aliases[-1] if len(aliases) > 1 else key
+
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                self._conn.execute('INSERT OR REPLACE INTO vt_reports (ioc_kind, ioc_value, report, fetched_at, '
+                                   'accessed_at) VALUES (?, ?, ?, ?, ?)',
+                                   (ioc_kind, key, report_text, now, now))
+                self._conn.executemany('INSERT OR REPLACE INTO vt_hash_aliases (alias, canonical, source, added_at) '
+                                       'VALUES (?, ?, ?, ?)',
+                                       [(alias, key, ALIAS_SOURCE_REPORT, now) for alias in set(aliases)])
+                self._evict()
+                self._conn.execute('COMMIT')
+
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+
+        return get_text_digest(report_text)
+
+    def _resolve_alias(self, key):
+        """
+        Returns the hash a file report is stored under. Caller must hold the lock
+
+        :param key: Normalized hash
+        :return: Canonical hash, the hash itself if it has no alias
+        """
+        row = self._conn.execute('SELECT canonical FROM vt_hash_aliases WHERE alias = ? AND source = ?',
+                                 (key, ALIAS_SOURCE_REPORT)).fetchone()
+        return row[0] if row else key
+
+    def add_sample_hashes(self, hashes):
+        """
+        Records hashes of samples seen in IP and domain reports, as candidates for pre-warming. Hashes
+        already known are ignored, and only the max_entries most recent candidates are kept
+
+        :param hashes: List of normalized sha256
+        :return: Nothing
+        """
+        if not hashes:
+            return
+
+        now = time.time()
+        with self._lock:
+            self._conn.executemany('INSERT OR IGNORE INTO vt_hash_aliases (alias, canonical, source, added_at) '
+                                   'VALUES (?, ?, ?, ?)',
+                                   [(sample_hash, sample_hash, ALIAS_SOURCE_SAMPLE, now) for sample_hash in hashes])
+            if not self.max_entries:
+                return
+
+            self._conn.execute('DELETE FROM vt_hash_aliases WHERE source = ? AND alias NOT IN ('
+                               'SELECT alias FROM vt_hash_aliases WHERE source = ? ORDER BY added_at DESC LIMIT ?)',
+                               (ALIAS_SOURCE_SAMPLE, ALIAS_SOURCE_SAMPLE, self.max_entries))
+
+    def get_sample_hashes(self, limit, exclude=()):
+        """
+        Returns the most recently seen sample hashes whose report is not cached yet
+
+        :param limit: Maximum number of hashes
+        :param exclude: Hashes not to return
+        :return: List of normalized sha256
+        """
+        if limit <= 0:
+            return []
+
+        with self._lock:
+            rows = self._conn.execute('SELECT alias FROM vt_hash_aliases WHERE source = ? ORDER BY added_at DESC '
+                                      'LIMIT ?', (ALIAS_SOURCE_SAMPLE, limit + len(exclude))).fetchall()
+
+        return [row[0] for row in rows if row[0] not in exclude][:limit]
+
+    def discard_sample_hashes(self, hashes):
+        """
+        Drops sample hashes VT doesn't know, so they are not requested again
+
+        :param hashes: List of normalized sha256
+        :return: Nothing
+        """
+        with self._lock:
+            self._conn.executemany('DELETE FROM vt_hash_aliases WHERE alias = ? AND source = ?',
+                                   [(sample_hash, ALIAS_SOURCE_SAMPLE) for sample_hash in hashes])
+
+    def _evict(self):
+        """
+        Drops the least recently used reports above max_entries, once every EVICTION_INTERVAL reports stored.
+        Caller must hold the lock
+
+        :return: Nothing
+        """
+        if not self.max_entries:
+            return
+
+        self._stored_since_eviction += 1
+        if self._stored_since_eviction < EVICTION_INTERVAL:
+            return
+        self._stored_since_eviction = 0
+
+        count = self._conn.execute('SELECT COUNT(*) FROM vt_reports').fetchone()[0]
+        if count <= self.max_entries:
+            return
+
+        evicted = self._conn.execute('SELECT rowid, ioc_kind, ioc_value FROM vt_reports ORDER BY accessed_at ASC '
+                                     'LIMIT ?', (count - self.max_entries,)).fetchall()
+        self._conn.executemany('DELETE FROM vt_reports WHERE rowid = ?', [(row[0],) for row in evicted])
+        self._conn.executemany('DELETE FROM vt_hash_aliases WHERE canonical = ? AND source = ?',
+                               [(row[2], ALIAS_SOURCE_REPORT) for row in evicted if row[1] == IOC_KIND_HASH])
+
+
+def get_report_cache(mod_config):
+    """
+    Returns the report cache matching the module configuration, or None if the cache is disabled.
+    Caches are kept for the lifetime of the worker and reopened only when the configuration changes.
+
+    :param mod_config: Module configuration
+    :return: VtReportCache or None
+    """
+    if not mod_config.get('vt_cache_enabled'):
+        return None
+
+    db_path = mod_config.get('vt_cache_path') or DEFAULT_CACHE_PATH
+    ttls = {
+        IOC_KIND_HASH: int(mod_config.get('vt_cache_hash_ttl') or 0) * 3600,
+        IOC_KIND_IP: int(mod_config.get('vt_cache_ip_ttl') or 0) * 3600,
+        IOC_KIND_DOMAIN: int(mod_config.get('vt_cache_domain_ttl') or 0) * 3600
+    }
+    max_entries = int(mod_config.get('vt_cache_max_entries') or 0)
+
+    cache_key = (db_path, tuple(sorted(ttls.items())), max_entries)
+    with _caches_lock:
+        cache = _caches.get(cache_key)
+        if cache is None:
+            cache = VtReportCache(db_path=db_path, ttls=ttls, max_entries=max_entries)
+            _caches[cache_key] = cache
+
+    return cache
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+#
+#  IRIS VT Module Source Code
+#  contact@dfir-iris.org
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+from app.datamgmt.manage.manage_attribute_db import add_tab_attribute_field
+
+
+def parse_tags(ioc_tags):
+    """
+    Splits the tags of an IOC, dropping the empty ones
+
+    :param ioc_tags: Comma-separated tags, or None
+    :return: List of tags, in their original order
+    """
+    if not ioc_tags:
+        return []
+
+    return [tag for tag in ioc_tags.split(',') if tag]
+
+
+class IocChangeSet(object):
+    """
+    Collects the target state of the fields the enrichment writes on an IOC, i.e. tags, description
+    and custom attributes, and applies only the ones that differ from the current IOC. An enrichment
+    with an unchanged verdict leaves the IOC untouched, so no UPDATE is issued for it.
+    """
+    def __init__(self, ioc):
+        self.ioc = ioc
+        self.tags = parse_tags(ioc.ioc_tags)
+        self.description = ioc.ioc_description or ''
+        self.attributes = {}
+
+    def has_tag(self, tag):
+        return tag in self.tags
+
+    def add_tag(self, tag):
+        """
+        Adds a tag, if not already present
+
+        :param tag: Tag to add
+        :return: Nothing
+        """
+        if tag not in self.tags:
+            self.tags.append(tag)
+
+    def remove_tag(self, tag):
+        """
+        Removes a tag, if present
+
+        :param tag: Tag to remove
+        :return: Nothing
+        """
+        self.tags = [current_tag for current_tag in self.tags if current_tag != tag]
+
+    def append_description(self, text):
+        """
+        Appends text to the description
+
+        :param text: Text to append
+        :return: Nothing
+        """
+        self.description = f"{self.description}{text}"
+
+    def get_attribute(self, tab_name, field_name):
+        """
+        Returns the current value of a custom attribute of the IOC
+
+        :param tab_name: Attribute tab
+        :param field_name: Attribute field
+        :return: Value or None
+        """
+        field = ((self.ioc.custom_attributes or {}).get(tab_name) or {}).get(field_name)
+        if not isinstance(field, dict):
+            return None
+
+        return field.get('value')
+
+    def set_attribute(self, tab_name, field_name, field_type, field_value):
+        """
+        Sets the target value of a custom attribute of the IOC
+
+        :param tab_name: Attribute tab
+        :param field_name: Attribute field
+        :param field_type: Attribute type
+        :param field_value: Attribute value
+        :return: Nothing
+        """
+        self.attributes[(tab_name, field_name)] = (field_type, field_value)
+
+    def get_changes(self):
+        """
+        Diffs the target state against the current IOC
+
+        :return: Dict of the changed fields. Tags and description map to their new value, attributes
+                 are listed under 'attributes' as (tab, field, type, value)
+        """
+        changes = {}
+        if self.tags != parse_tags(self.ioc.ioc_tags):
+            changes['tags'] = ','.join(self.tags)
+
+        if self.description != (self.ioc.ioc_description or ''):
+            changes['description'] = self.description
+
+        attributes = [(tab_name, field_name, field_type, field_value)
+                      for (tab_name, field_name), (field_type, field_value) in self.attributes.items()
+                      if self.get_attribute(tab_name, field_name) != field_value]
+        if attributes:
+            changes['attributes'] = attributes
+
+        return changes
+
+    def apply(self):
+        """
+        Applies the changed fields to the IOC. Untouched fields are not assigned at all, and each
+        changed attribute is written once
+
+        :return: Dict of the applied changes, empty if the IOC is unchanged
+        """
+        changes = self.get_changes()
+
+        if 'tags' in changes:
+            self.ioc.ioc_tags = changes['tags']
+
+        if 'description' in changes:
+            self.ioc.ioc_description = changes['description']
+
+        for tab_name, field_name, field_type, field_value in changes.get('attributes', []):
+            add_tab_attribute_field(self.ioc, tab_name=tab_name, field_name=field_name, field_type=field_type,
+                                    field_value=field_value)
+
+        return changes
@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+#
+#  IRIS VT Module Source Code
+#  contact@dfir-iris.org
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from iris_vt_module.vt_handler.vt_breaker import build_circuit_breaker
+from iris_vt_module.vt_handler.vt_keypool import AUTH_FAILURE_STATUSES, build_key_pool, get_api_keys
+from iris_vt_module.vt_handler.vt_lookup_backend import VtLookupBackend
+from iris_vt_module.vt_handler.vt_metrics import metrics
+from iris_vt_module.vt_handler.vt_stream import ReportProjection, parse_projected
+
+VT_API_URL = 'https://www.virustotal.com/vtapi/v2/'
+STREAM_CHUNK_SIZE = 65536
+
+# Statuses of transient failures, retried with a backoff. 204 is VT quota exceeded
+RETRYABLE_STATUSES = (204, 429, 500, 502, 503, 504)
+# Maximum delay between two attempts, in seconds
+RETRY_MAX_DELAY = 30
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def build_report(status_code, results):
+    """
+    Builds a VT report dict from the status and body of a VT response, in the format of
+    the virustotal-api package
+
+    :param status_code: HTTP status of the response
+    :param results: Decoded JSON body of the response if the request succeeded
+    :return: Dict with results and/or error and response_code
+    """
+    if status_code == 200:
+        return dict(results=results, response_code=status_code)
+
+    elif status_code == 400:
+        return dict(error='package sent is either malformed or not within the past 24 hours.',
+                    response_code=status_code)
+
+    elif status_code == 204:
+        return dict(error='You exceeded the public API request rate limit (4 requests of any nature per minute)',
+                    response_code=status_code)
+
+    elif status_code == 401:
+        return dict(error='VT API key refused (authentication failure).', response_code=status_code)
+
+    elif status_code == 403:
+        return dict(error='You tried to perform calls to functions for which you require a Private API key.',
+                    response_code=status_code)
+
+    elif status_code == 404:
+        return dict(error='File not found.', response_code=status_code)
+
+    return dict(response_code=status_code)
+
+
+def quota_exhausted_report(rate_limiter, max_wait):
+    """
+    Builds the report returned when the rate limiter gives no request slot before the deadline
+
+    :param rate_limiter: Rate limiter of the client
+    :param max_wait: Deadline in seconds
+    :return: Dict with error and response_code
+    """
+    metrics.inc('iris_vt_quota_exhausted_total', source='limiter')
+    return dict(error=f'VT quota exhausted, no request slot available within {max_wait} seconds. '
+                      f'Remaining quota: {rate_limiter.get_remaining()}',
+                response_code=204)
+
+
+def auth_failed_report(key_pool):
+    """
+    Builds the report returned when VT refused every key of the pool and none can be used yet
+
+    :param key_pool: Key pool of the client
+    :return: Dict with error and response_code
+    """
+    metrics.inc('iris_vt_auth_failures_total', source='pool')
+    return dict(error=f'VT API key refused (authentication failure). No key usable for another '
+                      f'{key_pool.get_wait_time():.0f} seconds, check the API keys of the module configuration',
+                response_code=401)
+
+
+def get_backoff_delay(attempt, backoff):
+    """
+    Returns the delay before retrying a request. The delay doubles at each attempt, and half of it
+    is randomized so that workers failing together don't retry together
+
+    :param attempt: Number of the retry, starting at 1
+    :param backoff: Delay before the first retry, in seconds
+    :return: Delay in seconds
+    """
+    delay = min(backoff * 2 ** (attempt - 1), RETRY_MAX_DELAY)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def count_response_bytes(chunks):
+    """
+    Counts the bytes of a streamed response as they are read
+
+    :param chunks: Iterable of bytes
+    :return: Generator of the same chunks
+    """
+    for chunk in chunks:
+        metrics.inc('iris_vt_response_bytes_total', len(chunk))
+        yield chunk
+
+
+class VtClient(VtLookupBackend):
+    """
+    Minimal VT v2 API client built on a long-lived requests session, so connections to VT are
+    kept alive and reused across IOCs and hooks instead of paying a TLS handshake on every lookup.
+    Requests are spread over the keys of the key pool. Responses are returned in the same format as
+    the virustotal-api package.
+    """
+    def __init__(self, key_pool, breaker, proxies, pool_size, connect_timeout, read_timeout, max_wait,
+                 retry_attempts=0, retry_backoff=1.0, projection_max_items=0, projection_skip_undetected=False):
+        # The key pool tracks the quota of each key, so it acts as the rate limiter of the client
+        self.rate_limiter = key_pool
+        self.breaker = breaker
+        self.proxies = proxies
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_wait = max_wait
+        self.retry_attempts = retry_attempts
+        self.retry_backoff = retry_backoff
+        self.projection = ReportProjection(projection_max_items, projection_skip_undetected)
+        self.base_url = VT_API_URL
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    @property
+    def file_report_batch_size(self):
+        """
+        Number of resources VT accepts in a single file report request, whatever the key used
+        """
+        return self.rate_limiter.file_report_batch_size
+
+    def _get(self, endpoint, params, projected=False, premium_params=None):
+        """
+        Issues a GET request on a VT endpoint through the pooled session. Requests failing for a
+        transient reason are retried with an exponential backoff
+
+        :param endpoint: Endpoint relative to the API base URL
+        :param params: Query parameters, without the API key
+        :param projected: Stream the response through the report projection, if one is configured
+        :param premium_params: Query parameters added when the request is sent with a premium key
+        :return: VT report dict
+        """
+        attempt = 0
+        while True:
+            report, retryable = self._get_once(endpoint, dict(params), projected, premium_params)
+            # No retry once the breaker opened, the error of the last attempt is more telling
+            if not retryable or attempt >= self.retry_attempts or self.breaker.get_retry_after():
+                return report
+
+            attempt += 1
+            metrics.inc('iris_vt_retries_total')
+            time.sleep(get_backoff_delay(attempt, self.retry_backoff))
+
+    def _get_once(self, endpoint, params, projected, premium_params):
+        """
+        Issues a single GET request on a VT endpoint
+
+        :param endpoint: Endpoint relative to the API base URL
+        :param params: Query parameters, without the API key
+        :param projected: Stream the response through the report projection, if one is configured
+        :param premium_params: Query parameters added when the request is sent with a premium key
+        :return: Tuple (VT report dict, True if the request can be retried)
+        """
+        if not self.breaker.allow_request():
+            return self.breaker.get_open_report(), False
+
+        key = self.rate_limiter.acquire(self.max_wait)
+        if key is None:
+            if self.rate_limiter.is_refused():
+                return auth_failed_report(self.rate_limiter), False
+            return quota_exhausted_report(self.rate_limiter, self.max_wait), False
+
+        params['apikey'] = key.api_key
+        if key.is_premium and premium_params:
+            params.update(premium_params)
+        stream = projected and self.projection.is_active()
+
+        try:
+            response = self.session.get(self.base_url + endpoint, params=params, proxies=self.proxies,
+                                        timeout=self.timeout, stream=stream)
+        except requests.RequestException as e:
+            self.breaker.record_failure()
+            return dict(error=str(e)), True
+
+        if response.status_code == 204:
+            metrics.inc('iris_vt_quota_exhausted_total', source='api')
+        elif response.status_code in AUTH_FAILURE_STATUSES:
+            metrics.inc('iris_vt_auth_failures_total', source='api')
+        self.rate_limiter.notify_response(key, response.status_code)
+
+        try:
+            if response.status_code != 200:
+                results = None
+            elif stream:
+                chunks = count_response_bytes(response.iter_content(chunk_size=STREAM_CHUNK_SIZE))
+                results = parse_projected(chunks, self.projection)
+            else:
+                metrics.inc('iris_vt_response_bytes_total', len(response.content))
+                results = response.json()
+
+        except requests.RequestException as e:
+            self.breaker.record_failure()
+            return dict(error=f'Invalid response from VT. {e}'), True
+
+        except ValueError as e:
+            self.breaker.record_success()
+            return dict(error=f'Invalid response from VT. {e}'), False
+
+        finally:
+            response.close()
+
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+        return build_report(response.status_code, results), response.status_code in RETRYABLE_STATUSES
+
+    def get_ip_report(self, this_ip):
+        """
+        Get IP address report
+
+        :param this_ip: IP address
+        :return: VT report dict
+        """
+        return self._get('ip-address/report', {'ip': this_ip}, projected=True)
+
+    def get_domain_report(self, this_domain):
+        """
+        Get domain report
+
+        :param this_domain: Domain name
+        :return: VT report dict
+        """
+        return self._get('domain/report', {'domain': this_domain}, projected=True)
+
+    def get_file_report(self, resource):
+        """
+        Get file report
+
+        :param resource: md5/sha1/sha256 of the file, or comma-separated list of up to
+                         file_report_batch_size hashes
+        :return: VT report dict. Results is a list when several hashes are requested
+        """
+        params = {'resource': resource}
+
+        return self._get('file/report', params, premium_params={'allinfo': 1})
+
+    def close(self):
+        """
+        Closes the session, releasing its pooled connections. Requests still in flight complete, their
+        connections being closed once released
+
+        :return: Nothing
+        """
+        self.session.close()
+
+
+def get_proxies(server_config):
+    """
+    Returns the proxies to use to reach VT, from the IRIS server configuration
+
+    :param server_config: Server configuration
+    :return: Dict of proxies
+    """
+    proxies = {}
+
+    if server_config.get('http_proxy'):
+        proxies['https'] = server_config.get('HTTPS_PROXY')
+
+    if server_config.get('https_proxy'):
+        proxies['http'] = server_config.get('HTTP_PROXY')
+
+    return proxies
+
+
+def get_client_settings(mod_config, server_config):
+    """
+    Returns the settings of a VT client from the module configuration
+
+    :param mod_config: Module configuration
+    :param server_config: Server configuration
+    :return: Dict of VtClient arguments, with the API keys in place of the key pool
+    """
+    return {
+        'api_keys': get_api_keys(mod_config),
+        'proxies': get_proxies(server_config),
+        'pool_size': int(mod_config.get('vt_pool_size') or 10),
+        'connect_timeout': float(mod_config.get('vt_connect_timeout') or 5),
+        'read_timeout': float(mod_config.get('vt_read_timeout') or 30),
+        'max_wait': float(mod_config.get('vt_rate_limit_max_wait') or 0),
+        'retry_attempts': int(mod_config.get('vt_retry_attempts') or 0),
+        'retry_backoff': float(mod_config.get('vt_retry_backoff') or 0),
+        'projection_max_items': int(mod_config.get('vt_projection_max_items') or 0),
+        'projection_skip_undetected': bool(mod_config.get('vt_projection_skip_undetected'))
+    }
+
+
+def get_lookup_deadline(mod_config):
+    """
+    Returns the longest time a lookup of the VT client can last: waiting for a key, then connecting
+    and reading the response, on every attempt, with the longest backoff between attempts
+
+    :param mod_config: Module configuration
+    :return: Duration in seconds
+    """
+    connect_timeout = float(mod_config.get('vt_connect_timeout') or 5)
+    read_timeout = float(mod_config.get('vt_read_timeout') or 30)
+    max_wait = float(mod_config.get('vt_rate_limit_max_wait') or 0)
+    retry_attempts = int(mod_config.get('vt_retry_attempts') or 0)
+    retry_backoff = float(mod_config.get('vt_retry_backoff') or 0)
+
+    deadline = (retry_attempts + 1) * (max_wait + connect_timeout + read_timeout)
+    for attempt in range(1, retry_attempts + 1):
+        deadline += min(retry_backoff * 2 ** (attempt - 1), RETRY_MAX_DELAY)
+
+    return deadline
+
+
+def get_client_key(settings, mod_config):
+    """
+    Returns the key identifying a client built with the given settings
+
+    :param settings: Settings returned by get_client_settings
+    :param mod_config: Module configuration
+    :return: Hashable key
+    """
+    rate_limits = tuple(mod_config.get(f'vt_rate_limit_{window}') for window in ['per_minute', 'per_day', 'per_month'])
+    key_pool = tuple(mod_config.get(param) for param in ['vt_premium_key_weight', 'vt_key_quota_cooldown',
+                                                           'vt_key_auth_cooldown'])
+    breaker = (mod_config.get('vt_breaker_threshold'), mod_config.get('vt_breaker_cooldown'))
+    return tuple((name, tuple(sorted(value.items())) if isinstance(value, dict) else value)
+                 for name, value in sorted(settings.items())) + (rate_limits, key_pool, breaker)
+
+
+def get_vt_client(mod_config, server_config):
+    """
+    Returns the pooled VT client matching the module configuration. Clients are kept for the lifetime
+    of the worker and rebuilt only when the API keys, their types, the proxies or the connection
+    settings change.
+
+    :param mod_config: Module configuration
+    :param server_config: Server configuration
+    :return: VtClient
+    """
+    settings = get_client_settings(mod_config, server_config)
+    client_key = get_client_key(settings, mod_config)
+
+    with _clients_lock:
+        client = _clients.get(client_key)
+        if client is None:
+            # Configuration changed, close the previous clients so their pools are released
+            for stale_client in _clients.values():
+                stale_client.close()
+            _clients.clear()
+            client = VtClient(key_pool=build_key_pool(mod_config, settings.pop('api_keys')),
+                              breaker=build_circuit_breaker(mod_config), **settings)
+            _clients[client_key] = client
+
+    return client
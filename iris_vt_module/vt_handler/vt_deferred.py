@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+#
+#  IRIS VT Module Source Code
+#  contact@dfir-iris.org
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+import logging
+import os
+import sqlite3
+import threading
+import time
+import traceback
+
+from iris_vt_module.vt_handler.vt_cache import DEFAULT_CACHE_PATH, ensure_private_directory
+from iris_vt_module.vt_handler.vt_metrics import metrics
+
+log = logging.getLogger('iris_vt_module.vt_deferred')
+
+STATUS_PENDING = 'pending'
+STATUS_RUNNING = 'running'
+STATUS_DEAD = 'dead'
+
+# Time after which an entry claimed by a worker which died is handed to another one
+CLAIM_LEASE = 900
+# Maximum time the worker sleeps before checking the queue again
+POLL_INTERVAL = 30
+
+_queues = {}
+_queues_lock = threading.Lock()
+_workers = {}
+_workers_lock = threading.Lock()
+
+
+class VtDeferredQueue(object):
+    """
+    Durable queue of the IOCs waiting for a deferred enrichment, stored in a SQLite database shared by the
+    workers of the host. An IOC is queued once: queuing it again, e.g. after an update, refreshes its entry.
+    Entries are claimed with a lease, so entries of a worker which died are processed by another one
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+
+        ensure_private_directory(os.path.dirname(db_path) or '.')
+
+        self._conn = sqlite3.connect(db_path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS vt_deferred_queue ('
+                           'ioc_id INTEGER PRIMARY KEY, '
+                           'ioc_kind TEXT NOT NULL, '
+                           'ioc_value TEXT NOT NULL, '
+                           'status TEXT NOT NULL, '
+                           'attempts INTEGER NOT NULL, '
+                           'next_attempt_at REAL NOT NULL, '
+                           'enqueued_at REAL NOT NULL, '
+                           'last_error TEXT)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS vt_deferred_queue_due ON vt_deferred_queue '
+                           '(status, next_attempt_at)')
+
+    def enqueue(self, ioc_id, ioc_kind, ioc_value):
+        """
+        Queues an IOC for enrichment. An IOC already queued, or dead-lettered, is reset to pending
+
+        :param ioc_id: ID of the IOC
+        :param ioc_kind: Kind of the IOC (ip, domain, hash)
+        :param ioc_value: Value of the IOC when queued
+        :return: Nothing
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO vt_deferred_queue (ioc_id, ioc_kind, ioc_value, status, '
+                               'attempts, next_attempt_at, enqueued_at, last_error) VALUES (?, ?, ?, ?, 0, ?, ?, NULL)',
+                               (ioc_id, ioc_kind, ioc_value, STATUS_PENDING, now, now))
+
+    def claim(self, limit):
+        """
+        Claims the entries due for processing, oldest first
+
+        :param limit: Maximum number of entries claimed
+        :return: List of (IOC ID, IOC kind, IOC value, attempts)
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._conn.execute(
+                    'SELECT ioc_id, ioc_kind, ioc_value, attempts FROM vt_deferred_queue '
+                    'WHERE status IN (?, ?) AND next_attempt_at <= ? ORDER BY next_attempt_at, ioc_id LIMIT ?',
+                    (STATUS_PENDING, STATUS_RUNNING, now, limit)).fetchall()
+
+                self._conn.executemany('UPDATE vt_deferred_queue SET status = ?, next_attempt_at = ? WHERE ioc_id = ?',
+                                       [(STATUS_RUNNING, now + CLAIM_LEASE, row[0]) for row in rows])
+                self._conn.execute('COMMIT')
+
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+
+        return rows
+
+    def complete(self, ioc_id, ioc_value):
+        """
+        Removes an entry once processed. An entry queued again with another value while it was
+        processed is kept, so the new value is enriched too
+
+        :param ioc_id: ID of the IOC
+        :param ioc_value: Value of the IOC when claimed
+        :return: Nothing
+        """
+        with self._lock:
+            self._conn.execute('DELETE FROM vt_deferred_queue WHERE ioc_id = ? AND ioc_value = ? AND status = ?',
+                               (ioc_id, ioc_value, STATUS_RUNNING))
+
+    def retry(self, ioc_id, error, retry_delay, max_attempts):
+        """
+        Schedules a new attempt of a failed entry, with an exponential backoff. Entries reaching
+        the maximum number of attempts are dead-lettered
+
+        :param ioc_id: ID of the IOC
+        :param error: Error of the failed attempt
+        :param retry_delay: Delay before the first retry, in seconds
+        :param max_attempts: Number of attempts before dead-lettering
+        :return: True if the entry was dead-lettered
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT attempts FROM vt_deferred_queue WHERE ioc_id = ? AND status = ?',
+                                     (ioc_id, STATUS_RUNNING)).fetchone()
+            if row is None:
+                return False
+
+            attempts = row[0] + 1
+            dead = attempts >= max_attempts
+            self._conn.execute('UPDATE vt_deferred_queue SET status = ?, attempts = ?, next_attempt_at = ?, '
+                               'last_error = ? WHERE ioc_id = ?',
+                               (STATUS_DEAD if dead else STATUS_PENDING, attempts,
+                                time.time() + retry_delay * 2 ** (attempts - 1), error, ioc_id))
+
+        return dead
+
+    def get_depth(self):
+        """
+        Returns the number of entries of the queue, by status, and exports it to the worker metrics
+
+        :return: Dict with the pending, running and dead counts
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT status, COUNT(*) FROM vt_deferred_queue GROUP BY status').fetchall()
+
+        depth = {STATUS_PENDING: 0, STATUS_RUNNING: 0, STATUS_DEAD: 0}
+        depth.update(dict(rows))
+
+        for status, count in depth.items():
+            metrics.set('iris_vt_deferred_queue_depth', count, status=status)
+
+        return depth
+
+    def get_next_due(self):
+        """
+        Returns the time the next entry is due
+
+        :return: Timestamp, or None if nothing is waiting
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT MIN(next_attempt_at) FROM vt_deferred_queue WHERE status IN (?, ?)',
+                                     (STATUS_PENDING, STATUS_RUNNING)).fetchone()
+
+        return row[0]
+
+
+def get_deferred_queue(mod_config):
+    """
+    Returns the deferred enrichment queue, located next to the report cache
+
+    :param mod_config: Module configuration
+    :return: VtDeferredQueue
+    """
+    db_path = os.path.join(os.path.dirname(mod_config.get('vt_cache_path') or DEFAULT_CACHE_PATH), 'vt_deferred.db')
+
+    with _queues_lock:
+        queue = _queues.get(db_path)
+        if queue is None:
+            queue = VtDeferredQueue(db_path)
+            _queues[db_path] = queue
+
+    return queue
+
+
+class VtDeferredWorker(object):
+    """
+    Background thread draining the deferred queue of a worker process. Entries are claimed in batches
+    sized to the request slots the rate limiter has left, so the queue drains at the rate the quota allows
+    instead of having lookups wait on the limiter
+    """
+    def __init__(self, queue):
+        self.queue = queue
+        self.settings = None
+        self._wake_up = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def configure(self, process, rate_limiter, breaker, batch_size, retry_delay, max_attempts):
+        """
+        Updates the settings of the worker, from the hook which queued the latest entries
+
+        :param process: Callable enriching a list of claimed entries, returning a dict of errors by IOC ID,
+                        None for the entries enriched successfully
+        :param rate_limiter: Rate limiter of the lookup backend, or None
+        :param breaker: Circuit breaker of the lookup backend, or None
+        :param batch_size: Maximum number of entries processed at once
+        :param retry_delay: Delay before the first retry of a failed entry, in seconds
+        :param max_attempts: Number of attempts before an entry is dead-lettered
+        :return: Nothing
+        """
+        self.settings = (process, rate_limiter, breaker, batch_size, retry_delay, max_attempts)
+
+    def is_running(self):
+        """
+        Tells whether the worker thread runs in this process
+
+        :return: True if it runs
+        """
+        with self._lock:
+            return self._thread is not None and self._thread.is_alive()
+
+    def wake_up(self):
+        """
+        Starts the worker thread if needed and makes it check the queue
+
+        :return: Nothing
+        """
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='iris_vt_deferred', daemon=True)
+                self._thread.start()
+
+        self._wake_up.set()
+
+    def _get_sleep_time(self):
+        next_due = self.queue.get_next_due()
+        if next_due is None:
+            return POLL_INTERVAL
+
+        return min(max(next_due - time.time(), 0), POLL_INTERVAL)
+
+    def _run(self):
+        while True:
+            try:
+                processed = self.process_batch()
+            except Exception:
+                log.error(traceback.format_exc())
+                processed = 0
+
+            if not processed:
+                self._wake_up.wait(self._get_sleep_time())
+                self._wake_up.clear()
+
+    def process_batch(self):
+        """
+        Claims and processes a batch of due entries
+
+        :return: Number of entries processed
+        """
+        process, rate_limiter, breaker, batch_size, retry_delay, max_attempts = self.settings
+
+        # Entries are left queued while VT is unreachable, instead of using up their attempts
+        if breaker is not None:
+            wait = breaker.get_retry_after()
+            if wait:
+                time.sleep(min(wait, POLL_INTERVAL))
+                return 0
+
+        if rate_limiter is not None:
+            wait = rate_limiter.get_wait_time()
+            if wait:
+                time.sleep(min(wait, POLL_INTERVAL))
+                return 0
+
+            minute_slots = rate_limiter.get_remaining()['minute']
+            if minute_slots is not None:
+                batch_size = max(1, min(batch_size, minute_slots))
+
+        entries = self.queue.claim(batch_size)
+        if not entries:
+            return 0
+
+        try:
+            errors = process(entries)
+        except Exception:
+            error = traceback.format_exc()
+            log.error(error)
+            errors = {entry[0]: error for entry in entries}
+
+        for ioc_id, _, ioc_value, _ in entries:
+            error = errors.get(ioc_id)
+            if error is None:
+                self.queue.complete(ioc_id, ioc_value)
+
+            elif self.queue.retry(ioc_id, error, retry_delay, max_attempts):
+                log.error(f'Deferred enrichment of IOC {ioc_id} failed {max_attempts} times, dead-lettered. {error}')
+
+            else:
+                log.warning(f'Deferred enrichment of IOC {ioc_id} failed, will be retried. {error}')
+
+        depth = self.queue.get_depth()
+        log.info(f'{len(entries)} deferred IOCs processed. Queue depth: {depth[STATUS_PENDING]} pending, '
+                 f'{depth[STATUS_DEAD]} dead-lettered')
+
+        return len(entries)
+
+
+def get_deferred_worker(queue):
+    """
+    Returns the worker of a deferred queue in this process
+
+    :param queue: VtDeferredQueue
+    :return: VtDeferredWorker
+    """
+    with _workers_lock:
+        worker = _workers.get(queue.db_path)
+        if worker is None:
+            worker = VtDeferredWorker(queue)
+            _workers[queue.db_path] = worker
+
+    return worker
+
+
+def load_iocs(ioc_ids):
+    """
+    Loads IOCs from the IRIS database
+
+    :param ioc_ids: List of IOC IDs
+    :return: Dict of IOCs by ID. Deleted IOCs are missing
+    """
+    from app.models import Ioc
+
+    return {ioc.ioc_id: ioc for ioc in Ioc.query.filter(Ioc.ioc_id.in_(ioc_ids)).all()}
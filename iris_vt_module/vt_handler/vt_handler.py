@@ -16,117 +16,463 @@
 #  You should have received a copy of the GNU Lesser General Public License
 #  along with this program; if not, write to the Free Software Foundation,
 #  Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+import json
 import logging
+import time
 import traceback
-
-from virus_total_apis import PublicApi, PrivateApi
+from concurrent.futures import CancelledError, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from functools import partial, wraps
 
 from iris_interface.IrisModuleInterface import IrisPipelineTypes, IrisModuleInterface, IrisModuleTypes
-import iris_interface.IrisInterfaceStatus as InterfaceStatus
-from app.datamgmt.manage.manage_attribute_db import add_tab_attribute_field
 
+from iris_vt_module.vt_handler.vt_changeset import IocChangeSet
+from iris_vt_module.vt_handler.vt_client import get_lookup_deadline, get_vt_client
+from iris_vt_module.vt_handler.vt_lookup_backend import VtChainedBackend
+from iris_vt_module.vt_handler.vt_metrics import IocTimings, STAGES, metrics
+from iris_vt_module.vt_handler.vt_mirror import get_mirror_backend
+from iris_vt_module.vt_handler.vt_negative_cache import get_negative_cache
+from iris_vt_module.vt_handler.vt_report_model import VtReportModel
+from iris_vt_module.vt_handler.vt_cache import get_report_cache, get_sample_hashes, normalize_ioc_value, \
+    IOC_KIND_DOMAIN, IOC_KIND_HASH, IOC_KIND_IP
+from iris_vt_module.vt_handler.vt_singleflight import SingleFlight
 from iris_vt_module.vt_handler.vt_helper import gen_domain_report_from_template, gen_ip_report_from_template, \
-    get_detected_urls_ratio, gen_hash_report_from_template
+    gen_hash_report_from_template, get_rendered_report_cache, get_report_digest, get_template_digest, \
+    error_status, success_status
+
+REPORT_TEMPLATES = {
+    IOC_KIND_IP: 'vt_ip_report_template',
+    IOC_KIND_DOMAIN: 'vt_domain_report_template',
+    IOC_KIND_HASH: 'vt_hash_report_template'
+}
+
+FINGERPRINT_TAB = 'VT Report'
+FINGERPRINT_FIELD = 'Enrichment fingerprint'
+
+# Lookups in flight in this worker, shared by all the hooks it processes
+_lookups_in_flight = SingleFlight()
+
+
+def timed_enrichment(ioc_kind):
+    """
+    Decorates the handlers of an IOC kind so each enrichment gets a timing breakdown. The breakdown is
+    logged, added to the worker metrics and to the totals of the hook. A failed enrichment is accounted
+    to the last stage it reached
+
+    :param ioc_kind: Kind of the IOCs handled (ip, domain, hash)
+    :return: Decorator
+    """
+    def decorator(handler):
+        @wraps(handler)
+        def timed_handler(self, ioc, report=None):
+            self.timings = IocTimings()
+            status = handler(self, ioc, report=report)
+
+            timings = self.timings
+            lookup_key = (ioc_kind, normalize_ioc_value(ioc_kind, ioc.ioc_value))
+            timings.add('lookup', self.lookup_durations.pop(lookup_key, 0))
+            outcome = 'success' if status.is_success() else 'failure'
+            self.log.info(f'IOC {ioc.ioc_value} enrichment {outcome} in {timings.get_total() * 1000:.1f}ms '
+                          f'({timings.format()})')
+
+            metrics.observe_timings(timings)
+            metrics.inc('iris_vt_iocs_total', ioc_kind=ioc_kind, outcome=outcome)
+            if outcome == 'failure':
+                failed_stage = [stage for stage in STAGES if stage in timings.durations][-1]
+                metrics.inc('iris_vt_errors_total', ioc_kind=ioc_kind, stage=failed_stage)
+
+            self.hook_stats[outcome] += 1
+            for stage, seconds in timings.durations.items():
+                self.hook_stats['stages'][stage] = self.hook_stats['stages'].get(stage, 0) + seconds
+
+            return status
+
+        return timed_handler
+
+    return decorator
 
 
 class VtHandler(object):
     def __init__(self, mod_config, server_config, logger):
         self.mod_config = mod_config
         self.server_config = server_config
+        self.backend = mod_config.get('vt_backend') or 'api'
         self.vt = self.get_vt_instance()
+        self.cache = get_report_cache(mod_config)
+        self.prewarm_samples = bool(mod_config.get('vt_cache_prewarm_samples'))
+        # Misses of the local mirror alone say nothing about VT
+        self.negative_cache = get_negative_cache(mod_config) if self.backend != 'mirror' else None
+        self.max_concurrency = int(mod_config.get('vt_max_concurrency') or 1)
+        self.report_max_items = int(mod_config.get('vt_report_max_items') or 0)
+        self.report_max_bytes = int(mod_config.get('vt_report_max_bytes') or 0)
+        self.render_cache = get_rendered_report_cache(mod_config)
+        self.update_freshness = int(mod_config.get('vt_update_freshness') or 0) * 3600
+        self.async_vt = None
+        self.lookup_timeout = float(mod_config.get('vt_lookup_timeout') or 0)
+        # Hooks following a lookup led by another hook give up once it outlasted every attempt of the client
+        self.flight_timeout = get_lookup_deadline(mod_config)
         self.log = logger
+        # Durations of the lookups of this hook, consumed by the enrichment of the IOCs
+        self.lookup_durations = {}
+        # Digests of the reports of this hook, taken from the text the report cache reads or writes
+        self.report_digests = {}
+        self.timings = IocTimings()
+        # Lookups which failed for a transient reason (quota, network, breaker open), worth retrying later
+        self.hook_stats = {'success': 0, 'failure': 0, 'transient_failure': 0, 'stages': {},
+                           'render_cache_hits': 0, 'render_cache_misses': 0}
+
+        if mod_config.get('vt_lookup_engine') == 'asyncio':
+            # Imported on demand, so workers using the threads engine never load asyncio and aiohttp
+            from iris_vt_module.vt_handler.vt_async_client import get_vt_async_client, is_async_engine_available
+
+            if self.backend != 'api':
+                self.log.info(f'asyncio lookup engine only applies to the api backend, '
+                              f'using the threads engine with the {self.backend} backend')
+            elif is_async_engine_available():
+                self.async_vt = get_vt_async_client(mod_config, server_config)
+            else:
+                self.log.warning('asyncio lookup engine requires aiohttp, which is not installed. '
+                                 'Falling back to the threads engine')
 
     def get_vt_instance(self):
         """
-        Returns an VT API instance depending if the key is premium or not
+        Returns the lookup backend of the module configuration. The pooled VT client is shared across hooks
+        and rebuilt only when the configuration changes. The local mirror is used alone, or chained before
+        the VT client so that only the indicators it doesn't know are looked up online
 
         :return: VT Instance
         """
-        is_premium = self.mod_config.get('vt_key_is_premium')
-        api_key = self.mod_config.get('vt_api_key')
-        proxies = {}
+        if self.backend == 'mirror':
+            return get_mirror_backend(self.mod_config)
 
-        if self.server_config.get('http_proxy'):
-            proxies['https'] = self.server_config.get('HTTPS_PROXY')
+        vt_client = get_vt_client(self.mod_config, self.server_config)
+        if self.backend == 'chained':
+            return VtChainedBackend(get_mirror_backend(self.mod_config), vt_client)
+
+        return vt_client
+
+    def _log_quota(self):
+        """
+        Logs the remaining quota of the backend, if it has one
 
-        if self.server_config.get('https_proxy'):
-            proxies['http'] = self.server_config.get('HTTP_PROXY')
+        :return: Nothing
+        """
+        if self.vt.rate_limiter is not None:
+            self.log.info(f'VT quota remaining: {self.vt.rate_limiter.get_remaining()}')
+
+    def _get_cached_report(self, ioc_kind, value):
+        """
+        Returns the cached report of an IOC. Indicators VT recently didn't know get a not found report
+
+        :param ioc_kind: Kind of the IOC (ip, domain, hash)
+        :param value: Value of the IOC
+        :return: VT report or None
+        """
+        if self.negative_cache and self.negative_cache.contains(ioc_kind, value):
+            self.log.info(f'{value} recently not found in VT. Skipping lookup')
+            metrics.inc('iris_vt_negative_cache_hits_total', ioc_kind=ioc_kind)
+            return dict(results={'response_code': 0, 'verbose_msg': 'Indicator recently not found in VT'},
+                        response_code=200)
+
+        if not self.cache:
+            return None
+
+        report, digest = self.cache.get_with_digest(ioc_kind, value)
+        if report is not None:
+            self.log.info(f'VT report for {value} found in cache')
+            metrics.inc('iris_vt_cache_hits_total', ioc_kind=ioc_kind)
+            self.report_digests[(ioc_kind, normalize_ioc_value(ioc_kind, value))] = digest
+
+        return report
+
+    def _store_report(self, ioc_kind, value, report):
+        """
+        Stores a report fetched from VT into the cache, if valid. The samples listed by IP and domain
+        reports are recorded for pre-warming, and indicators VT doesn't know go to the negative cache
+
+        :param ioc_kind: Kind of the IOC (ip, domain, hash)
+        :param value: Value of the IOC
+        :param report: VT report
+        :return: Nothing
+        """
+        response_code = (report.get('results') or {}).get('response_code')
+        if self.negative_cache and response_code == 0:
+            self.negative_cache.add(ioc_kind, value)
+
+        if self.cache and response_code == 1:
+            digest = self.cache.set(ioc_kind, value, report)
+            self.report_digests[(ioc_kind, normalize_ioc_value(ioc_kind, value))] = digest
+
+            if self.prewarm_samples and ioc_kind != IOC_KIND_HASH:
+                self.cache.add_sample_hashes(get_sample_hashes(report['results']))
+
+    def _get_report_digest(self, ioc_kind, value, report):
+        """
+        Returns the digest identifying the content of the report of an IOC. Reports read from or written to
+        the report cache reuse the digest of their stored text, others are serialized to be digested
+
+        :param ioc_kind: Kind of the IOC (ip, domain, hash)
+        :param value: Value of the IOC
+        :param report: VT report
+        :return: Hex digest
+        """
+        digest = self.report_digests.get((ioc_kind, normalize_ioc_value(ioc_kind, value)))
+        return digest if digest is not None else get_report_digest(report)
+
+    def _get_report(self, ioc_kind, value, fetcher):
+        """
+        Returns the VT report of an IOC. The report cache is checked first, and only valid
+        reports fetched from VT are stored back into it
+
+        :param ioc_kind: Kind of the IOC (ip, domain, hash)
+        :param value: Value of the IOC
+        :param fetcher: VT API method to call on cache miss
+        :return: VT report
+        """
+        start = time.perf_counter()
+        report = self._get_cached_report(ioc_kind, value)
+        if report is None:
+            self.log.info(f'Getting {ioc_kind} report for {value}')
+            report = fetcher(value)
+            self._log_quota()
+            self._store_report(ioc_kind, value, report)
+            metrics.inc('iris_vt_lookups_total', ioc_kind=ioc_kind)
+
+        self._record_lookup(ioc_kind, [value], start)
+
+        return report
+
+    async def _get_report_async(self, ioc_kind, value, fetcher):
+        """
+        Same as _get_report, for the asyncio engine
 
-        if is_premium:
-            return PrivateApi(api_key, proxies=proxies)
+        :param ioc_kind: Kind of the IOC (ip, domain, hash)
+        :param value: Value of the IOC
+        :param fetcher: Coroutine method of the asyncio client to call on cache miss
+        :return: VT report
+        """
+        start = time.perf_counter()
+        report = self._get_cached_report(ioc_kind, value)
+        if report is None:
+            self.log.info(f'Getting {ioc_kind} report for {value}')
+            report = await fetcher(value)
+            self._log_quota()
+            self._store_report(ioc_kind, value, report)
+            metrics.inc('iris_vt_lookups_total', ioc_kind=ioc_kind)
+
+        self._record_lookup(ioc_kind, [value], start)
+
+        return report
+
+    def _record_lookup(self, ioc_kind, values, start):
+        """
+        Records the duration of a lookup, to be reported in the timing breakdown of the IOCs it served
+
+        :param ioc_kind: Kind of the IOCs (ip, domain, hash)
+        :param values: Values of the IOCs served by the lookup
+        :param start: perf_counter value at the start of the lookup
+        :return: Nothing
+        """
+        duration = time.perf_counter() - start
+        for value in values:
+            self.lookup_durations[(ioc_kind, normalize_ioc_value(ioc_kind, value))] = duration
+
+    def _get_template(self, ioc_kind):
+        """
+        Returns the configured report template of an IOC kind
+
+        :param ioc_kind: Kind of the IOC (ip, domain, hash)
+        :return: Template string
+        """
+        return self.mod_config.get(REPORT_TEMPLATES[ioc_kind]) or ''
+
+    def is_enrichment_fresh(self, ioc, ioc_kind):
+        """
+        Checks the enrichment fingerprint stored on an IOC. The enrichment is fresh if it was done
+        on the same value and type, with the same template, within the configured freshness window
+
+        :param ioc: IOC instance
+        :param ioc_kind: Kind of the IOC (ip, domain, hash)
+        :return: True if the IOC doesn't need to be enriched again
+        """
+        if not self.update_freshness:
+            return False
+
+        fingerprint = ((ioc.custom_attributes or {}).get(FINGERPRINT_TAB) or {}).get(FINGERPRINT_FIELD)
+        if not fingerprint:
+            return False
+
+        try:
+            fingerprint = json.loads(fingerprint.get('value'))
+        except (TypeError, ValueError):
+            return False
+
+        return (fingerprint.get('value') == ioc.ioc_value and
+                fingerprint.get('type') == ioc.ioc_type.type_name and
+                fingerprint.get('template_digest') == get_template_digest(self._get_template(ioc_kind)) and
+                time.time() - fingerprint.get('looked_up_at', 0) < self.update_freshness)
+
+    def _render_report(self, ioc_kind, generator, report, report_digest, model):
+        """
+        Renders the report of an IOC with the configured template. A report already rendered from the same
+        report content with the same template and limits is reused from the rendered reports cache
+
+        :param ioc_kind: Kind of the IOC (ip, domain, hash)
+        :param generator: gen_*_report_from_template function of the IOC kind
+        :param report: VT report
+        :param report_digest: Digest of the VT report
+        :param model: VtReportModel of the report
+        :return: IIStatus
+        """
+        html_template = self._get_template(ioc_kind)
+        if self.render_cache is None:
+            return generator(html_template=html_template, vt_report=report, max_items=self.report_max_items,
+                             max_bytes=self.report_max_bytes, model=model)
+
+        key = (ioc_kind, report_digest, get_template_digest(html_template), self.report_max_items,
+               self.report_max_bytes)
+        rendered = self.render_cache.get(key)
+        if rendered is not None:
+            self.hook_stats['render_cache_hits'] += 1
+            metrics.inc('iris_vt_render_cache_hits_total', ioc_kind=ioc_kind)
+            self.log.info(f'Rendered report reused. {self.render_cache.format_stats()}')
+            return success_status(data=rendered)
+
+        self.hook_stats['render_cache_misses'] += 1
+        metrics.inc('iris_vt_render_cache_misses_total', ioc_kind=ioc_kind)
+        status = generator(html_template=html_template, vt_report=report, max_items=self.report_max_items,
+                           max_bytes=self.report_max_bytes, model=model)
+        if status.is_success():
+            self.render_cache.set(key, status.get_data())
+            self.log.info(f'Rendered report cached. {self.render_cache.format_stats()}')
+
+        return status
+
+    def _store_fingerprint(self, changes, ioc_kind, report_digest):
+        """
+        Stores the enrichment fingerprint on an IOC, so later updates can skip the enrichment
+        while it is fresh. A fingerprint describing the same enrichment is kept as is, and only
+        its lookup time is refreshed once half of the freshness window has elapsed, so re-runs with an
+        unchanged verdict don't rewrite it every time. Nothing is stored when the freshness window is
+        disabled, as updates then always re-enrich
+
+        :param changes: IocChangeSet of the IOC
+        :param ioc_kind: Kind of the IOC (ip, domain, hash)
+        :param report_digest: Digest of the VT report the IOC was enriched with
+        :return: Nothing
+        """
+        if not self.update_freshness:
+            return
+
+        ioc = changes.ioc
+        fingerprint = {
+            'value': ioc.ioc_value,
+            'type': ioc.ioc_type.type_name,
+            'looked_up_at': time.time(),
+            'report_digest': report_digest,
+            'template_digest': get_template_digest(self._get_template(ioc_kind))
+        }
+
+        current = changes.get_attribute(FINGERPRINT_TAB, FINGERPRINT_FIELD)
+        try:
+            current_fingerprint = json.loads(current) if current else {}
+        except (TypeError, ValueError):
+            current_fingerprint = {}
+
+        if isinstance(current_fingerprint, dict):
+            looked_up_at = current_fingerprint.pop('looked_up_at', 0)
+            if current_fingerprint == {k: v for k, v in fingerprint.items() if k != 'looked_up_at'} and \
+                    fingerprint['looked_up_at'] - looked_up_at < self.update_freshness / 2:
+                return
+
+        changes.set_attribute(FINGERPRINT_TAB, FINGERPRINT_FIELD, "input_string", json.dumps(fingerprint))
+
+    def _apply_changes(self, changes):
+        """
+        Applies the changes of an enrichment to its IOC, only writing the fields that changed
+
+        :param changes: IocChangeSet of the IOC
+        :return: IIStatus
+        """
+        try:
+            applied = changes.apply()
+
+        except Exception:
+            self.log.error(traceback.format_exc())
+            return error_status(traceback.format_exc())
+
+        if applied:
+            self.log.info(f'Updated {", ".join(applied)} of IOC {changes.ioc.ioc_value}')
         else:
-            return PublicApi(api_key, proxies=proxies)
+            self.log.info(f'IOC {changes.ioc.ioc_value} unchanged. Nothing to write')
+
+        return success_status()
 
     def _validate_report(self, report):
         self.log.info(f'VT report fetched.')
         results = report.get('results')
         if not results:
-            self.log.error(f'Unable to get report. Is the API key valid ?')
-            return InterfaceStatus.I2Error
+            self.hook_stats['transient_failure'] += 1
+            if report.get('response_code') == 204:
+                self.log.error(f'Unable to get report. {report.get("error")}')
+            else:
+                self.log.error(f'Unable to get report. Is the API key valid ?')
+            return error_status()
 
         if results.get('response_code') == 0:
             self.log.error(f'Got invalid feedback from VT :: {results.get("verbose_msg")}')
-            return InterfaceStatus.I2Error()
+            return error_status(f'Got invalid feedback from VT :: {results.get("verbose_msg")}')
 
-        return InterfaceStatus.I2Success(data=report)
+        return success_status(data=report)
 
-    def tag_if_malicious_or_suspicious(self, context, ioc):
+    def tag_if_malicious_or_suspicious(self, context, changes):
         """
         Tag an IOC if the detections ratio are higher than the configured threshold
-        :param ioc: IOC checked
-        :param context: VT report
+        :param changes: IocChangeSet of the IOC checked
+        :param context: VtReportModel of the VT report
         :return:
         """
-        _, avg_detected_ratio, _ = get_detected_urls_ratio(context)
-
-        if not avg_detected_ratio:
-
-            pos = context.get('positives')
-            total = context.get('total')
-            if pos and total:
-                avg_detected_ratio = round(float(pos)/float(total), 2) * 100
+        avg_detected_ratio = context.get_detection_ratio()
 
         if avg_detected_ratio:
-            if ioc.ioc_tags is None:
-                ioc.ioc_tags = ""
-
             if float(self.mod_config.get('vt_tag_malicious_threshold')) <= float(avg_detected_ratio):
-                if f'vt:malicious' not in ioc.ioc_tags.split(','):
-                    ioc.ioc_tags = f"{ioc.ioc_tags},vt:malicious"
+                changes.add_tag('vt:malicious')
 
             elif float(self.mod_config.get('vt_tag_suspicious_threshold')) <= float(avg_detected_ratio):
-                if f'vt:suspicious' not in ioc.ioc_tags.split(','):
-                    ioc.ioc_tags = f"{ioc.ioc_tags},vt:suspicious"
+                changes.add_tag('vt:suspicious')
 
             else:
-                if f'vt:suspicious' in ioc.ioc_tags.split(','):
-                    ioc.ioc_tags = ioc.ioc_tags.replace('vt:suspicious', '').replace(',,', ',')
-                if f'vt:malicious' in ioc.ioc_tags.split(','):
-                    ioc.ioc_tags = ioc.ioc_tags.replace('vt:malicious', '').replace(',,', ',')
+                changes.remove_tag('vt:suspicious')
+                changes.remove_tag('vt:malicious')
 
-    def handle_vt_domain(self, ioc):
+    @timed_enrichment(IOC_KIND_DOMAIN)
+    def handle_vt_domain(self, ioc, report=None):
         """
         Handles an IOC of type domain and adds VT insights
 
         :param ioc: IOC instance
+        :param report: VT report of the domain if already fetched, else it is fetched
         :return: IIStatus
         """
+        if report is None:
+            report = self._get_report(IOC_KIND_DOMAIN, ioc.ioc_value, self.vt.get_domain_report)
 
-        self.log.info(f'Getting domain report for {ioc.ioc_value}')
-        report = self.vt.get_domain_report(ioc.ioc_value)
-
-        status = self._validate_report(report)
+        with self.timings.stage('validate'):
+            status = self._validate_report(report)
         if not status: return status
 
         report = status.get_data()
+        report_digest = self._get_report_digest(IOC_KIND_DOMAIN, ioc.ioc_value, report)
         results = report.get('results')
 
-        self.tag_if_malicious_or_suspicious(context=results, ioc=ioc)
+        with self.timings.stage('tagging'):
+            model = VtReportModel.from_results(results)
+            changes = IocChangeSet(ioc)
+            self.tag_if_malicious_or_suspicious(context=model, changes=changes)
 
         if self.mod_config.get('vt_domain_add_whois_as_desc') is True:
-            if "WHOIS" not in ioc.ioc_description:
+            if "WHOIS" not in changes.description:
                 self.log.info('Adding WHOIS information to IOC description')
-                ioc.ioc_description = f"{ioc.ioc_description}\n\nWHOIS\n {results.get('whois')}"
+                changes.append_description(f"\n\nWHOIS\n {results.get('whois')}")
 
             else:
                 self.log.info('Skipped adding WHOIS. Information already present')
@@ -135,11 +481,11 @@ class VtHandler(object):
 
         if self.mod_config.get('vt_domain_add_subdomain_as_desc') is True:
 
-            if "Subdomains" not in ioc.ioc_description:
+            if "Subdomains" not in changes.description:
                 if report.get('results').get('subdomains'):
                     subd_data = [f"- {subd}\n" for subd in results.get('subdomains')]
                     self.log.info('Adding subdomains information to IOC description')
-                    ioc.ioc_description = f"{ioc.ioc_description}\n\nSubdomains\n{subd_data}"
+                    changes.append_description(f"\n\nSubdomains\n{subd_data}")
                 else:
                     self.log.info('No subdomains in VT report')
             else:
@@ -150,128 +496,425 @@ class VtHandler(object):
         if self.mod_config.get('vt_report_as_attribute') is True:
             self.log.info('Adding new attribute VT Domain Report to IOC')
 
-            status = gen_domain_report_from_template(html_template=self.mod_config.get('vt_domain_report_template'),
-                                                     vt_report=report)
+            with self.timings.stage('render'):
+                status = self._render_report(IOC_KIND_DOMAIN, gen_domain_report_from_template, report,
+                                             report_digest, model)
 
             if not status.is_success():
                 return status
 
             rendered_report = status.get_data()
 
-            try:
-                add_tab_attribute_field(ioc, tab_name='VT Report', field_name="HTML report", field_type="html",
-                                        field_value=rendered_report)
-
-            except Exception:
-
-                self.log.error(traceback.format_exc())
-                return InterfaceStatus.I2Error(traceback.format_exc())
+            changes.set_attribute('VT Report', "HTML report", "html", rendered_report)
         else:
             self.log.info('Skipped adding attribute report. Option disabled')
 
-        return InterfaceStatus.I2Success()
+        with self.timings.stage('write'):
+            self._store_fingerprint(changes, IOC_KIND_DOMAIN, report_digest)
+            status = self._apply_changes(changes)
+        if not status: return status
 
-    def handle_vt_ip(self, ioc):
+        return success_status()
+
+    @timed_enrichment(IOC_KIND_IP)
+    def handle_vt_ip(self, ioc, report=None):
         """
         Handles an IOC of type IP and adds VT insights
 
         :param ioc: IOC instance
+        :param report: VT report of the IP if already fetched, else it is fetched
         :return: IIStatus
         """
-        vt = self.get_vt_instance()
-
-        self.log.info(f'Getting IP report for {ioc.ioc_value}')
-        report = vt.get_ip_report(ioc.ioc_value)
+        if report is None:
+            report = self._get_report(IOC_KIND_IP, ioc.ioc_value, self.vt.get_ip_report)
 
-        status = self._validate_report(report)
+        with self.timings.stage('validate'):
+            status = self._validate_report(report)
         if not status: return status
 
         report = status.get_data()
+        report_digest = self._get_report_digest(IOC_KIND_IP, ioc.ioc_value, report)
 
         results = report.get('results')
 
-        self.tag_if_malicious_or_suspicious(context=results, ioc=ioc)
+        with self.timings.stage('tagging'):
+            model = VtReportModel.from_results(results)
+            changes = IocChangeSet(ioc)
+            self.tag_if_malicious_or_suspicious(context=model, changes=changes)
 
         if self.mod_config.get('vt_ip_assign_asn_as_tag') is True:
             self.log.info('Assigning new ASN tag to IOC.')
 
-            asn = results.get('asn')
+            asn = model.asn
             if asn is None:
                 self.log.info('ASN was nul - skipping')
 
-            if ioc.ioc_tags is None:
-                ioc.ioc_tags = ""
-
-            if f'ASN:{asn}' not in ioc.ioc_tags.split(','):
-                ioc.ioc_tags = f"{ioc.ioc_tags},ASN:{asn}"
+            if not changes.has_tag(f'ASN:{asn}'):
+                changes.add_tag(f'ASN:{asn}')
             else:
                 self.log.info('ASN already tagged for this IOC. Skipping')
 
         if self.mod_config.get('vt_report_as_attribute') is True:
             self.log.info('Adding new attribute VT IP Report to IOC')
 
-            status = gen_ip_report_from_template(html_template=self.mod_config.get('vt_ip_report_template'),
-                                                 vt_report=report)
+            with self.timings.stage('render'):
+                status = self._render_report(IOC_KIND_IP, gen_ip_report_from_template, report, report_digest,
+                                             model)
 
             if not status.is_success():
                 return status
 
             rendered_report = status.get_data()
 
-            try:
-                add_tab_attribute_field(ioc, tab_name='VT Report', field_name="HTML report", field_type="html",
-                                        field_value=rendered_report)
-
-            except Exception:
-                print(traceback.format_exc())
-                self.log.error(traceback.format_exc())
-                return InterfaceStatus.I2Error(traceback.format_exc())
+            changes.set_attribute('VT Report', "HTML report", "html", rendered_report)
         else:
             self.log.info('Skipped adding attribute report. Option disabled')
 
-        return InterfaceStatus.I2Success("Successfully processed IP")
+        with self.timings.stage('write'):
+            self._store_fingerprint(changes, IOC_KIND_IP, report_digest)
+            status = self._apply_changes(changes)
+        if not status: return status
+
+        return success_status(message="Successfully processed IP")
+
+    def get_reports(self, lookups):
+        """
+        Fetches the reports of several IOCs at once. Lookups run concurrently, either in a bounded thread
+        pool or on the asyncio engine, and hashes not found in cache are grouped in batched file report
+        requests, as VT accepts several comma-separated resources per request. Only the fetches run in
+        the pool, so the IOCs themselves are never touched outside the hook thread.
+
+        Duplicated IOCs are looked up once, and lookups already in flight for another hook of this
+        worker are waited for instead of being issued again.
+
+        :param lookups: List of (IOC kind, value)
+        :return: Dict of VT reports indexed by (IOC kind, normalized value)
+        """
+        reports = {}
+        leaders = []
+        follower_tasks = []
+        claimed = []
+        to_fetch_hashes = []
+        for ioc_kind, value in lookups:
+            key = (ioc_kind, normalize_ioc_value(ioc_kind, value))
+            if key in reports:
+                continue
+
+            reports[key] = None
+
+            if ioc_kind == IOC_KIND_HASH:
+                report = self._get_cached_report(IOC_KIND_HASH, key[1])
+                if report is not None:
+                    reports[key] = report
+                    continue
+
+            flight, is_leader = _lookups_in_flight.claim(key)
+            if not is_leader:
+                self.log.info(f'Lookup of {value} already in flight. Waiting for it')
+                follower_tasks.append(partial(self._wait_flight, key, flight))
+                continue
+
+            claimed.append((key, flight))
+            if ioc_kind == IOC_KIND_HASH:
+                to_fetch_hashes.append((key, flight))
+            else:
+                leaders.append(([(key, flight)], ioc_kind, key[1]))
+
+        batch_size = self.vt.file_report_batch_size
+        for index in range(0, len(to_fetch_hashes), batch_size):
+            batch_flights = to_fetch_hashes[index:index + batch_size]
+            leaders.append((batch_flights, IOC_KIND_HASH, [key[1] for key, _ in batch_flights]))
+
+        # A batched request costs the same whatever the number of hashes, so the free slots of the last
+        # batch are filled with samples seen in IP and domain reports, likely to be looked up later
+        prewarm_keys = []
+        if self.cache and self.prewarm_samples and to_fetch_hashes and len(to_fetch_hashes) % batch_size:
+            batch = leaders[-1][2]
+            requested = {key[1] for key in reports if key[0] == IOC_KIND_HASH}
+            for sample_hash in self.cache.get_sample_hashes(batch_size - len(batch), exclude=requested):
+                batch.append(sample_hash)
+                prewarm_keys.append((IOC_KIND_HASH, sample_hash))
+
+        try:
+            if self.async_vt:
+                try:
+                    results = self.async_vt.run(self._run_lookups_async(leaders, follower_tasks),
+                                                timeout=self.lookup_timeout or None)
+                except (FutureTimeoutError, CancelledError) as e:
+                    error = f'VT lookups timed out after {self.lookup_timeout} seconds' \
+                        if isinstance(e, FutureTimeoutError) else 'VT lookups cancelled as the client was closed'
+                    self.log.error(error)
+                    results = [{key: dict(error=error) for key, _ in claimed}]
+
+                for result in results:
+                    reports.update(result)
+
+            else:
+                for result in self._run_lookups(leaders, follower_tasks):
+                    reports.update(result)
+
+        finally:
+            # Release the followers of lookups which never ran because an error aborted the hook
+            for key, flight in claimed:
+                _lookups_in_flight.fail(key, flight, RuntimeError(f'Lookup of {key[1]} aborted'))
+
+        self._collect_prewarmed(reports, prewarm_keys)
+
+        return reports
+
+    def _collect_prewarmed(self, reports, prewarm_keys):
+        """
+        Removes the pre-warmed sample reports from the reports of a hook. They are already cached, and
+        the samples VT doesn't know are dropped from the candidates
+
+        :param reports: Dict of VT reports indexed by (IOC kind, normalized value)
+        :param prewarm_keys: List of (IOC kind, normalized hash) added to the batches for pre-warming
+        :return: Nothing
+        """
+        unknown = []
+        for key in prewarm_keys:
+            results = (reports.pop(key, None) or {}).get('results') or {}
+            if results.get('response_code') == 1:
+                metrics.inc('iris_vt_prewarmed_total')
+            elif results.get('response_code') == 0:
+                unknown.append(key[1])
+
+        if prewarm_keys:
+            self.log.info(f'{len(prewarm_keys) - len(unknown)} sample reports pre-warmed')
+
+        if unknown:
+            self.cache.discard_sample_hashes(unknown)
+
+    def _run_lookups(self, leaders, follower_tasks):
+        """
+        Runs the lookups of get_reports with the threads engine
+
+        :param leaders: List of (flights, IOC kind, value or batch of hashes) led by this handler
+        :param follower_tasks: Callables waiting for lookups led by other hooks
+        :return: List of dicts of VT reports indexed by (IOC kind, normalized value)
+        """
+        fetchers = {
+            IOC_KIND_IP: self.vt.get_ip_report,
+            IOC_KIND_DOMAIN: self.vt.get_domain_report
+        }
+
+        # Leaders are scheduled first. They never wait on other hooks, so followers always end up released
+        tasks = []
+        for flights, ioc_kind, value in leaders:
+            if ioc_kind == IOC_KIND_HASH:
+                task = partial(self._fetch_hash_batch, value)
+            else:
+                task = partial(self._fetch_single, ioc_kind, value, fetchers[ioc_kind])
+
+            tasks.append(partial(self._lead, flights, task))
+
+        tasks += follower_tasks
+
+        if len(tasks) <= 1 or self.max_concurrency <= 1:
+            return [task() for task in tasks]
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='iris_vt') as executor:
+            return list(executor.map(lambda task: task(), tasks))
+
+    async def _run_lookups_async(self, leaders, follower_tasks):
+        """
+        Runs the lookups of get_reports with the asyncio engine, on the private loop of the asyncio
+        client. At most max_concurrency requests are in flight at once
+
+        :param leaders: List of (flights, IOC kind, value or batch of hashes) led by this handler
+        :param follower_tasks: Callables waiting for lookups led by other hooks
+        :return: List of dicts of VT reports indexed by (IOC kind, normalized value)
+        """
+        fetchers = {
+            IOC_KIND_IP: self.async_vt.get_ip_report,
+            IOC_KIND_DOMAIN: self.async_vt.get_domain_report
+        }
+        import asyncio
+
+        semaphore = asyncio.Semaphore(max(self.max_concurrency, 1))
+        loop = asyncio.get_running_loop()
+
+        async def run_leader(flights, ioc_kind, value):
+            async with semaphore:
+                try:
+                    if ioc_kind == IOC_KIND_HASH:
+                        reports = await self._fetch_hash_batch_async(value)
+                    else:
+                        reports = {(ioc_kind, value): await self._get_report_async(ioc_kind, value,
+                                                                                   fetchers[ioc_kind])}
+
+                except Exception as e:
+                    return self._fail_lead(flights, e)
+
+            for key, flight in flights:
+                _lookups_in_flight.resolve(key, flight, reports.get(key))
+
+            return reports
+
+        # Followers block on a lookup owned by another hook, so they wait in the default executor
+        return await asyncio.gather(*[run_leader(*leader) for leader in leaders],
+                                    *[loop.run_in_executor(None, task) for task in follower_tasks])
+
+    def _lead(self, flights, task):
+        """
+        Runs a lookup task and publishes its outcome to the hooks waiting for it
+
+        :param flights: List of ((IOC kind, normalized value), flight) led by the task
+        :param task: Lookup task, returning a dict of reports indexed by (IOC kind, normalized value)
+        :return: Reports of the task, or error reports of its IOCs if it failed
+        """
+        try:
+            reports = task()
+
+        except Exception as e:
+            return self._fail_lead(flights, e)
+
+        for key, flight in flights:
+            _lookups_in_flight.resolve(key, flight, reports.get(key))
+
+        return reports
+
+    def _fail_lead(self, flights, error):
+        """
+        Publishes the failure of a lookup task to the hooks waiting for it. The failure is confined to
+        the IOCs of the task, the other lookups of the hook go on
+
+        :param flights: List of ((IOC kind, normalized value), flight) led by the task
+        :param error: Exception raised by the task
+        :return: Dict of error reports indexed by (IOC kind, normalized value)
+        """
+        self.log.error(f'Lookup of {", ".join(key[1] for key, _ in flights)} failed. {traceback.format_exc()}')
+        for key, flight in flights:
+            _lookups_in_flight.fail(key, flight, error)
+
+        return {key: dict(error=f'Lookup failed. {error}') for key, _ in flights}
+
+    def _wait_flight(self, key, flight):
+        """
+        Waits for a lookup issued by another hook
+
+        :param key: (IOC kind, normalized value)
+        :param flight: Flight of the lookup
+        :return: Dict with the VT report indexed by (IOC kind, normalized value), an error report if
+                 the lookup failed or outlasted the flight timeout
+        """
+        try:
+            return {key: flight.wait(self.flight_timeout)}
+
+        except Exception as e:
+            self.log.error(f'Lookup of {key[1]} led by another hook failed. {e}')
+            return {key: dict(error=f'Lookup failed. {e}')}
+
+    def _fetch_single(self, ioc_kind, key, fetcher):
+        """
+        Fetches the report of a single IOC
+
+        :param ioc_kind: Kind of the IOC (ip, domain)
+        :param key: Normalized value of the IOC
+        :param fetcher: VT API method to call on cache miss
+        :return: Dict with the VT report indexed by (IOC kind, normalized value)
+        """
+        return {(ioc_kind, key): self._get_report(ioc_kind, key, fetcher)}
+
+    def _fetch_hash_batch(self, batch):
+        """
+        Fetches the reports of a batch of hashes in a single request and splits the response per hash
+
+        :param batch: List of normalized hashes
+        :return: Dict of VT reports indexed by (IOC kind, normalized hash)
+        """
+        start = time.perf_counter()
+        self.log.info(f'Getting hash reports for {", ".join(batch)}')
+        report = self.vt.get_file_report(','.join(batch))
+        self._log_quota()
+        metrics.inc('iris_vt_lookups_total', len(batch), ioc_kind=IOC_KIND_HASH)
+        self._record_lookup(IOC_KIND_HASH, batch, start)
+
+        return self._split_hash_batch(batch, report)
 
-    def handle_vt_hash(self, ioc):
+    async def _fetch_hash_batch_async(self, batch):
+        """
+        Same as _fetch_hash_batch, for the asyncio engine
+
+        :param batch: List of normalized hashes
+        :return: Dict of VT reports indexed by (IOC kind, normalized hash)
+        """
+        start = time.perf_counter()
+        self.log.info(f'Getting hash reports for {", ".join(batch)}')
+        report = await self.async_vt.get_file_report(','.join(batch))
+        self._log_quota()
+        metrics.inc('iris_vt_lookups_total', len(batch), ioc_kind=IOC_KIND_HASH)
+        self._record_lookup(IOC_KIND_HASH, batch, start)
+
+        return self._split_hash_batch(batch, report)
+
+    def _split_hash_batch(self, batch, report):
+        """
+        Splits the response of a batched file report request into one report per hash,
+        and caches the valid ones
+
+        :param batch: List of normalized hashes requested
+        :param report: VT report of the batch
+        :return: Dict of VT reports indexed by (IOC kind, normalized hash)
+        """
+        results = report.get('results')
+        if not results:
+            return {(IOC_KIND_HASH, key): report for key in batch}
+
+        if isinstance(results, dict):
+            results = [results]
+
+        reports = {}
+        for key, result in zip(batch, results):
+            hash_report = {'results': result, 'response_code': report.get('response_code')}
+            reports[(IOC_KIND_HASH, key)] = hash_report
+            self._store_report(IOC_KIND_HASH, key, hash_report)
+
+        return reports
+
+    @timed_enrichment(IOC_KIND_HASH)
+    def handle_vt_hash(self, ioc, report=None):
         """
         Handles an IOC of type hash and adds VT insights
 
         :param ioc: IOC instance
+        :param report: VT report of the hash if already fetched, else it is fetched
         :return: IIStatus
         """
-        vt = self.get_vt_instance()
-
-        self.log.info(f'Getting hash report for {ioc.ioc_value}')
-        report = vt.get_file_report(ioc.ioc_value)
+        if report is None:
+            report = self._get_report(IOC_KIND_HASH, ioc.ioc_value, self.vt.get_file_report)
 
-        status = self._validate_report(report)
+        with self.timings.stage('validate'):
+            status = self._validate_report(report)
         if not status: return status
 
         report = status.get_data()
+        report_digest = self._get_report_digest(IOC_KIND_HASH, ioc.ioc_value, report)
         results = report.get('results')
 
-        self.tag_if_malicious_or_suspicious(context=results, ioc=ioc)
+        with self.timings.stage('tagging'):
+            model = VtReportModel.from_results(results)
+            changes = IocChangeSet(ioc)
+            self.tag_if_malicious_or_suspicious(context=model, changes=changes)
 
         if self.mod_config.get('vt_report_as_attribute') is True:
             self.log.info('Generating report from template')
-            status = gen_hash_report_from_template(html_template=self.mod_config.get('vt_hash_report_template'),
-                                                   vt_report=report)
+            with self.timings.stage('render'):
+                status = self._render_report(IOC_KIND_HASH, gen_hash_report_from_template, report, report_digest,
+                                             model)
 
             if not status.is_success():
                 return status
 
             rendered_report = status.get_data()
 
-            try:
-                self.log.info('Adding new attribute VT hash Report to IOC')
-                add_tab_attribute_field(ioc, tab_name='VT Report', field_name="HTML report", field_type="html",
-                                        field_value=rendered_report)
-                self.log.info('Done')
-
-            except Exception:
-                print(traceback.format_exc())
-                self.log.error(traceback.format_exc())
-                return InterfaceStatus.I2Error(traceback.format_exc())
+            changes.set_attribute('VT Report', "HTML report", "html", rendered_report)
         else:
             self.log.info('Skipped adding attribute report. Option disabled')
 
-        return InterfaceStatus.I2Success("Successfully processed hash")
\ No newline at end of file
+        with self.timings.stage('write'):
+            self._store_fingerprint(changes, IOC_KIND_HASH, report_digest)
+            status = self._apply_changes(changes)
+        if not status: return status
+
+        return success_status(message="Successfully processed hash")
@@ -1,134 +1,487 @@
+import hashlib
 import json
+import threading
 import traceback
+from collections import OrderedDict
 
-from jinja2 import Template
 import logging
 from iris_interface import IrisInterfaceStatus
 
+import iris_vt_module.IrisVTConfig as interface_conf
+from iris_vt_module.vt_handler.vt_metrics import metrics
+from iris_vt_module.vt_handler.vt_report_model import VtReportModel
+
 log = logging.getLogger('iris_vt_module.vt_helper')
 
 
-def get_detected_urls_ratio(report):
-    avg_urls_detect_ratio = None
-    avg_urls_detect_ratio_str = "No information"
-    nb_detected_urls = None
-    if "detected_urls" in report:
-        nb_detected_urls = len(report["detected_urls"])
-        count_total = 0
-        count_positives = 0
+def success_status(data=None, message='Success'):
+    """
+    Returns a new success status. The I2Success and I2Error of iris_interface are shared instances, which
+    calling mutates, so they can't carry data out of code running in several threads, such as the
+    deferred worker and the hooks
 
-        for detected_url in report["detected_urls"]:
-            count_total += detected_url.get('total')
-            count_positives += detected_url.get('positives')
+    :param data: Data of the status
+    :param message: Message of the status
+    :return: IIStatus
+    """
+    return IrisInterfaceStatus.IIStatus(code=IrisInterfaceStatus.I2CodeSuccess, message=message, data=data)
 
-        if nb_detected_urls > 0:
-            avg_urls_detect_ratio_str = f"{round(count_positives/nb_detected_urls, 2)} / " \
-                                              f"{count_total/nb_detected_urls}"
 
-            avg_urls_detect_ratio = round(count_positives/count_total, 2)*100
+def error_status(message='Unspecified error', data=None):
+    """
+    Returns a new error status, see success_status
 
-    return avg_urls_detect_ratio_str, avg_urls_detect_ratio, nb_detected_urls
+    :param message: Message of the status
+    :param data: Data of the status
+    :return: IIStatus
+    """
+    return IrisInterfaceStatus.IIStatus(code=IrisInterfaceStatus.I2CodeError, message=message, data=data)
+
+# Templates are compiled once in a shared environment and cached by the digest of their content,
+# so a template edited in the UI is recompiled on next use while unchanged ones are reused.
+# The environment is built on first compilation, Jinja is not loaded before a template is needed
+MAX_COMPILED_TEMPLATES = 32
+_jinja_env = None
+_compiled_templates = {}
+_compiled_templates_lock = threading.Lock()
 
+_rendered_caches = {}
+_rendered_caches_lock = threading.Lock()
 
-def gen_domain_report_from_template(html_template, vt_report) -> IrisInterfaceStatus:
+
+class TruncatedList(list):
     """
-    Generates an HTML report for domains, displayed as an attribute in the IOC
+    List section of a report cut to the configured number of items
+    """
+    truncated_count = 0
 
-    :param html_template: A string representing the HTML template
-    :param vt_report: The JSON report fetched with VT API
-    :return: IrisInterfaceStatus
+
+class TruncatedDict(dict):
     """
-    template = Template(html_template)
-    context = vt_report
-    results = context.get('results')
+    Dict section of a report cut to the configured number of items
+    """
+    truncated_count = 0
 
-    context["avg_urls_detect_ratio"], _, context["nb_detected_urls"] = get_detected_urls_ratio(results)
 
-    if "detected_downloaded_samples" in results:
-        context["nb_detected_samples"] = len(results["detected_downloaded_samples"])
-        count_total = 0
-        count_positives = 0
+def _add_truncation_markers(value):
+    """
+    Returns a copy of value where truncated sections end with a marker telling how many items were dropped
 
-        for samples in results["detected_downloaded_samples"]:
-            count_total += samples.get('total')
-            count_positives += samples.get('positives')
+    :param value: Report or part of a report
+    :return: Value with markers
+    """
+    if isinstance(value, TruncatedList):
+        return [_add_truncation_markers(item) for item in value] + [f'... truncated {value.truncated_count} items']
 
-        if context['nb_detected_samples'] > 0:
-            context["avg_samples_detect_ratio"] = f"{round(count_positives/context['nb_detected_samples'], 2)} / " \
-                                                  f"{count_total/context['nb_detected_samples']}"
-        else:
-            context["avg_samples_detect_ratio"] = "No information"
+    if isinstance(value, TruncatedDict):
+        marked = {key: _add_truncation_markers(item) for key, item in value.items()}
+        marked['...'] = f'truncated {value.truncated_count} items'
+        return marked
+
+    if isinstance(value, dict):
+        return {key: _add_truncation_markers(item) for key, item in value.items()}
+
+    return value
+
+
+def tojson_with_truncation(value, indent=None):
+    """
+    Replacement of the builtin tojson filter, which shows the sections truncated by bound_report_sections
+
+    :param value: Value to serialize
+    :param indent: JSON indentation
+    :return: Markup
+    """
+    from jinja2.utils import htmlsafe_json_dumps
+
+    return htmlsafe_json_dumps(_add_truncation_markers(value), dumps=json.dumps, indent=indent, sort_keys=True)
+
+
+def _get_jinja_env():
+    """
+    Returns the shared Jinja environment, built on first use
+
+    :return: jinja2 Environment
+    """
+    global _jinja_env
+
+    if _jinja_env is None:
+        from jinja2 import Environment
+
+        jinja_env = Environment()
+        jinja_env.filters['tojson'] = tojson_with_truncation
+        _jinja_env = jinja_env
+
+    return _jinja_env
 
-    try:
 
+def bound_report_sections(results, max_items):
+    """
+    Returns a shallow copy of the report results where every list or dict section holds at most max_items
+    items. The original results are left untouched
+
+    :param results: Results of a VT report
+    :param max_items: Maximum number of items per section. 0 means unlimited
+    :return: Bounded results
+    """
+    if not max_items:
+        return results
+
+    bounded = {}
+    for section, value in results.items():
+        if isinstance(value, list) and len(value) > max_items:
+            value_bounded = TruncatedList(value[:max_items])
+            value_bounded.truncated_count = getattr(value, 'truncated_count', 0) + len(value) - max_items
+            value = value_bounded
+
+        elif isinstance(value, dict) and len(value) > max_items:
+            value_bounded = TruncatedDict(item for _, item in zip(range(max_items), value.items()))
+            value_bounded.truncated_count = getattr(value, 'truncated_count', 0) + len(value) - max_items
+            value = value_bounded
+
+        bounded[section] = value
+
+    return bounded
+
+
+def _empty_report_sections(results):
+    """
+    Returns a shallow copy of the report results where every list or dict section is emptied, keeping
+    only the number of items dropped
+
+    :param results: Results of a VT report
+    :return: Results without sections
+    """
+    emptied = {}
+    for section, value in results.items():
+        if isinstance(value, (list, dict)) and value:
+            value_emptied = TruncatedList() if isinstance(value, list) else TruncatedDict()
+            value_emptied.truncated_count = getattr(value, 'truncated_count', 0) + len(value)
+            value = value_emptied
+
+        emptied[section] = value
+
+    return emptied
+
+
+def _render_within(template, context, max_bytes):
+    """
+    Renders a template, streaming its output and stopping as soon as it exceeds max_bytes
+
+    :param template: Compiled template
+    :param context: Rendering context
+    :param max_bytes: Maximum size of the rendered report
+    :return: Rendered report, or None if it exceeds max_bytes
+    """
+    chunks = []
+    size = 0
+    for chunk in template.generate(context):
+        size += len(chunk.encode('utf-8'))
+        if size > max_bytes:
+            return None
+
+        chunks.append(chunk)
+
+    return ''.join(chunks)
+
+
+def render_template(html_template, context, max_bytes):
+    """
+    Renders a template within max_bytes. A report exceeding it is cut on its data rather than on its markup:
+    it is rendered again with half the items per report section until it fits, then with the sections
+    emptied, so the rendered HTML and the scripts of the template stay complete. Each rendering stops as
+    soon as it exceeds max_bytes, so oversized reports are never built in full
+
+    :param html_template: A string representing the HTML template
+    :param context: Rendering context
+    :param max_bytes: Maximum size of the rendered report. 0 means unlimited
+    :return: Rendered report
+    """
+    template = get_compiled_template(html_template)
+    if not max_bytes:
         rendered = template.render(context)
+        metrics.inc('iris_vt_render_bytes_total', len(rendered.encode('utf-8')))
+        return rendered
 
-    except Exception:
-        log.error(traceback.format_exc())
-        return IrisInterfaceStatus.I2Error(traceback.format_exc())
+    results = context.get('results')
+    sections = [value for value in results.values() if isinstance(value, (list, dict))] \
+        if isinstance(results, dict) else []
+    max_items = max((len(section) for section in sections), default=0)
+
+    rendered = _render_within(template, context, max_bytes)
+    if rendered is not None:
+        metrics.inc('iris_vt_render_bytes_total', len(rendered.encode('utf-8')))
+        return rendered
 
-    return IrisInterfaceStatus.I2Success(data=rendered)
+    while rendered is None and max_items:
+        max_items //= 2
+        bounded = bound_report_sections(results, max_items) if max_items else _empty_report_sections(results)
+        rendered = _render_within(template, dict(context, results=bounded), max_bytes)
 
+    if rendered is None:
+        log.warning(f'Rendered report exceeds {max_bytes} bytes without its sections. Not rendered')
+        rendered = f'<p><i>Report not rendered, exceeding {max_bytes} bytes</i></p>'
+    else:
+        log.warning(f'Rendered report exceeds {max_bytes} bytes. Rendered with {max_items} items per section')
 
-def gen_ip_report_from_template(html_template, vt_report) -> IrisInterfaceStatus:
+    metrics.inc('iris_vt_render_bytes_total', len(rendered.encode('utf-8')))
+    return rendered
+
+
+def get_template_digest(html_template):
     """
-    Generates an HTML report for IP, displayed as an attribute in the IOC
+    Returns the digest identifying the content of a template
 
     :param html_template: A string representing the HTML template
+    :return: Hex digest
+    """
+    return hashlib.sha256(html_template.encode('utf-8')).hexdigest()
+
+
+def get_report_digest(vt_report):
+    """
+    Returns the digest identifying the content of a VT report
+
     :param vt_report: The JSON report fetched with VT API
+    :return: Hex digest
+    """
+    return hashlib.sha256(json.dumps(vt_report.get('results'), sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_compiled_template(html_template):
+    """
+    Returns the compiled version of a template, compiling it on first use
+
+    :param html_template: A string representing the HTML template
+    :return: jinja2 Template
+    """
+    digest = get_template_digest(html_template)
+
+    template = _compiled_templates.get(digest)
+    if template is not None:
+        return template
+
+    template = _get_jinja_env().from_string(html_template)
+
+    with _compiled_templates_lock:
+        if len(_compiled_templates) >= MAX_COMPILED_TEMPLATES:
+            _compiled_templates.pop(next(iter(_compiled_templates)))
+        _compiled_templates[digest] = template
+
+    return template
+
+
+class RenderedReportCache(object):
+    """
+    LRU cache of rendered reports of a worker, keyed by (IOC kind, report digest, template digest, rendering
+    limits), so an unchanged report rendered with an unchanged template is reused as is. The cache is bounded
+    by the total length of the reports it holds, least recently used reports are evicted first
+    """
+    def __init__(self, max_size):
+        """
+        :param max_size: Maximum total length of the cached reports, in characters
+        """
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._reports = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns a cached rendered report, and counts the hit or miss
+
+        :param key: Key of the rendered report
+        :return: Rendered report or None
+        """
+        with self._lock:
+            rendered = self._reports.get(key)
+            if rendered is None:
+                self.misses += 1
+                return None
+
+            self._reports.move_to_end(key)
+            self.hits += 1
+
+        return rendered
+
+    def set(self, key, rendered):
+        """
+        Caches a rendered report, evicting the least recently used ones beyond the size limit. Reports larger
+        than the whole cache are not cached
+
+        :param key: Key of the rendered report
+        :param rendered: Rendered report
+        :return: Nothing
+        """
+        if len(rendered) > self.max_size:
+            return
+
+        with self._lock:
+            previous = self._reports.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+
+            self._reports[key] = rendered
+            self.size += len(rendered)
+
+            while self.size > self.max_size:
+                _, evicted = self._reports.popitem(last=False)
+                self.size -= len(evicted)
+
+    def format_stats(self):
+        """
+        Returns the counters of the cache, for logging
+
+        :return: String
+        """
+        return (f'Rendered reports cache: {self.hits} hits, {self.misses} misses, {len(self._reports)} reports, '
+                f'{self.size // 1024}KB')
+
+
+def get_rendered_report_cache(mod_config):
+    """
+    Returns the rendered reports cache of the worker matching the module configuration, or None if disabled
+
+    :param mod_config: Module configuration
+    :return: RenderedReportCache or None
+    """
+    max_size = int(mod_config.get('vt_render_cache_max_mb') or 0) * 1048576
+    if max_size <= 0:
+        return None
+
+    with _rendered_caches_lock:
+        cache = _rendered_caches.get(max_size)
+        if cache is None:
+            cache = RenderedReportCache(max_size)
+            _rendered_caches[max_size] = cache
+
+    return cache
+
+
+def validate_templates(mod_config) -> IrisInterfaceStatus:
+    """
+    Compiles the report templates of the configuration, so syntax errors are reported when the module
+    registers instead of on each IOC. The default templates ship with the module and are skipped, so
+    registering with them doesn't load Jinja
+
+    :param mod_config: Module configuration
     :return: IrisInterfaceStatus
     """
-    template = Template(html_template)
-    context = vt_report
-    results = context.get('results')
+    defaults = {param['param_name']: param['default'] for param in interface_conf.module_configuration}
 
-    context["avg_urls_detect_ratio"], _, context["nb_detected_urls"] = get_detected_urls_ratio(results)
+    errors = []
+    for param_name in ['vt_domain_report_template', 'vt_ip_report_template', 'vt_hash_report_template']:
+        html_template = mod_config.get(param_name)
+        if not html_template or html_template == defaults.get(param_name):
+            continue
 
-    if "detected_communicating_samples" in results:
-        context["nb_detected_samples"] = len(results["detected_communicating_samples"])
-        count_total = 0
-        count_positives = 0
+        from jinja2 import TemplateSyntaxError
 
-        for samples in results["detected_communicating_samples"]:
-            count_total += samples.get('total')
-            count_positives += samples.get('positives')
+        try:
+            get_compiled_template(html_template)
 
-        if context['nb_detected_samples'] > 0:
-            context["avg_samples_detect_ratio"] = f"{round(count_positives/context['nb_detected_samples'], 2)} / " \
-                                                  f"{count_total/context['nb_detected_samples']}"
-        else:
-            context["avg_samples_detect_ratio"] = "No information"
+        except TemplateSyntaxError as e:
+            errors.append(f'{param_name}: line {e.lineno}: {e.message}')
 
-    try:
+    if errors:
+        return error_status(message='Invalid report templates', data=errors)
 
-        rendered = template.render(context)
+    return success_status()
 
-    except Exception:
-        print(traceback.format_exc())
-        log.error(traceback.format_exc())
-        return IrisInterfaceStatus.I2Error(traceback.format_exc())
 
-    return IrisInterfaceStatus.I2Success(data=rendered)
+def get_detected_urls_ratio(report):
+    """
+    Returns the detection statistics of the detected URLs of a report
+
+    :param report: Results of a VT report
+    :return: Average detection as displayed, detection ratio in percent, number of detected URLs
+    """
+    detected_urls = VtReportModel.from_results(report).detected_urls
+    if detected_urls is None:
+        return "No information", None, None
+
+    return detected_urls.get_average_str(), detected_urls.get_ratio(), detected_urls.count
 
 
-def gen_hash_report_from_template(html_template, vt_report) -> IrisInterfaceStatus:
+def _gen_report_from_template(html_template, vt_report, max_items, max_bytes, context):
     """
-    Generates an HTML report for hash, displayed as an attribute in the IOC
+    Renders a report template with the report and its statistics as context
 
     :param html_template: A string representing the HTML template
     :param vt_report: The JSON report fetched with VT API
+    :param max_items: Maximum number of items rendered per report section. 0 means unlimited
+    :param max_bytes: Maximum size of the rendered report. 0 means unlimited
+    :param context: Statistics of the report
     :return: IrisInterfaceStatus
     """
-    template = Template(html_template)
-    context = vt_report
+    context.update(vt_report)
+    context['results'] = bound_report_sections(vt_report.get('results'), max_items)
 
     try:
 
-        rendered = template.render(context)
+        rendered = render_template(html_template, context, max_bytes)
 
     except Exception:
-        print(traceback.format_exc())
         log.error(traceback.format_exc())
-        return IrisInterfaceStatus.I2Error(traceback.format_exc())
+        return error_status(traceback.format_exc())
+
+    return success_status(data=rendered)
+
+
+def gen_domain_report_from_template(html_template, vt_report, max_items=0, max_bytes=0,
+                                    model=None) -> IrisInterfaceStatus:
+    """
+    Generates an HTML report for domains, displayed as an attribute in the IOC
+
+    :param html_template: A string representing the HTML template
+    :param vt_report: The JSON report fetched with VT API
+    :param max_items: Maximum number of items rendered per report section. 0 means unlimited
+    :param max_bytes: Maximum size of the rendered report. 0 means unlimited
+    :param model: VtReportModel of the report if already built
+    :return: IrisInterfaceStatus
+    """
+    if model is None:
+        model = VtReportModel.from_results(vt_report.get('results'))
+
+    return _gen_report_from_template(html_template, vt_report, max_items, max_bytes,
+                                     model.get_template_context(model.downloaded_samples))
+
+
+def gen_ip_report_from_template(html_template, vt_report, max_items=0, max_bytes=0,
+                                model=None) -> IrisInterfaceStatus:
+    """
+    Generates an HTML report for IP, displayed as an attribute in the IOC
+
+    :param html_template: A string representing the HTML template
+    :param vt_report: The JSON report fetched with VT API
+    :param max_items: Maximum number of items rendered per report section. 0 means unlimited
+    :param max_bytes: Maximum size of the rendered report. 0 means unlimited
+    :param model: VtReportModel of the report if already built
+    :return: IrisInterfaceStatus
+    """
+    if model is None:
+        model = VtReportModel.from_results(vt_report.get('results'))
+
+    return _gen_report_from_template(html_template, vt_report, max_items, max_bytes,
+                                     model.get_template_context(model.communicating_samples))
+
+
+def gen_hash_report_from_template(html_template, vt_report, max_items=0, max_bytes=0,
+                                  model=None) -> IrisInterfaceStatus:
+    """
+    Generates an HTML report for hash, displayed as an attribute in the IOC
+
+    :param html_template: A string representing the HTML template
+    :param vt_report: The JSON report fetched with VT API
+    :param max_items: Maximum number of items rendered per report section. 0 means unlimited
+    :param max_bytes: Maximum size of the rendered report. 0 means unlimited
+    :param model: VtReportModel of the report if already built
+    :return: IrisInterfaceStatus
+    """
+    if model is None:
+        model = VtReportModel.from_results(vt_report.get('results'))
 
-    return IrisInterfaceStatus.I2Success(data=rendered)
\ No newline at end of file
+    return _gen_report_from_template(html_template, vt_report, max_items, max_bytes,
+                                     {'engine_detections': model.engine_detections})
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+#
+#  IRIS VT Module Source Code
+#  contact@dfir-iris.org
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+import logging
+import random
+import threading
+import time
+
+from iris_vt_module.vt_handler.vt_ratelimit import build_rate_limiter
+
+log = logging.getLogger('iris_vt_module.vt_keypool')
+
+# Responses of VT meaning the key is refused, as opposed to rate limited
+AUTH_FAILURE_STATUSES = (401, 403)
+
+
+class VtApiKey(object):
+    """
+    VT API key of a pool, with its own quota tracking and cooldown
+    """
+    def __init__(self, api_key, is_premium, rate_limiter, weight):
+        self.api_key = api_key
+        self.is_premium = is_premium
+        self.rate_limiter = rate_limiter
+        self.weight = weight
+        self.cooldown_until = 0
+        # True while the last response to a request sent with the key was an authentication failure
+        self.auth_failed = False
+
+    @property
+    def label(self):
+        """
+        Name of the key in logs, without disclosing it
+        """
+        return f'...{(self.api_key or "")[-4:]}'
+
+    def get_cooldown(self):
+        """
+        Returns the remaining cooldown of the key
+
+        :return: Seconds, 0 if the key can be used
+        """
+        return max(self.cooldown_until - time.monotonic(), 0)
+
+
+class VtKeyPool(object):
+    """
+    Spreads the lookups over several VT API keys. It exposes the same interface as VtRateLimiter, so
+    clients and the deferred worker use a single key or a pool the same way, except that acquire returns
+    the key the request must be sent with. Keys with a free request slot are picked with a weighted random
+    choice, premium keys weighing more so public keys quotas are kept for bursts. Keys VT answers with a
+    quota exceeded or an authentication failure are cooled down and skipped until the cooldown is over
+    """
+    def __init__(self, keys, quota_cooldown, auth_cooldown):
+        self.keys = keys
+        self.quota_cooldown = quota_cooldown
+        self.auth_cooldown = auth_cooldown
+        self._lock = threading.Lock()
+
+    @property
+    def file_report_batch_size(self):
+        """
+        Number of resources VT accepts in a single file report request, whatever the key picked
+        """
+        return 25 if all(key.is_premium for key in self.keys) else 4
+
+    def _get_candidates(self):
+        """
+        Returns the keys which are not cooling down, in a weighted random order
+
+        :return: List of VtApiKey
+        """
+        candidates = [key for key in self.keys if not key.get_cooldown()]
+        # Weighted random permutation, each key ordered by a draw biased by its weight
+        candidates.sort(key=lambda key: random.random() ** (1.0 / key.weight), reverse=True)
+        return candidates
+
+    def try_acquire(self):
+        """
+        Takes a request slot on one of the keys
+
+        :return: Tuple (key, wait). Key is None if no slot was taken, and wait the number of seconds
+                 to wait before trying again
+        """
+        waits = [key.get_cooldown() for key in self.keys if key.get_cooldown()]
+
+        for key in self._get_candidates():
+            key_wait = key.rate_limiter.try_acquire()
+            if not key_wait:
+                return key, 0
+
+            waits.append(key_wait)
+
+        return None, min(waits)
+
+    def acquire(self, max_wait):
+        """
+        Waits for one of the keys to allow a new request, for at most max_wait seconds
+
+        :param max_wait: Maximum number of seconds to wait
+        :return: VtApiKey to send the request with, or None if the deadline would be exceeded
+        """
+        deadline = time.monotonic() + max_wait
+
+        while True:
+            key, wait = self.try_acquire()
+            if key is not None:
+                return key
+
+            if time.monotonic() + wait > deadline:
+                return None
+
+            time.sleep(wait)
+
+    async def acquire_async(self, max_wait):
+        """
+        Same as acquire, for the asyncio engine. Waiting doesn't block the event loop
+
+        :param max_wait: Maximum number of seconds to wait
+        :return: VtApiKey to send the request with, or None if the deadline would be exceeded
+        """
+        import asyncio
+
+        deadline = time.monotonic() + max_wait
+
+        while True:
+            key, wait = self.try_acquire()
+            if key is not None:
+                return key
+
+            if time.monotonic() + wait > deadline:
+                return None
+
+            await asyncio.sleep(wait)
+
+    def notify_response(self, key, status_code):
+        """
+        Updates the state of a key after a VT response. Quota exceeded responses empty the minute
+        bucket of the key and, when other keys can take over, cool it down. Authentication failures
+        cool the key down for longer
+
+        :param key: VtApiKey the request was sent with
+        :param status_code: HTTP status of the response
+        :return: Nothing
+        """
+        key.auth_failed = status_code in AUTH_FAILURE_STATUSES
+
+        if status_code == 204:
+            key.rate_limiter.notify_quota_exceeded()
+            if len(self.keys) == 1:
+                return
+
+            cooldown = self.quota_cooldown
+            reason = 'quota exceeded'
+
+        elif status_code in AUTH_FAILURE_STATUSES:
+            cooldown = self.auth_cooldown
+            reason = 'authentication failure'
+
+        else:
+            return
+
+        if cooldown:
+            log.warning(f'VT key {key.label}: {reason}, cooled down for {cooldown} seconds')
+            with self._lock:
+                key.cooldown_until = max(key.cooldown_until, time.monotonic() + cooldown)
+
+    def is_refused(self):
+        """
+        Returns True if VT refused every key of the pool and all of them are cooling down, in which case
+        no slot can be taken until a key is fixed or its cooldown is over, whatever the quota left
+
+        :return: Bool
+        """
+        return all(key.auth_failed and key.get_cooldown() for key in self.keys)
+
+    def get_wait_time(self):
+        """
+        Returns the number of seconds to wait before a request can be issued on any key, without taking a slot
+
+        :return: Seconds to wait, 0 if a request can be issued now
+        """
+        return min(max(key.get_cooldown(), key.rate_limiter.get_wait_time()) for key in self.keys)
+
+    def get_remaining(self):
+        """
+        Returns the remaining quota of each window, summed over the keys which are not cooling down.
+        None means unlimited
+
+        :return: Dict
+        """
+        remaining = {}
+        for key in self.keys:
+            key_remaining = key.rate_limiter.get_remaining()
+            for window, value in key_remaining.items():
+                if key.get_cooldown():
+                    value = 0
+                if window not in remaining:
+                    remaining[window] = value
+                elif remaining[window] is not None:
+                    remaining[window] = None if value is None else remaining[window] + value
+
+        return remaining
+
+
+def get_api_keys(mod_config):
+    """
+    Returns the API keys of the module configuration: the main key, then the additional keys. Additional
+    keys are comma-separated, a key suffixed with :premium being a premium key
+
+    :param mod_config: Module configuration
+    :return: Tuple of (API key, is premium)
+    """
+    keys = [(mod_config.get('vt_api_key'), bool(mod_config.get('vt_key_is_premium')))]
+
+    for entry in (mod_config.get('vt_additional_api_keys') or '').split(','):
+        api_key, _, key_type = entry.strip().partition(':')
+        if api_key:
+            keys.append((api_key, key_type.strip().lower() == 'premium'))
+
+    return tuple(keys)
+
+
+def build_key_pool(mod_config, api_keys):
+    """
+    Builds the key pool of the module configuration, each key with its own rate limiter
+
+    :param mod_config: Module configuration
+    :param api_keys: Keys returned by get_api_keys
+    :return: VtKeyPool
+    """
+    premium_weight = float(mod_config.get('vt_premium_key_weight') or 1)
+    keys = [VtApiKey(api_key, is_premium, build_rate_limiter(mod_config, api_key, is_premium),
+                     premium_weight if is_premium else 1.0)
+            for api_key, is_premium in api_keys]
+
+    return VtKeyPool(keys,
+                     quota_cooldown=float(mod_config.get('vt_key_quota_cooldown') or 0),
+                     auth_cooldown=float(mod_config.get('vt_key_auth_cooldown') or 0))
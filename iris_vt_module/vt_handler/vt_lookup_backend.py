@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+#
+#  IRIS VT Module Source Code
+#  contact@dfir-iris.org
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+from abc import ABC, abstractmethod
+
+
+class VtLookupBackend(ABC):
+    """
+    Interface of the backends VtHandler fetches reports from. Reports are returned in the
+    format of the virustotal-api package, i.e. dicts with results and/or error and response_code
+    """
+    # Number of hashes accepted by a single get_file_report call
+    file_report_batch_size = 1
+
+    # Rate limiter of the backend, None if the backend has no quota
+    rate_limiter = None
+
+    # Circuit breaker of the backend, None if the backend is local
+    breaker = None
+
+    @abstractmethod
+    def get_ip_report(self, this_ip):
+        """
+        Get IP address report
+
+        :param this_ip: IP address
+        :return: VT report dict
+        """
+
+    @abstractmethod
+    def get_domain_report(self, this_domain):
+        """
+        Get domain report
+
+        :param this_domain: Domain name
+        :return: VT report dict
+        """
+
+    @abstractmethod
+    def get_file_report(self, resource):
+        """
+        Get file report
+
+        :param resource: Hash of the file, or comma-separated list of up to file_report_batch_size hashes
+        :return: VT report dict. Results is a list when several hashes are requested
+        """
+
+
+def is_not_found(results):
+    """
+    Returns True if the results of a report tell the indicator is unknown
+
+    :param results: Results of a VT report
+    :return: Bool
+    """
+    return not results or results.get('response_code') == 0
+
+
+class VtChainedBackend(VtLookupBackend):
+    """
+    Tries a first backend, typically the local mirror, and falls back to a second one,
+    typically the VT API, for the indicators the first one doesn't know
+    """
+    def __init__(self, primary, fallback):
+        self.primary = primary
+        self.fallback = fallback
+        self.file_report_batch_size = fallback.file_report_batch_size
+        self.rate_limiter = fallback.rate_limiter
+        self.breaker = fallback.breaker
+
+    def _chain(self, method_name, value):
+        report = getattr(self.primary, method_name)(value)
+        if not is_not_found(report.get('results')):
+            return report
+
+        return getattr(self.fallback, method_name)(value)
+
+    def get_ip_report(self, this_ip):
+        return self._chain('get_ip_report', this_ip)
+
+    def get_domain_report(self, this_domain):
+        return self._chain('get_domain_report', this_domain)
+
+    def get_file_report(self, resource):
+        hashes = [resource_hash.strip() for resource_hash in resource.split(',')]
+
+        results = []
+        missing = []
+        for resource_hash in hashes:
+            result = self.primary.get_file_report(resource_hash).get('results')
+            if is_not_found(result):
+                missing.append(resource_hash)
+            results.append(result)
+
+        if not missing:
+            return dict(results=results if len(hashes) > 1 else results[0], response_code=200)
+
+        report = self.fallback.get_file_report(','.join(missing))
+        fallback_results = report.get('results')
+        if not fallback_results:
+            if len(missing) == len(hashes):
+                return report
+            # Keep what the primary knows, the others stay unknown
+            fallback_results = [None] * len(missing)
+
+        elif isinstance(fallback_results, dict):
+            fallback_results = [fallback_results]
+
+        fallback_results = dict(zip(missing, fallback_results))
+        results = [fallback_results.get(resource_hash) if is_not_found(result) and fallback_results.get(resource_hash)
+                   else result for resource_hash, result in zip(hashes, results)]
+
+        return dict(results=results if len(hashes) > 1 else results[0], response_code=200)
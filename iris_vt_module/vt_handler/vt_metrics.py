@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+#
+#  IRIS VT Module Source Code
+#  contact@dfir-iris.org
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+import atexit
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+
+# Stages of the enrichment of an IOC, in processing order
+STAGES = ('lookup', 'validate', 'tagging', 'render', 'write')
+
+# Files written to the textfile collector directory, one per worker
+TEXTFILE_NAME = re.compile(r'iris_vt_module_(\d+)\.prom$')
+
+# Exported metrics, with their Prometheus type and help
+METRICS = {
+    'iris_vt_hooks_total': ('counter', 'Hooks processed, by hook'),
+    'iris_vt_hook_seconds_total': ('counter', 'Time spent processing hooks, by hook'),
+    'iris_vt_iocs_total': ('counter', 'IOCs processed, by IOC kind and outcome'),
+    'iris_vt_skipped_total': ('counter', 'IOCs skipped without lookup, by hook and reason'),
+    'iris_vt_lookups_total': ('counter', 'Reports fetched from the lookup backend, by IOC kind'),
+    'iris_vt_cache_hits_total': ('counter', 'Reports served by the report cache, by IOC kind'),
+    'iris_vt_negative_cache_hits_total': ('counter', 'Lookups skipped as the indicator was recently unknown to VT'),
+    'iris_vt_prewarmed_total': ('counter', 'Sample reports cached in the free slots of batched hash requests'),
+    'iris_vt_errors_total': ('counter', 'IOC enrichments failed, by IOC kind and stage'),
+    'iris_vt_quota_exhausted_total': ('counter', 'Lookups refused for quota, by source (api or limiter)'),
+    'iris_vt_auth_failures_total': ('counter', 'Lookups refused as the API key failed authentication, by source '
+                                               '(api or pool)'),
+    'iris_vt_response_bytes_total': ('counter', 'Bytes of VT responses received'),
+    'iris_vt_render_bytes_total': ('counter', 'Bytes of reports rendered'),
+    'iris_vt_render_cache_hits_total': ('counter', 'Rendered reports reused from the cache, by IOC kind'),
+    'iris_vt_render_cache_misses_total': ('counter', 'Reports rendered as not found in the cache, by IOC kind'),
+    'iris_vt_stage_seconds_total': ('counter', 'Time spent in each enrichment stage'),
+    'iris_vt_stage_iocs_total': ('counter', 'Number of IOCs timed in each enrichment stage'),
+    'iris_vt_retries_total': ('counter', 'VT requests retried after a transient failure'),
+    'iris_vt_breaker_rejections_total': ('counter', 'Lookups rejected while the circuit breaker is open'),
+    'iris_vt_deferred_queue_depth': ('gauge', 'IOCs in the deferred enrichment queue, by status')
+}
+
+
+def is_process_alive(pid):
+    """
+    Returns True if a process of the host has the given PID
+
+    :param pid: PID
+    :return: Bool
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Process of another user
+        return True
+
+    return True
+
+
+def escape_label_value(value):
+    """
+    Escapes a label value for the Prometheus text format
+
+    :param value: Label value
+    :return: String
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class _StageTimer(object):
+    def __init__(self, timings, stage):
+        self.timings = timings
+        self.stage = stage
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timings.add(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class IocTimings(object):
+    """
+    Timing breakdown of the enrichment of a single IOC
+    """
+    __slots__ = ('durations',)
+
+    def __init__(self):
+        self.durations = {}
+
+    def stage(self, stage):
+        """
+        Times a stage of the enrichment
+
+            with timings.stage('render'):
+                ...
+
+        :param stage: Name of the stage, one of STAGES
+        :return: Context manager
+        """
+        return _StageTimer(self, stage)
+
+    def add(self, stage, seconds):
+        self.durations[stage] = self.durations.get(stage, 0) + seconds
+
+    def get_total(self):
+        return sum(self.durations.values())
+
+    def format(self):
+        """
+        Formats the breakdown for logs
+
+        :return: String such as "lookup 120.4ms, validate 0.1ms, render 3.2ms"
+        """
+        return ', '.join(f'{stage} {self.durations[stage] * 1000:.1f}ms' for stage in STAGES
+                         if stage in self.durations)
+
+
+class VtMetrics(object):
+    """
+    Cumulative counters and gauges of a worker, exported in the Prometheus text format
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = defaultdict(float)
+        self._textfiles = set()
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increments a counter
+
+        :param name: Name of the metric, one of METRICS
+        :param value: Increment
+        :param labels: Labels of the counter
+        :return: Nothing
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] += value
+
+    def set(self, name, value, **labels):
+        """
+        Sets a gauge
+
+        :param name: Name of the metric, one of METRICS
+        :param value: Value
+        :param labels: Labels of the gauge
+        :return: Nothing
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = value
+
+    def observe_timings(self, timings):
+        """
+        Adds the timing breakdown of an IOC to the stage counters
+
+        :param timings: IocTimings
+        :return: Nothing
+        """
+        for stage, seconds in timings.durations.items():
+            self.inc('iris_vt_stage_seconds_total', seconds, stage=stage)
+            self.inc('iris_vt_stage_iocs_total', stage=stage)
+
+    def get_value(self, name, **labels):
+        with self._lock:
+            return self._values.get((name, tuple(sorted(labels.items()))), 0)
+
+    def render_prometheus(self, **extra_labels):
+        """
+        Renders the counters in the Prometheus text exposition format
+
+        :param extra_labels: Labels added to every sample, such as the worker
+        :return: String
+        """
+        with self._lock:
+            values = sorted(self._values.items())
+
+        lines = []
+        for name, (metric_type, metric_help) in METRICS.items():
+            samples = [(labels, value) for (metric_name, labels), value in values if metric_name == name]
+            if not samples:
+                continue
+
+            lines.append(f'# HELP {name} {metric_help}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for labels, value in samples:
+                labels = dict(labels, **extra_labels)
+                label_str = ','.join(f'{label}="{escape_label_value(label_value)}"'
+                                     for label, label_value in sorted(labels.items()))
+                lines.append(f'{name}{{{label_str}}} {value!r}' if label_str else f'{name} {value!r}')
+
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, directory):
+        """
+        Writes the counters of this worker to a file of a node_exporter textfile collector directory.
+        Each worker writes its own file, labelled with its PID, so workers don't overwrite each other.
+        The file is removed when the worker exits, and the files left by workers which died without
+        removing theirs are pruned
+
+        :param directory: Directory read by the textfile collector
+        :return: Path of the file written
+        """
+        pid = os.getpid()
+        path = os.path.join(directory, f'iris_vt_module_{pid}.prom')
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+
+        with open(tmp_path, 'w') as textfile:
+            textfile.write(self.render_prometheus(worker=pid))
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if not self._textfiles:
+                atexit.register(self.remove_textfiles)
+            self._textfiles.add(path)
+
+        self._prune_textfiles(directory)
+
+        return path
+
+    @staticmethod
+    def _prune_textfiles(directory):
+        """
+        Removes the files of the workers which are no longer running
+
+        :param directory: Directory read by the textfile collector
+        :return: Nothing
+        """
+        for name in os.listdir(directory):
+            match = TEXTFILE_NAME.match(name)
+            if match is None or is_process_alive(int(match.group(1))):
+                continue
+
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                # Pruned by another worker
+                pass
+
+    def remove_textfiles(self):
+        """
+        Removes the files written by this worker, so its counters stop being exported once it exits
+
+        :return: Nothing
+        """
+        with self._lock:
+            textfiles, self._textfiles = self._textfiles, set()
+
+        for path in textfiles:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+# Counters of this worker, shared by all the hooks it processes
+metrics = VtMetrics()
@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+#
+#  IRIS VT Module Source Code
+#  contact@dfir-iris.org
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+import glob
+import hashlib
+import heapq
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+
+from iris_vt_module.vt_handler.vt_cache import DEFAULT_CACHE_PATH, ensure_private_directory, normalize_ioc_value, \
+    IOC_KIND_DOMAIN, IOC_KIND_HASH, IOC_KIND_IP
+from iris_vt_module.vt_handler.vt_lookup_backend import VtLookupBackend
+
+log = logging.getLogger(__name__)
+
+INDEX_FILE = 'vt_mirror.idx'
+INDEX_MANIFEST = 'vt_mirror.idx.json'
+INDEX_VERSION = 1
+
+# Index entry: 64 bits key fingerprint, dump file number, offset and length of the line
+INDEX_ENTRY = struct.Struct('<QIQI')
+# Same entry while the index is built. Big endian, so sorting packed entries sorts them by fingerprint, then
+# in the dumps order
+SORT_ENTRY = struct.Struct('>QIQI')
+# Number of entries sorted in memory. Larger dumps are sorted in runs spilled to disk, then merged
+INDEX_RUN_ENTRIES = 500000
+
+# Fields of a dump line holding the indicators it describes
+HASH_FIELDS = ('md5', 'sha1', 'sha256')
+IP_FIELDS = ('ip', 'ip_address')
+DOMAIN_FIELDS = ('domain',)
+
+
+def get_key_fingerprint(ioc_kind, value):
+    """
+    Returns the 64 bits fingerprint of an indicator in the index
+
+    :param ioc_kind: Kind of the IOC (ip, domain, hash)
+    :param value: Normalized value of the IOC
+    :return: Int
+    """
+    digest = hashlib.blake2b(f'{ioc_kind}:{value}'.encode('utf-8'), digest_size=8).digest()
+    return struct.unpack('<Q', digest)[0]
+
+
+def get_line_keys(record):
+    """
+    Returns the indicators a dump line describes. Lines are VT reports results, completed
+    with an ip or domain field for IP and domain reports, as those don't name their subject
+
+    :param record: Decoded dump line
+    :return: List of (IOC kind, normalized value)
+    """
+    keys = []
+    for field in DOMAIN_FIELDS:
+        if record.get(field):
+            keys.append((IOC_KIND_DOMAIN, normalize_ioc_value(IOC_KIND_DOMAIN, record[field])))
+
+    for field in IP_FIELDS:
+        if record.get(field):
+            keys.append((IOC_KIND_IP, normalize_ioc_value(IOC_KIND_IP, record[field])))
+
+    for field in HASH_FIELDS:
+        if record.get(field):
+            keys.append((IOC_KIND_HASH, normalize_ioc_value(IOC_KIND_HASH, record[field])))
+
+    return keys
+
+
+def list_dump_files(mirror_path):
+    """
+    Lists the JSONL dumps of a mirror directory, in a stable order
+
+    :param mirror_path: Directory of the mirror
+    :return: List of paths
+    """
+    return sorted(glob.glob(os.path.join(mirror_path, '*.jsonl')))
+
+
+def get_dumps_manifest(dump_files):
+    """
+    Describes the dumps an index is built from, to detect when it needs to be rebuilt
+
+    :param dump_files: List of dump paths
+    :return: Dict
+    """
+    files = []
+    for dump_file in dump_files:
+        stat = os.stat(dump_file)
+        files.append([os.path.basename(dump_file), stat.st_size, stat.st_mtime_ns])
+
+    return {'version': INDEX_VERSION, 'files': files}
+
+
+def _iter_run(run_path):
+    """
+    Iterates the packed entries of a sorted run
+
+    :param run_path: Path of the run
+    :return: Generator of SORT_ENTRY packed entries
+    """
+    with open(run_path, 'rb') as run:
+        while True:
+            entry = run.read(SORT_ENTRY.size)
+            if not entry:
+                return
+            yield entry
+
+
+def get_index_directory(mod_config, mirror_path):
+    """
+    Returns the directory holding the index of a mirror, next to the report cache. The dumps directory
+    is usually read-only, so the index is kept in the private databases directory, one per mirror
+
+    :param mod_config: Module configuration
+    :param mirror_path: Directory of the mirror
+    :return: Path of the index directory
+    """
+    mirrors_directory = os.path.join(os.path.dirname(mod_config.get('vt_cache_path') or DEFAULT_CACHE_PATH),
+                                     'vt_mirror')
+    mirror_id = hashlib.sha256(os.path.abspath(mirror_path).encode('utf-8')).hexdigest()[:16]
+
+    # The parent directory is shared with the other databases, it is checked as well
+    ensure_private_directory(os.path.dirname(mirrors_directory) or '.')
+    ensure_private_directory(mirrors_directory)
+    ensure_private_directory(os.path.join(mirrors_directory, mirror_id))
+
+    return os.path.join(mirrors_directory, mirror_id)
+
+
+def build_mirror_index(mirror_path, index_directory):
+    """
+    Builds the index of the JSONL dumps of a mirror directory. The index is a sorted array of fixed
+    size entries, which is memory mapped and binary searched on lookup, so that only the pages
+    touched are loaded and the dumps are never held in memory. Entries are sorted as packed bytes,
+    in runs of INDEX_RUN_ENTRIES merged from disk, so building takes bounded memory whatever the dumps size
+
+    :param mirror_path: Directory of the mirror
+    :param index_directory: Directory the index, its runs and manifest are written to
+    :return: Number of indexed entries
+    """
+    # Workers may build the index concurrently, each writes its own files and the last one wins
+    tmp_suffix = f'.{os.getpid()}.tmp'
+    index_path = os.path.join(index_directory, INDEX_FILE)
+
+    dump_files = list_dump_files(mirror_path)
+    run = []
+    run_paths = []
+
+    def spill_run():
+        run.sort()
+        run_path = f'{index_path}.run{len(run_paths)}{tmp_suffix}'
+        run_paths.append(run_path)
+        with open(run_path, 'wb') as run_file:
+            run_file.writelines(run)
+        run.clear()
+
+    count = 0
+    try:
+        for file_number, dump_file in enumerate(dump_files):
+            with open(dump_file, 'rb') as dump:
+                offset = 0
+                for line in dump:
+                    length = len(line)
+                    if line.strip():
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            log.warning(f'Skipping invalid line at offset {offset} of {dump_file}')
+                            record = None
+
+                        if isinstance(record, dict):
+                            for ioc_kind, value in get_line_keys(record):
+                                run.append(SORT_ENTRY.pack(get_key_fingerprint(ioc_kind, value), file_number,
+                                                           offset, length))
+                                if len(run) >= INDEX_RUN_ENTRIES:
+                                    spill_run()
+
+                    offset += length
+
+        # Entries of the same key keep the dumps order, so the last one is the most recent
+        if run_paths:
+            spill_run()
+            entries = heapq.merge(*[_iter_run(run_path) for run_path in run_paths])
+        else:
+            run.sort()
+            entries = run
+
+        with open(index_path + tmp_suffix, 'wb') as index:
+            for entry in entries:
+                index.write(INDEX_ENTRY.pack(*SORT_ENTRY.unpack(entry)))
+                count += 1
+        os.replace(index_path + tmp_suffix, index_path)
+
+    finally:
+        for run_path in run_paths:
+            if os.path.exists(run_path):
+                os.remove(run_path)
+
+    manifest_path = os.path.join(index_directory, INDEX_MANIFEST)
+    with open(manifest_path + tmp_suffix, 'w') as manifest:
+        json.dump(get_dumps_manifest(dump_files), manifest)
+    os.replace(manifest_path + tmp_suffix, manifest_path)
+
+    return count
+
+
+def is_index_stale(mirror_path, index_directory):
+    """
+    Returns True if the index of a mirror directory is missing or doesn't match its dumps
+
+    :param mirror_path: Directory of the mirror
+    :param index_directory: Directory of the index
+    :return: Bool
+    """
+    try:
+        with open(os.path.join(index_directory, INDEX_MANIFEST)) as manifest:
+            built_from = json.load(manifest)
+    except (OSError, ValueError):
+        return True
+
+    if not os.path.exists(os.path.join(index_directory, INDEX_FILE)):
+        return True
+
+    return built_from != get_dumps_manifest(list_dump_files(mirror_path))
+
+
+def not_found_report():
+    """
+    Report returned for indicators the mirror doesn't know, as VT does for unknown indicators
+
+    :return: VT report dict
+    """
+    return dict(results={'response_code': 0, 'verbose_msg': 'Indicator not found in the local mirror'},
+                response_code=200)
+
+
+class VtMirrorBackend(VtLookupBackend):
+    """
+    Serves reports from a local mirror of VT data, i.e. JSONL dumps of reports in a directory.
+    The index of the dumps is built on first use, and rebuilt when the dumps change
+    """
+    file_report_batch_size = 25
+
+    def __init__(self, mirror_path, index_directory):
+        self.mirror_path = mirror_path
+        self.index_directory = index_directory
+        self._lock = threading.Lock()
+        self._dump_files = []
+        self._index_file = None
+        self._index = None
+        self._count = 0
+
+        self._open()
+
+    def _open(self):
+        """
+        Builds the index if needed and maps it
+
+        :return: Nothing
+        """
+        if is_index_stale(self.mirror_path, self.index_directory):
+            log.info(f'Building VT mirror index of {self.mirror_path} in {self.index_directory}')
+            count = build_mirror_index(self.mirror_path, self.index_directory)
+            log.info(f'VT mirror index built with {count} entries')
+
+        self._dump_files = list_dump_files(self.mirror_path)
+        self._index_file = open(os.path.join(self.index_directory, INDEX_FILE), 'rb')
+        size = os.fstat(self._index_file.fileno()).st_size
+        self._count = size // INDEX_ENTRY.size
+        # Empty files can't be mapped
+        self._index = mmap.mmap(self._index_file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+
+    def _read_fingerprint(self, position):
+        return INDEX_ENTRY.unpack_from(self._index, position * INDEX_ENTRY.size)[0]
+
+    def _find_entries(self, fingerprint):
+        """
+        Binary searches the entries of a fingerprint
+
+        :param fingerprint: Key fingerprint
+        :return: List of (file number, offset, length), oldest first
+        """
+        if not self._count:
+            return []
+
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._read_fingerprint(middle) < fingerprint:
+                low = middle + 1
+            else:
+                high = middle
+
+        entries = []
+        while low < self._count:
+            entry = INDEX_ENTRY.unpack_from(self._index, low * INDEX_ENTRY.size)
+            if entry[0] != fingerprint:
+                break
+            entries.append(entry[1:])
+            low += 1
+
+        return entries
+
+    def _read_record(self, file_number, offset, length):
+        with open(self._dump_files[file_number], 'rb') as dump:
+            dump.seek(offset)
+            return json.loads(dump.read(length))
+
+    def lookup(self, ioc_kind, value):
+        """
+        Returns the most recent results the mirror holds for an indicator
+
+        :param ioc_kind: Kind of the IOC (ip, domain, hash)
+        :param value: Value of the IOC
+        :return: Results dict or None
+        """
+        value = normalize_ioc_value(ioc_kind, value)
+        with self._lock:
+            entries = self._find_entries(get_key_fingerprint(ioc_kind, value))
+
+        # Fingerprints may collide, the record is checked to really describe the indicator
+        for file_number, offset, length in reversed(entries):
+            record = self._read_record(file_number, offset, length)
+            if (ioc_kind, value) in get_line_keys(record):
+                return record
+
+        return None
+
+    def _get_report(self, ioc_kind, value):
+        results = self.lookup(ioc_kind, value)
+        if results is None:
+            return not_found_report()
+
+        return dict(results=results, response_code=200)
+
+    def get_ip_report(self, this_ip):
+        return self._get_report(IOC_KIND_IP, this_ip)
+
+    def get_domain_report(self, this_domain):
+        return self._get_report(IOC_KIND_DOMAIN, this_domain)
+
+    def get_file_report(self, resource):
+        hashes = [resource_hash.strip() for resource_hash in resource.split(',')]
+        reports = [self._get_report(IOC_KIND_HASH, resource_hash) for resource_hash in hashes]
+        if len(reports) == 1:
+            return reports[0]
+
+        return dict(results=[report['results'] for report in reports], response_code=200)
+
+    def close(self):
+        """
+        Unmaps the index
+
+        :return: Nothing
+        """
+        with self._lock:
+            if self._index is not None:
+                self._index.close()
+                self._index = None
+            if self._index_file is not None:
+                self._index_file.close()
+                self._index_file = None
+            self._count = 0
+
+
+# Mirror backends by directory, shared across hooks of a worker. The global lock only guards the dicts,
+# each mirror is opened under its own lock so building an index never holds the hooks using other mirrors
+_mirror_backends = {}
+_mirror_open_locks = {}
+_mirror_backends_lock = threading.Lock()
+
+
+def get_mirror_backend(mod_config):
+    """
+    Returns the mirror backend of the module configuration. The backend is reopened when
+    the dumps of the mirror change
+
+    :param mod_config: Module configuration
+    :return: VtMirrorBackend
+    :raise ValueError: The mirror directory is not set or doesn't exist, or its index can't be built
+    """
+    mirror_path = mod_config.get('vt_mirror_path')
+    if not mirror_path:
+        raise ValueError('vt_mirror_path must be set to use the local mirror backend')
+
+    if not os.path.isdir(mirror_path):
+        raise ValueError(f'VT mirror directory {mirror_path} not found')
+
+    index_directory = get_index_directory(mod_config, mirror_path)
+    backend_key = (mirror_path, index_directory)
+
+    with _mirror_backends_lock:
+        backend = _mirror_backends.get(backend_key)
+        open_lock = _mirror_open_locks.setdefault(backend_key, threading.Lock())
+
+    if backend is not None and not is_index_stale(mirror_path, index_directory):
+        return backend
+
+    with open_lock:
+        # The index may have been rebuilt while waiting for the lock
+        with _mirror_backends_lock:
+            backend = _mirror_backends.get(backend_key)
+
+        if backend is None or is_index_stale(mirror_path, index_directory):
+            if backend is not None:
+                backend.close()
+
+            try:
+                backend = VtMirrorBackend(mirror_path, index_directory)
+            except OSError as e:
+                # Unreadable dumps or full disk. The mirror is left out until the next hook tries again
+                log.error(f'Unable to open the VT mirror {mirror_path}. {e}')
+                with _mirror_backends_lock:
+                    _mirror_backends.pop(backend_key, None)
+                raise ValueError(f'VT mirror {mirror_path} unavailable. {e}')
+
+            with _mirror_backends_lock:
+                _mirror_backends[backend_key] = backend
+
+    return backend
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+#
+#  IRIS VT Module Source Code
+#  contact@dfir-iris.org
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+import atexit
+import hashlib
+import logging
+import mmap
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+try:
+    import fcntl
+except ImportError:
+    # Without fcntl, concurrent flushes of several workers may drop each other's entries, which
+    # only costs a lookup
+    fcntl = None
+
+from iris_vt_module.vt_handler.vt_cache import DEFAULT_CACHE_PATH, ensure_private_directory, normalize_ioc_value
+
+log = logging.getLogger('iris_vt_module.vt_negative_cache')
+
+# Number of generation files covering the TTL. An entry expires between 3/4 of the TTL and the TTL
+GENERATIONS = 4
+# Entries buffered by a worker before being merged into the current generation file
+FLUSH_SIZE = 1024
+# Maximum time an entry stays buffered in the worker which found it
+FLUSH_INTERVAL = 10
+# Interval between two scans of the directory for generation files written by other workers
+REFRESH_INTERVAL = 5
+
+GENERATION_PREFIX = 'expires_'
+GENERATION_SUFFIX = '.bin'
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_fingerprint(ioc_kind, value):
+    """
+    Returns the 64 bits fingerprint of an indicator. Collisions are negligible below billions of entries,
+    and would only make an indicator be reported as unknown until its generation expires
+
+    :param ioc_kind: Kind of the IOC (ip, domain, hash)
+    :param value: Value of the IOC
+    :return: Integer fingerprint
+    """
+    key = f'{ioc_kind}:{normalize_ioc_value(ioc_kind, value)}'.encode()
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+
+class VtNegativeCache(object):
+    """
+    Cache of the indicators VT doesn't know, so they are not looked up again on every hook until their TTL
+    expires. Indicators are stored as 64 bits fingerprints, 8 bytes each, in sorted arrays: one file per
+    generation of TTL / GENERATIONS seconds, memory-mapped and binary searched, so the page cache holds a
+    single copy shared by all the workers of the host. Files are named after the expiry time of their
+    generation and deleted as a whole once expired, whatever the TTL configured when they were written.
+
+    New entries are buffered by the worker and merged into the file of the current generation in batches.
+    Files are never modified in place: a merge writes a new file and renames it over the previous one.
+    """
+    def __init__(self, directory, ttl):
+        """
+        :param directory: Directory of the generation files
+        :param ttl: Number of seconds an indicator is remembered as unknown
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.span = ttl / GENERATIONS
+        self._lock = threading.Lock()
+        # Expiry time -> (file signature, mmap, memoryview of the fingerprints)
+        self._generations = {}
+        self._pending = set()
+        self._last_flush = time.monotonic()
+        self._last_refresh = 0
+
+        # The parent directory is shared with the other databases, it is checked as well
+        ensure_private_directory(os.path.dirname(directory) or '.')
+        ensure_private_directory(directory)
+        atexit.register(self.flush)
+
+    def _get_current_expiry(self):
+        """
+        Returns the expiry time of the entries added now, the end of the generation GENERATIONS - 1
+        generations ahead
+
+        :return: Timestamp
+        """
+        return int((time.time() // self.span + GENERATIONS) * self.span)
+
+    def contains(self, ioc_kind, value):
+        """
+        Checks whether an indicator is known to be unknown to VT
+
+        :param ioc_kind: Kind of the IOC (ip, domain, hash)
+        :param value: Value of the IOC
+        :return: True if VT didn't know the indicator within the TTL
+        """
+        fingerprint = get_fingerprint(ioc_kind, value)
+
+        with self._lock:
+            if fingerprint in self._pending:
+                return True
+
+            if time.monotonic() - self._last_refresh >= REFRESH_INTERVAL:
+                self._refresh()
+
+            return any(self._contains_sorted(fingerprints, fingerprint)
+                       for _, _, fingerprints in self._generations.values())
+
+    def add(self, ioc_kind, value):
+        """
+        Records an indicator VT doesn't know
+
+        :param ioc_kind: Kind of the IOC (ip, domain, hash)
+        :param value: Value of the IOC
+        :return: Nothing
+        """
+        with self._lock:
+            self._pending.add(get_fingerprint(ioc_kind, value))
+
+            if len(self._pending) >= FLUSH_SIZE or time.monotonic() - self._last_flush >= FLUSH_INTERVAL:
+                self._flush()
+
+    def flush(self):
+        """
+        Merges the buffered entries into the file of the current generation
+
+        :return: Nothing
+        """
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        """
+        Same as flush. Caller must hold the lock
+
+        :return: Nothing
+        """
+        self._last_flush = time.monotonic()
+        if not self._pending:
+            return
+
+        path = os.path.join(self.directory, f'{GENERATION_PREFIX}{self._get_current_expiry()}{GENERATION_SUFFIX}')
+
+        try:
+            with open(os.path.join(self.directory, 'lock'), 'a') as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+                fingerprints = array('Q')
+                try:
+                    with open(path, 'rb') as f:
+                        fingerprints.frombytes(f.read())
+                except FileNotFoundError:
+                    pass
+
+                new = sorted(fingerprint for fingerprint in self._pending
+                             if not self._contains_sorted(fingerprints, fingerprint))
+                if new:
+                    fingerprints = self._merge_sorted(fingerprints, new)
+
+                    tmp_path = f'{path}.{os.getpid()}.tmp'
+                    with open(tmp_path, 'wb') as f:
+                        f.write(fingerprints.tobytes())
+                    os.replace(tmp_path, path)
+
+        except OSError as e:
+            log.warning(f'Unable to write the negative cache to {self.directory}: {e}')
+            return
+
+        if new:
+            log.info(f'{len(new)} unknown indicators added to the negative cache, '
+                     f'{len(fingerprints)} in the current generation')
+        self._pending.clear()
+        self._refresh()
+
+    @staticmethod
+    def _merge_sorted(fingerprints, new):
+        """
+        Inserts a few fingerprints into a large sorted array. The array is copied by slices between the
+        insertion points, so the cost is a memory copy rather than a sort
+
+        :param fingerprints: Sorted array of fingerprints
+        :param new: Sorted list of fingerprints not in the array
+        :return: Sorted array of all the fingerprints
+        """
+        merged = array('Q')
+        start = 0
+        for fingerprint in new:
+            index = bisect_left(fingerprints, fingerprint, start)
+            merged.extend(fingerprints[start:index])
+            merged.append(fingerprint)
+            start = index
+
+        merged.extend(fingerprints[start:])
+
+        return merged
+
+    @staticmethod
+    def _contains_sorted(fingerprints, fingerprint):
+        """
+        Binary searches a fingerprint in a sorted array
+
+        :param fingerprints: Sorted sequence of fingerprints
+        :param fingerprint: Fingerprint searched
+        :return: True if found
+        """
+        index = bisect_left(fingerprints, fingerprint)
+        return index < len(fingerprints) and fingerprints[index] == fingerprint
+
+    def _refresh(self):
+        """
+        Maps the generation files written since the last refresh, by this worker or another one, and
+        drops the expired ones. Caller must hold the lock
+
+        :return: Nothing
+        """
+        self._last_refresh = time.monotonic()
+        now = time.time()
+
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            names = []
+
+        found = set()
+        for name in names:
+            if not (name.startswith(GENERATION_PREFIX) and name.endswith(GENERATION_SUFFIX)):
+                continue
+
+            try:
+                expires_at = int(name[len(GENERATION_PREFIX):-len(GENERATION_SUFFIX)])
+            except ValueError:
+                continue
+
+            path = os.path.join(self.directory, name)
+            if expires_at <= now:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                continue
+
+            found.add(expires_at)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            signature = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            mapped = self._generations.get(expires_at)
+            if mapped is not None and mapped[0] == signature:
+                continue
+
+            self._unmap(expires_at)
+            if stat.st_size < 8:
+                continue
+
+            try:
+                with open(path, 'rb') as f:
+                    mapped_file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                continue
+
+            length = len(mapped_file) - len(mapped_file) % 8
+            self._generations[expires_at] = (signature, mapped_file, memoryview(mapped_file)[:length].cast('Q'))
+
+        for expires_at in list(self._generations):
+            if expires_at not in found:
+                self._unmap(expires_at)
+
+    def _unmap(self, expires_at):
+        """
+        Releases the mapping of a generation file. Caller must hold the lock
+
+        :param expires_at: Expiry time of the generation
+        :return: Nothing
+        """
+        mapped = self._generations.pop(expires_at, None)
+        if mapped is not None:
+            mapped[2].release()
+            mapped[1].close()
+
+    def get_size(self):
+        """
+        Returns the number of unknown indicators remembered
+
+        :return: Number of entries, buffered ones included
+        """
+        with self._lock:
+            self._refresh()
+            return len(self._pending) + sum(len(mapped[2]) for mapped in self._generations.values())
+
+
+def get_negative_cache(mod_config):
+    """
+    Returns the negative cache of the module configuration, located next to the report cache, or None if
+    it is disabled
+
+    :param mod_config: Module configuration
+    :return: VtNegativeCache or None
+    """
+    ttl = int(mod_config.get('vt_negative_cache_ttl') or 0) * 3600
+    if not mod_config.get('vt_negative_cache_enabled') or ttl <= 0:
+        return None
+
+    directory = os.path.join(os.path.dirname(mod_config.get('vt_cache_path') or DEFAULT_CACHE_PATH),
+                             'vt_negative_cache')
+
+    with _caches_lock:
+        cache = _caches.get((directory, ttl))
+        if cache is None:
+            cache = VtNegativeCache(directory, ttl)
+            _caches[(directory, ttl)] = cache
+
+    return cache
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+#
+#  IRIS VT Module Source Code
+#  contact@dfir-iris.org
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+import ipaddress
+import logging
+import re
+import threading
+from bisect import bisect_right
+
+from iris_vt_module.vt_handler.vt_cache import normalize_ioc_value, IOC_KIND_DOMAIN, IOC_KIND_HASH, IOC_KIND_IP
+
+log = logging.getLogger('iris_vt_module.vt_preflight')
+
+# Reasons an IOC is skipped before any lookup
+SKIP_MALFORMED = 'malformed'
+SKIP_NON_ROUTABLE = 'non_routable'
+SKIP_EXCLUDED = 'excluded'
+SKIP_UNSUPPORTED_HASH = 'unsupported_hash'
+SKIP_REASONS = (SKIP_MALFORMED, SKIP_NON_ROUTABLE, SKIP_EXCLUDED, SKIP_UNSUPPORTED_HASH)
+
+# Special-purpose ranges (IANA IPv4 and IPv6 special-purpose registries) VT has nothing to say about:
+# private, shared, loopback, link-local, documentation, benchmarking, multicast and reserved addresses
+NON_ROUTABLE_NETWORKS = (
+    '0.0.0.0/8', '10.0.0.0/8', '100.64.0.0/10', '127.0.0.0/8', '169.254.0.0/16', '172.16.0.0/12',
+    '192.0.0.0/24', '192.0.2.0/24', '192.88.99.0/24', '192.168.0.0/16', '198.18.0.0/15', '198.51.100.0/24',
+    '203.0.113.0/24', '224.0.0.0/4', '240.0.0.0/4',
+    '::/128', '::1/128', '64:ff9b:1::/48', '100::/64', '2001:db8::/32', 'fc00::/7', 'fe80::/10', 'ff00::/8'
+)
+
+# Suffixes of names which never resolve on the Internet: special-use names (RFC 6761, RFC 6762, RFC 8375),
+# reverse DNS zones and suffixes commonly used for internal networks
+NON_ROUTABLE_SUFFIXES = (
+    'localhost', 'local', 'localdomain', 'invalid', 'test', 'example', 'example.com', 'example.net',
+    'example.org', 'home.arpa', 'in-addr.arpa', 'ip6.arpa', 'internal', 'intranet', 'corp', 'lan', 'home',
+    'private'
+)
+
+DOMAIN_PATTERN = re.compile(r'(?=.{1,253}$)(?:(?!-)[a-z0-9_-]{1,63}(?<!-)\.)+(?=[a-z0-9-]*[a-z])(?!-)[a-z0-9-]{2,63}'
+                            r'(?<!-)')
+# VT identifies files by md5, sha1 or sha256
+HASH_PATTERN = re.compile(r'[0-9a-f]{32}|[0-9a-f]{40}|[0-9a-f]{64}')
+# Other hex digests, such as sha224 or sha512, are well-formed but unknown to VT
+HEX_PATTERN = re.compile(r'[0-9a-f]+')
+
+_preflights = {}
+_preflights_lock = threading.Lock()
+
+
+class CidrTable(object):
+    """
+    Set of networks compiled into sorted and merged integer ranges per IP version, so membership is a
+    binary search whatever the number of networks
+    """
+    def __init__(self, networks):
+        """
+        :param networks: Iterable of ipaddress networks
+        """
+        ranges = {4: [], 6: []}
+        for network in networks:
+            ranges[network.version].append((int(network.network_address), int(network.broadcast_address)))
+
+        self._starts = {}
+        self._ends = {}
+        for version, version_ranges in ranges.items():
+            merged = []
+            for start, end in sorted(version_ranges):
+                if merged and start <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+
+            self._starts[version] = [start for start, _ in merged]
+            self._ends[version] = [end for _, end in merged]
+
+    def __contains__(self, address):
+        value = int(address)
+        index = bisect_right(self._starts[address.version], value) - 1
+        return index >= 0 and value <= self._ends[address.version][index]
+
+
+class SuffixTable(object):
+    """
+    Set of domain suffixes. A domain matches if it is one of the suffixes or a subdomain of one
+    """
+    def __init__(self, suffixes):
+        """
+        :param suffixes: Iterable of normalized domain suffixes
+        """
+        self._suffixes = frozenset(suffixes)
+
+    def __contains__(self, domain):
+        labels = domain.split('.')
+        return any('.'.join(labels[index:]) in self._suffixes for index in range(len(labels)))
+
+
+def parse_indicator_list(value):
+    """
+    Parses a configured list of networks and domain suffixes, separated by commas, spaces or new lines.
+    Entries which are not IP addresses or networks are taken as domain suffixes, *.corp.example.com
+    and .corp.example.com being read as corp.example.com
+
+    :param value: Configured list
+    :return: List of ipaddress networks, list of domain suffixes
+    """
+    networks = []
+    suffixes = []
+    for entry in re.split(r'[\s,;]+', value or ''):
+        if not entry:
+            continue
+
+        try:
+            networks.append(ipaddress.ip_network(entry, strict=False))
+        except ValueError:
+            suffixes.append(normalize_ioc_value(IOC_KIND_DOMAIN, entry.lstrip('*').lstrip('.')))
+
+    return networks, suffixes
+
+
+class VtPreflight(object):
+    """
+    Classifies IOCs before any lookup, so indicators VT can't know are skipped without spending quota:
+    malformed values, hashes of types VT doesn't index, non routable addresses and names, and indicators
+    excluded by the configuration.
+    Indicators of the allow list are never skipped as non routable or excluded
+    """
+    def __init__(self, skip_non_routable, excluded, allowed):
+        """
+        :param skip_non_routable: Skip the special-purpose addresses and internal names
+        :param excluded: Configured list of networks and domain suffixes to skip
+        :param allowed: Configured list of networks and domain suffixes never skipped
+        """
+        self.skip_non_routable = skip_non_routable
+
+        excluded_networks, excluded_suffixes = parse_indicator_list(excluded)
+        allowed_networks, allowed_suffixes = parse_indicator_list(allowed)
+
+        self.non_routable_networks = CidrTable(ipaddress.ip_network(network) for network in NON_ROUTABLE_NETWORKS)
+        self.non_routable_suffixes = SuffixTable(NON_ROUTABLE_SUFFIXES)
+        self.excluded_networks = CidrTable(excluded_networks)
+        self.excluded_suffixes = SuffixTable(excluded_suffixes)
+        self.allowed_networks = CidrTable(allowed_networks)
+        self.allowed_suffixes = SuffixTable(allowed_suffixes)
+
+    def check(self, ioc_kind, value):
+        """
+        Checks whether an IOC is worth a lookup
+
+        :param ioc_kind: Kind of the IOC (ip, domain, hash)
+        :param value: Raw value of the IOC
+        :return: None if it is, else (skip reason, message)
+        """
+        value = normalize_ioc_value(ioc_kind, value)
+
+        if ioc_kind == IOC_KIND_IP:
+            return self._check_ip(value)
+
+        if ioc_kind == IOC_KIND_DOMAIN:
+            return self._check_domain(value)
+
+        if ioc_kind == IOC_KIND_HASH:
+            return self._check_hash(value)
+
+        return None
+
+    @staticmethod
+    def _check_hash(value):
+        """
+        Checks a hash is of a type VT identifies files by
+
+        :param value: Normalized hash
+        :return: None or (skip reason, message)
+        """
+        if HASH_PATTERN.fullmatch(value):
+            return None
+
+        if HEX_PATTERN.fullmatch(value):
+            return SKIP_UNSUPPORTED_HASH, f'is a {len(value) * 4} bits hash, VT only knows md5, sha1 and sha256'
+
+        return SKIP_MALFORMED, 'is not a md5, sha1 or sha256'
+
+    def _check_ip(self, value):
+        """
+        Checks an IP address against the allowed, excluded and non routable networks
+
+        :param value: Normalized IP address
+        :return: None or (skip reason, message)
+        """
+        try:
+            address = ipaddress.ip_address(value)
+        except ValueError:
+            return SKIP_MALFORMED, 'is not an IP address'
+
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+
+        if address in self.allowed_networks:
+            return None
+
+        if address in self.excluded_networks:
+            return SKIP_EXCLUDED, 'is in an excluded network'
+
+        if self.skip_non_routable and address in self.non_routable_networks:
+            return SKIP_NON_ROUTABLE, 'is a private or reserved address'
+
+        return None
+
+    def _check_domain(self, value):
+        """
+        Checks a domain against the allowed, excluded and non routable suffixes, then its syntax
+
+        :param value: Normalized domain
+        :return: None or (skip reason, message)
+        """
+        if value in self.allowed_suffixes:
+            return None
+
+        if value in self.excluded_suffixes:
+            return SKIP_EXCLUDED, 'is in an excluded domain'
+
+        if self.skip_non_routable and ('.' not in value or value in self.non_routable_suffixes):
+            return SKIP_NON_ROUTABLE, 'is an internal or reserved name'
+
+        if not value.isascii():
+            try:
+                value = value.encode('idna').decode('ascii')
+            except UnicodeError:
+                return SKIP_MALFORMED, 'is not a domain name'
+
+        if not DOMAIN_PATTERN.fullmatch(value):
+            return SKIP_MALFORMED, 'is not a domain name'
+
+        return None
+
+
+def get_preflight(mod_config):
+    """
+    Returns the pre-flight checks of the module configuration, or None if disabled. Tables are compiled
+    once per configuration and reused by the hooks of the worker
+
+    :param mod_config: Module configuration
+    :return: VtPreflight or None
+    """
+    if not mod_config.get('vt_preflight_enabled'):
+        return None
+
+    config_key = (bool(mod_config.get('vt_preflight_skip_non_routable')),
+                  mod_config.get('vt_preflight_excluded') or '',
+                  mod_config.get('vt_preflight_allowed') or '')
+
+    with _preflights_lock:
+        preflight = _preflights.get(config_key)
+        if preflight is None:
+            preflight = VtPreflight(*config_key)
+            _preflights[config_key] = preflight
+
+    return preflight
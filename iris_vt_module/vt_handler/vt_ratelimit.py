@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+#
+#  IRIS VT Module Source Code
+#  contact@dfir-iris.org
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+import calendar
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from iris_vt_module.vt_handler.vt_cache import DEFAULT_CACHE_PATH, ensure_private_directory
+
+# Quotas of a public VT key. Premium keys quotas depend on the license, so they are unlimited
+# unless set in the module configuration
+PUBLIC_KEY_LIMITS = {
+    'per_minute': 4,
+    'per_day': 500,
+    'per_month': 15500
+}
+
+PREMIUM_KEY_LIMITS = {
+    'per_minute': 0,
+    'per_day': 0,
+    'per_month': 0
+}
+
+_quota_stores = {}
+_quota_stores_lock = threading.Lock()
+
+
+def get_quota_periods():
+    """
+    Returns the current UTC calendar day and month, the periods the daily and monthly quotas are counted over
+
+    :return: Tuple (day, month)
+    """
+    utc_now = time.gmtime()
+    return f'{utc_now.tm_year}-{utc_now.tm_yday:03d}', f'{utc_now.tm_year}-{utc_now.tm_mon:02d}'
+
+
+def get_quota_wait_time(limits, tokens, day_count, month_count):
+    """
+    Returns the number of seconds to wait before a request can be issued
+
+    :param limits: Tuple (per_minute, per_day, per_month)
+    :param tokens: Tokens of the minute bucket
+    :param day_count: Requests issued during the current day
+    :param month_count: Requests issued during the current month
+    :return: Seconds to wait, 0 if a request can be issued now
+    """
+    per_minute, per_day, per_month = limits
+
+    if per_month and month_count >= per_month:
+        utc_now = time.gmtime()
+        next_month = (utc_now.tm_year + utc_now.tm_mon // 12, utc_now.tm_mon % 12 + 1)
+        return calendar.timegm((*next_month, 1, 0, 0, 0, 0, 0, 0)) - time.time()
+
+    if per_day and day_count >= per_day:
+        return 86400 - time.time() % 86400
+
+    if per_minute and tokens < 1:
+        return (1 - tokens) * 60.0 / per_minute
+
+    return 0
+
+
+class VtQuotaStore(object):
+    """
+    Request slots of the VT keys, stored in a SQLite database shared by all the IRIS workers of the host,
+    so the workers together stay within the quota of a key, and restarts don't reset it. Each key has a
+    minute bucket, refilled on the wall clock as the workers don't share a monotonic one, and a counter
+    per quota window, holding the requests issued during the current period of the window
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+
+        ensure_private_directory(os.path.dirname(db_path) or '.')
+
+        self._conn = sqlite3.connect(db_path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS vt_rate_buckets ('
+                           'bucket TEXT PRIMARY KEY, '
+                           'tokens REAL NOT NULL, '
+                           'refilled_at REAL NOT NULL)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS vt_quota_counters ('
+                           'bucket TEXT NOT NULL, '
+                           'window TEXT NOT NULL, '
+                           'period TEXT NOT NULL, '
+                           'count INTEGER NOT NULL, '
+                           'PRIMARY KEY (bucket, window))')
+
+    def _get_state(self, bucket, limits, now, periods):
+        """
+        Returns the state of the quota of a key. Caller must hold the lock
+
+        :param bucket: ID of the bucket of the key
+        :param limits: Tuple (per_minute, per_day, per_month)
+        :param now: Current time
+        :param periods: Current periods returned by get_quota_periods
+        :return: Tuple (tokens of the minute bucket refilled up to now, day count, month count)
+        """
+        per_minute = limits[0]
+        tokens = float(per_minute)
+        if per_minute:
+            row = self._conn.execute('SELECT tokens, refilled_at FROM vt_rate_buckets WHERE bucket = ?',
+                                     (bucket,)).fetchone()
+            if row is not None:
+                tokens = min(tokens, row[0] + max(now - row[1], 0) * per_minute / 60.0)
+
+        counts = {'day': 0, 'month': 0}
+        if limits[1] or limits[2]:
+            day, month = periods
+            for window, period, count in self._conn.execute('SELECT window, period, count FROM vt_quota_counters '
+                                                            'WHERE bucket = ?', (bucket,)):
+                # Counters of a past period are reset by the next request
+                if period == (day if window == 'day' else month):
+                    counts[window] = count
+
+        return tokens, counts['day'], counts['month']
+
+    def try_acquire(self, bucket, limits):
+        """
+        Takes a request slot of a key. The quota is read and updated in a single write transaction, so
+        concurrent workers never take the same slot
+
+        :param bucket: ID of the bucket of the key
+        :param limits: Tuple (per_minute, per_day, per_month)
+        :return: 0 if a slot was taken, else the number of seconds to wait before trying again
+        """
+        now = time.time()
+        periods = get_quota_periods()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                tokens, day_count, month_count = self._get_state(bucket, limits, now, periods)
+                wait = get_quota_wait_time(limits, tokens, day_count, month_count)
+
+                if limits[0]:
+                    # The refill is recorded whether a token is taken or not
+                    self._conn.execute('INSERT OR REPLACE INTO vt_rate_buckets (bucket, tokens, refilled_at) '
+                                       'VALUES (?, ?, ?)', (bucket, tokens if wait > 0 else tokens - 1, now))
+
+                if wait <= 0:
+                    counters = [('day', periods[0], day_count + 1), ('month', periods[1], month_count + 1)]
+                    self._conn.executemany('INSERT OR REPLACE INTO vt_quota_counters (bucket, window, period, '
+                                           'count) VALUES (?, ?, ?, ?)',
+                                           [(bucket, window, period, count) for window, period, count in counters
+                                            if limits[1 if window == 'day' else 2]])
+
+                self._conn.execute('COMMIT')
+
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+
+        return max(wait, 0)
+
+    def get_state(self, bucket, limits):
+        """
+        Returns the state of the quota of a key, without taking a slot
+
+        :param bucket: ID of the bucket of the key
+        :param limits: Tuple (per_minute, per_day, per_month)
+        :return: Tuple (tokens of the minute bucket, day count, month count)
+        """
+        with self._lock:
+            return self._get_state(bucket, limits, time.time(), get_quota_periods())
+
+    def empty_bucket(self, bucket):
+        """
+        Empties the minute bucket of a key, so the next tokens are available once it refilled
+
+        :param bucket: ID of the bucket of the key
+        :return: Nothing
+        """
+        with self._lock:
+            self._conn.execute('INSERT INTO vt_rate_buckets (bucket, tokens, refilled_at) VALUES (?, 0, ?) '
+                               'ON CONFLICT (bucket) DO UPDATE SET tokens = MIN(tokens, 0), '
+                               'refilled_at = excluded.refilled_at', (bucket, time.time()))
+
+
+def get_quota_store(mod_config):
+    """
+    Returns the quota store, located next to the report cache
+
+    :param mod_config: Module configuration
+    :return: VtQuotaStore
+    """
+    db_path = os.path.join(os.path.dirname(mod_config.get('vt_cache_path') or DEFAULT_CACHE_PATH), 'vt_quota.db')
+
+    with _quota_stores_lock:
+        store = _quota_stores.get(db_path)
+        if store is None:
+            store = VtQuotaStore(db_path)
+            _quota_stores[db_path] = store
+
+    return store
+
+
+def get_bucket_id(api_key):
+    """
+    Returns the ID of the quota bucket of a key, without disclosing the key
+
+    :param api_key: VT API key
+    :return: Hex digest
+    """
+    return hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()[:16]
+
+
+class VtRateLimiter(object):
+    """
+    Quota aware rate limiter. Requests per minute are throttled with a token bucket, while the daily
+    and monthly quotas are tracked as counters over UTC calendar windows. Both are kept in the quota
+    store, shared by the workers. A limit set to 0 is unlimited, and a key without limits never
+    reaches the store.
+    """
+    def __init__(self, per_minute, per_day, per_month, store, bucket):
+        """
+        :param per_minute: Requests per minute
+        :param per_day: Requests per UTC day
+        :param per_month: Requests per UTC month
+        :param store: VtQuotaStore holding the quota of the key
+        :param bucket: ID of the bucket of the key in the store
+        """
+        self.per_minute = per_minute
+        self.per_day = per_day
+        self.per_month = per_month
+        self.store = store
+        self.bucket = bucket
+
+    @property
+    def limits(self):
+        return self.per_minute, self.per_day, self.per_month
+
+    def try_acquire(self):
+        """
+        Takes a request slot if the quota allows it
+
+        :return: 0 if a slot was taken, else the number of seconds to wait before trying again
+        """
+        if not any(self.limits):
+            return 0
+
+        return self.store.try_acquire(self.bucket, self.limits)
+
+    def get_wait_time(self):
+        """
+        Returns the number of seconds to wait before a request can be issued, without taking a slot
+
+        :return: Seconds to wait, 0 if a request can be issued now
+        """
+        if not any(self.limits):
+            return 0
+
+        return max(get_quota_wait_time(self.limits, *self.store.get_state(self.bucket, self.limits)), 0)
+
+    def acquire(self, max_wait):
+        """
+        Waits for the quota to allow a new request, for at most max_wait seconds
+
+        :param max_wait: Maximum number of seconds to wait
+        :return: True if the request can be issued, False if the deadline would be exceeded
+        """
+        deadline = time.monotonic() + max_wait
+
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return True
+
+            if time.monotonic() + wait > deadline:
+                return False
+
+            time.sleep(wait)
+
+    async def acquire_async(self, max_wait):
+        """
+        Same as acquire, for the asyncio engine. Waiting doesn't block the event loop
+
+        :param max_wait: Maximum number of seconds to wait
+        :return: True if the request can be issued, False if the deadline would be exceeded
+        """
+        import asyncio
+
+        deadline = time.monotonic() + max_wait
+
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return True
+
+            if time.monotonic() + wait > deadline:
+                return False
+
+            await asyncio.sleep(wait)
+
+    def notify_quota_exceeded(self):
+        """
+        Empties the minute bucket after VT answered with a quota exceeded status, so the next
+        requests wait for a full refill instead of being rejected again
+
+        :return: Nothing
+        """
+        if self.per_minute:
+            self.store.empty_bucket(self.bucket)
+
+    def get_remaining(self):
+        """
+        Returns the remaining quota of each window. None means unlimited
+
+        :return: Dict
+        """
+        tokens, day_count, month_count = self.store.get_state(self.bucket, self.limits) if any(self.limits) \
+            else (0, 0, 0)
+
+        return {
+            'minute': int(tokens) if self.per_minute else None,
+            'day': self.per_day - day_count if self.per_day else None,
+            'month': self.per_month - month_count if self.per_month else None
+        }
+
+
+def build_rate_limiter(mod_config, api_key, is_premium):
+    """
+    Builds the rate limiter of a key from the module configuration. The limits depend on the key being
+    premium or not, and each of them can be overridden in the configuration
+
+    :param mod_config: Module configuration
+    :param api_key: VT API key
+    :param is_premium: True if the key is premium
+    :return: VtRateLimiter
+    """
+    limits = dict(PREMIUM_KEY_LIMITS if is_premium else PUBLIC_KEY_LIMITS)
+
+    for window in limits:
+        value = mod_config.get(f'vt_rate_limit_{window}')
+        if value is not None and str(value) != '':
+            limits[window] = int(value)
+
+    return VtRateLimiter(store=get_quota_store(mod_config), bucket=get_bucket_id(api_key), **limits)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+#
+#  IRIS VT Module Source Code
+#  contact@dfir-iris.org
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+
+class DetectionStats(object):
+    """
+    Detection counts of a list of VT items, such as detected URLs or samples
+    """
+    __slots__ = ('count', 'positives', 'total')
+
+    def __init__(self):
+        self.count = 0
+        self.positives = 0
+        self.total = 0
+
+    @classmethod
+    def from_items(cls, items):
+        """
+        Counts the detections of a report section in a single pass
+
+        :param items: List of dicts with positives and total
+        :return: DetectionStats
+        """
+        stats = cls()
+        for item in items:
+            stats.count += 1
+            stats.positives += item.get('positives') or 0
+            stats.total += item.get('total') or 0
+
+        return stats
+
+    def get_ratio(self):
+        """
+        Detection ratio of the section, in percent
+
+        :return: Float or None if there is nothing detected
+        """
+        if not self.count or not self.total:
+            return None
+
+        return round(self.positives / self.total, 2) * 100
+
+    def get_average_str(self):
+        """
+        Average detection of the items, as displayed in the reports
+
+        :return: String
+        """
+        if not self.count:
+            return "No information"
+
+        return f"{round(self.positives / self.count, 2)} / {self.total / self.count}"
+
+
+class VtReportModel(object):
+    """
+    Normalized view of the results of a VT report, holding only the statistics the enrichment needs.
+    Statistics are computed once when the results are parsed, then shared by the tagging and the
+    templates, so the raw results are not walked again and can be released once rendered.
+    """
+    __slots__ = ('response_code', 'positives', 'total', 'asn', 'detected_urls', 'downloaded_samples',
+                 'communicating_samples', 'engine_detections')
+
+    def __init__(self):
+        self.response_code = None
+        self.positives = None
+        self.total = None
+        self.asn = None
+        # Stats are None when the section is missing from the report
+        self.detected_urls = None
+        self.downloaded_samples = None
+        self.communicating_samples = None
+        # (engine, result) of the engines detecting a file
+        self.engine_detections = ()
+
+    @classmethod
+    def from_results(cls, results):
+        """
+        Builds the model of the results of a VT report
+
+        :param results: Results of a VT report
+        :return: VtReportModel
+        """
+        model = cls()
+        model.response_code = results.get('response_code')
+        model.positives = results.get('positives')
+        model.total = results.get('total')
+        model.asn = results.get('asn')
+
+        if 'detected_urls' in results:
+            model.detected_urls = DetectionStats.from_items(results['detected_urls'])
+
+        if 'detected_downloaded_samples' in results:
+            model.downloaded_samples = DetectionStats.from_items(results['detected_downloaded_samples'])
+
+        if 'detected_communicating_samples' in results:
+            model.communicating_samples = DetectionStats.from_items(results['detected_communicating_samples'])
+
+        scans = results.get('scans')
+        if isinstance(scans, dict):
+            model.engine_detections = tuple((engine, scan.get('result')) for engine, scan in scans.items()
+                                            if isinstance(scan, dict) and scan.get('detected'))
+
+        return model
+
+    def get_detection_ratio(self):
+        """
+        Detection ratio used to tag the IOC, in percent. The detected URLs ratio is used if any,
+        else the positives of the file report
+
+        :return: Float or None
+        """
+        ratio = self.detected_urls.get_ratio() if self.detected_urls else None
+
+        if not ratio and self.positives and self.total:
+            ratio = round(float(self.positives) / float(self.total), 2) * 100
+
+        return ratio
+
+    def get_template_context(self, samples):
+        """
+        Returns the statistics exposed to the report templates
+
+        :param samples: Samples stats displayed by the template, either downloaded or communicating
+        :return: Dict
+        """
+        context = {
+            'avg_urls_detect_ratio': self.detected_urls.get_average_str() if self.detected_urls else "No information",
+            'nb_detected_urls': self.detected_urls.count if self.detected_urls else None
+        }
+
+        if samples is not None:
+            context['nb_detected_samples'] = samples.count
+            context['avg_samples_detect_ratio'] = samples.get_average_str()
+
+        return context
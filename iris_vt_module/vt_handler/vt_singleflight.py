@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+#
+#  IRIS VT Module Source Code
+#  contact@dfir-iris.org
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+import threading
+
+
+class Flight(object):
+    """
+    Outstanding lookup, which followers wait for
+    """
+    def __init__(self):
+        self._done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self, timeout=None):
+        """
+        Waits for the lookup to complete and returns its result
+
+        :param timeout: Maximum time to wait, in seconds. None to wait until the lookup completes
+        :return: Result of the lookup. Raises the error of the lookup if it failed, or TimeoutError if
+                 it did not complete in time
+        """
+        if not self._done.wait(timeout):
+            raise TimeoutError(f'Lookup still running after {timeout} seconds')
+
+        if self.error is not None:
+            raise self.error
+
+        return self.result
+
+    def is_done(self):
+        return self._done.is_set()
+
+    def set_done(self):
+        self._done.set()
+
+
+class SingleFlight(object):
+    """
+    Coalesces identical lookups issued at the same time. The first caller claiming a key becomes the
+    leader of the lookup, the next ones become followers and share its result once the leader resolves it.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def claim(self, key):
+        """
+        Claims a key. The leader must eventually call resolve or fail with the returned flight
+
+        :param key: Key identifying the lookup
+        :return: Tuple (flight, True if the caller is the leader)
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, False
+
+            flight = Flight()
+            self._flights[key] = flight
+            return flight, True
+
+    def resolve(self, key, flight, result):
+        """
+        Publishes the result of a lookup to its followers
+
+        :param key: Key identifying the lookup
+        :param flight: Flight returned by claim
+        :param result: Result of the lookup
+        :return: Nothing
+        """
+        self._complete(key, flight, result=result)
+
+    def fail(self, key, flight, error):
+        """
+        Publishes the failure of a lookup to its followers. No-op if the flight is already resolved
+
+        :param key: Key identifying the lookup
+        :param flight: Flight returned by claim
+        :param error: Exception raised to the followers
+        :return: Nothing
+        """
+        self._complete(key, flight, error=error)
+
+    def _complete(self, key, flight, result=None, error=None):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+            if flight.is_done():
+                return
+
+            flight.result = result
+            flight.error = error
+
+        flight.set_done()
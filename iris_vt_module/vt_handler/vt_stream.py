@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+#
+#  IRIS VT Module Source Code
+#  contact@dfir-iris.org
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU Lesser General Public
+#  License as published by the Free Software Foundation; either
+#  version 3 of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+import codecs
+import json
+import re
+
+# Sections of IP and domain reports that can hold thousands of items on shared hosting or CDN
+# infrastructure, and only serve display purposes. Detected sections are never cut as the
+# detection statistics are computed on them
+PROJECTED_LIST_SECTIONS = ('resolutions', 'subdomains', 'domain_siblings')
+UNDETECTED_PREFIX = 'undetected_'
+
+_WHITESPACES = ' \t\n\r'
+_json_decoder = json.JSONDecoder()
+_STRING = re.compile(r'"(?:[^"\\]|\\.)*"', re.DOTALL)
+_SCALAR = re.compile(r'[^\s,\]}]+')
+# Inside containers, everything between brackets, complete strings included, is matched as a single run.
+# A run never ends inside a string, so the stream can be cut after any run or bracket
+_CONTAINER_RUN = re.compile(r'[^"\[\]{}]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"\[\]{}]*)*', re.DOTALL)
+
+
+class ReportProjection(object):
+    """
+    Describes the parts of a report kept when it is parsed
+    """
+    def __init__(self, max_items=0, skip_undetected=False):
+        """
+        :param max_items: Maximum number of items kept in the projected list sections. 0 means unlimited
+        :param skip_undetected: Drop the undetected_* sections
+        """
+        self.max_items = max_items
+        self.skip_undetected = skip_undetected
+
+    def is_active(self):
+        return bool(self.max_items or self.skip_undetected)
+
+    def skips(self, key):
+        return self.skip_undetected and key.startswith(UNDETECTED_PREFIX)
+
+    def get_limit(self, key):
+        return self.max_items if key in PROJECTED_LIST_SECTIONS else 0
+
+
+class _StreamReader(object):
+    """
+    Reads JSON text out of a stream of bytes chunks. Only the unconsumed part of the current
+    chunk is buffered, so skipped values are never held in memory
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """
+        Appends the next chunk to the unconsumed part of the buffer
+
+        :return: False if the stream is exhausted
+        """
+        if self.eof:
+            return False
+
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            self.eof = True
+            text = self._decoder.decode(b'', final=True)
+        else:
+            text = self._decoder.decode(chunk)
+
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        Skips whitespaces and returns the next character
+
+        :return: Character, or empty string at the end of the stream
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACES:
+                self.pos += 1
+
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+
+            if not self.fill():
+                return ''
+
+    def expect(self, expected):
+        char = self.peek()
+        if char not in expected:
+            raise ValueError(f'Expecting one of {expected!r} at position {self.pos}, got {char!r}')
+        self.pos += 1
+        return char
+
+    def _match(self, pattern):
+        """
+        Matches a token at the current position, reading more of the stream while the token may be incomplete
+
+        :param pattern: Compiled token pattern
+        :return: Match or None
+        """
+        while True:
+            match = pattern.match(self.buffer, self.pos)
+            if match is not None and (match.end() < len(self.buffer) or self.eof):
+                return match
+
+            if not self.fill():
+                return pattern.match(self.buffer, self.pos)
+
+    def read_value(self, keep=True):
+        """
+        Reads the next JSON value
+
+        :param keep: Decode the value. When False, the value is skipped without being materialized
+        :return: Decoded value, or None if skipped
+        """
+        char = self.peek()
+        if char not in '[{':
+            match = self._match(_STRING if char == '"' else _SCALAR)
+            if match is None:
+                raise ValueError(f'Invalid JSON value at position {self.pos}')
+            self.pos = match.end()
+            return json.loads(match.group()) if keep else None
+
+        if keep:
+            # Values held in the buffered chunk are decoded directly
+            try:
+                value, end = _json_decoder.raw_decode(self.buffer, self.pos)
+                self.pos = end
+                return value
+            except ValueError:
+                pass
+
+        return self.read_container(keep)
+
+    def read_container(self, keep=True, depth=0):
+        """
+        Reads a JSON list or object, or the rest of it
+
+        :param keep: Decode the container. When False, it is skipped without being materialized
+        :param depth: Number of containers already opened, to read the rest of a container
+        :return: Decoded container, or None if skipped
+        """
+        pieces = []
+        start = self.pos
+        buffer = self.buffer
+        pos = self.pos
+        while True:
+            char = buffer[pos:pos + 1]
+            if char == '[' or char == '{':
+                depth += 1
+                pos += 1
+                continue
+
+            if char == ']' or char == '}':
+                depth -= 1
+                pos += 1
+                if not depth:
+                    break
+                continue
+
+            end = _CONTAINER_RUN.match(buffer, pos).end() if char else pos
+            if end > pos:
+                pos = end
+                continue
+
+            # End of the chunk, or string cut by it. Keep what was read and read more
+            self.pos = pos
+            if keep:
+                pieces.append(buffer[start:pos])
+            if not self.fill():
+                raise ValueError('Unexpected end of JSON stream')
+            buffer = self.buffer
+            pos = start = 0
+
+        self.pos = pos
+
+        if not keep:
+            return None
+
+        pieces.append(self.buffer[start:self.pos])
+        return json.loads(''.join(pieces))
+
+
+def _read_list(reader, limit):
+    """
+    Reads a JSON list, keeping only its first items
+
+    :param reader: _StreamReader positioned on the list
+    :param limit: Number of items kept
+    :return: List
+    """
+    items = []
+    reader.expect('[')
+    if reader.peek() == ']':
+        reader.pos += 1
+        return items
+
+    while True:
+        items.append(reader.read_value())
+
+        if reader.expect(',]') == ']':
+            return items
+
+        if len(items) == limit:
+            # The remaining items are skipped in a single scan
+            reader.read_container(keep=False, depth=1)
+            return items
+
+
+def parse_projected(chunks, projection):
+    """
+    Parses a VT report streamed as bytes chunks, materializing only the sections kept by the projection.
+    Skipped sections and the items beyond the limit of a list are scanned but never decoded, so the
+    memory used scales with the projection rather than with the size of the response
+
+    :param chunks: Iterable of bytes
+    :param projection: ReportProjection
+    :return: Decoded report
+    """
+    reader = _StreamReader(chunks)
+    if reader.peek() != '{':
+        # Batched file reports are lists of small reports, they are decoded whole
+        return reader.read_value()
+
+    results = {}
+    reader.expect('{')
+    if reader.peek() == '}':
+        return results
+
+    while True:
+        key = reader.read_value()
+        reader.expect(':')
+
+        limit = projection.get_limit(key)
+        if projection.skips(key):
+            reader.read_value(keep=False)
+        elif limit and reader.peek() == '[':
+            results[key] = _read_list(reader, limit)
+        else:
+            results[key] = reader.read_value()
+
+        if reader.expect(',}') == '}':
+            return results
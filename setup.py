@@ -37,8 +37,11 @@ setuptools.setup(
          "Operating System :: OS Independent",
      ],
      install_requires=[
-        "virustotal-api==1.1.11",
+        "requests",
         "setuptools",
         "pyunpack"
-    ]
+    ],
+     extras_require={
+        "asyncio": ["aiohttp"]
+    }
  )